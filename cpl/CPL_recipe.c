@@ -3,6 +3,8 @@
 #include <dlfcn.h>
 #include <sys/wait.h>
 #include <sys/times.h>
+#include <time.h>
+#include <sys/resource.h>
 #include <signal.h>
 #include <stdlib.h>
 #include <stdio.h>
@@ -16,6 +18,8 @@
 #define HAVE_MTRACE
 #include <malloc.h>
 #define HAVE_MALLOPT
+#include <sched.h>
+#define HAVE_CPU_AFFINITY
 #endif
 
 /* Define PY_Type for Python <= 2.6 */
@@ -98,8 +102,21 @@ CPL_supported_versions(PyObject *self, PyObject *args) {
     return res;
 }
 
+#define CPL_parse_result_doc \
+    "Convert the data written by a recipe child process into the\n" \
+    "(frames, errors, stats) result tuple of run(). The optional\n"  \
+    "arguments are the resource usage of the child process as\n"    \
+    "reported by wait4(): the peak resident set size in bytes (minus\n"\
+    "the size at the fork, as returned by start()), the minor and\n" \
+    "major page faults, and the voluntary and involuntary context\n" \
+    "switches."
+
+static PyObject *
+CPL_parse_result(PyObject *self, PyObject *args);
+
 static PyMethodDef CPL_methods[] = {
     {"list", CPL_list, METH_VARARGS, CPL_list_doc},
+    {"parse_result", CPL_parse_result, METH_VARARGS, CPL_parse_result_doc},
     {"cpl_versions", CPL_supported_versions, METH_NOARGS, 
      CPL_supported_versions_doc},
     {NULL, NULL, 0, NULL}        /* Sentinel */
@@ -577,17 +594,23 @@ set_environment(PyObject *runenv) {
 }
 
 static PyObject *
-exec_build_retval(void *ptr) {
+exec_build_retval(void *ptr, const long long *usage) {
     long ret_code = ((long *)ptr)[1];
     double user_time = ((long *)ptr)[2] * 1e-6;
     double sys_time = ((long *)ptr)[3] * 1e-6;
     int memcheck = ((long *)ptr)[4];
-    PyObject *stats = Py_BuildValue("iffi", 
-				    ret_code, user_time, sys_time, memcheck);
-
-    long n_errors = ((long *)ptr)[5];
-
-    long index = 6 * sizeof(long);
+    double wall_time = ((long *)ptr)[5] * 1e-6;
+    PyObject *stats = Py_BuildValue("iffiLfLLLLLLLL", ret_code, user_time,
+				    sys_time, memcheck, usage[0], wall_time,
+				    usage[1], usage[2], usage[3], usage[4],
+				    (long long)((long *)ptr)[6],
+				    (long long)((long *)ptr)[7],
+				    (long long)((long *)ptr)[8],
+				    (long long)((long *)ptr)[9]);
+
+    long n_errors = ((long *)ptr)[10];
+
+    long index = 11 * sizeof(long);
     PyObject *errors = PyList_New(0);
     for (; n_errors > 0; n_errors--) {
 	long error_code = *((long *)(ptr + index));
@@ -667,7 +690,8 @@ exec_serialize_one_error(unsigned self, unsigned first, unsigned last) {
 static void *
 exec_serialize_retval(CPL_recipe *self, cpl_frameset *frames, 
 		      cpl_errorstate prestate, int retval, 
-		      const struct tms *tms_clock) {
+		      const struct tms *tms_clock, long wall_time,
+		      const long *io) {
     int n_frames = self->cpl->frameset_get_size(frames);
     int i_frame;
     void *ptr = malloc(sizeof(long));
@@ -680,6 +704,11 @@ exec_serialize_retval(CPL_recipe *self, cpl_frameset *frames,
 			      (tms_clock->tms_stime + tms_clock->tms_cstime)
 			      / sysconf(_SC_CLK_TCK));
     ptr = sbuffer_append_long(ptr, self->cpl->memory_is_empty());
+    ptr = sbuffer_append_long(ptr, wall_time);
+    int i_io;
+    for (i_io = 0; i_io < 4; i_io++) {
+	ptr = sbuffer_append_long(ptr, io[i_io]);
+    }
 
     serialized_cpl = self->cpl;
     self->cpl->errorstate_dump(prestate, CPL_FALSE, exec_serialize_one_error);
@@ -699,6 +728,50 @@ exec_serialize_retval(CPL_recipe *self, cpl_frameset *frames,
     }
     return ptr;
 }
+/* Read the I/O counters rchar, wchar, read_bytes and write_bytes of the
+   current process. Counters that are not available are set to -1. */
+static void read_proc_io(long *io) {
+    static const char *keys[] = {
+	"rchar:", "wchar:", "read_bytes:", "write_bytes:"
+    };
+    int i;
+    for (i = 0; i < 4; i++) {
+	io[i] = -1;
+    }
+    FILE *f = fopen("/proc/self/io", "r");
+    if (f == NULL) {
+	return;
+    }
+    char line[100];
+    while (fgets(line, sizeof(line), f) != NULL) {
+	for (i = 0; i < 4; i++) {
+	    if (strncmp(line, keys[i], strlen(keys[i])) == 0) {
+		io[i] = atol(line + strlen(keys[i]));
+	    }
+	}
+    }
+    fclose(f);
+}
+
+/* Resident set size of the current process in bytes, or 0 if it is not
+   available. A forked child starts with this as its peak RSS. */
+static long long read_proc_rss(void) {
+    long long size, resident;
+    FILE *f = fopen("/proc/self/statm", "r");
+    if (f == NULL) {
+	return 0;
+    }
+    int n = fscanf(f, "%lld %lld", &size, &resident);
+    fclose(f);
+    return (n == 2) ? resident * sysconf(_SC_PAGESIZE) : 0;
+}
+
+static long wall_clock(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return 1000000L * ts.tv_sec + ts.tv_nsec / 1000;
+}
+
 static int do_backtrace(void) {
   char cmd[300];
   snprintf(cmd, sizeof(cmd), 
@@ -778,14 +851,12 @@ static void setup_tracing(CPL_recipe *self, int memory_trace) {
     signal(SIGTERM, (sighandler_t) segv_handler);
 }
 
-#define CPL_recipe_exec_doc                                             \
-    "Execute with parameters and frames.\n\n"                           \
-    "The parameters shall contain an iterable of (name, value) pairs\n" \
-    "where the values have the correct type for the parameter.\n"       \
-    "The frames shall contain an iterable of (name, tag) pairs."
-
-static PyObject *
-CPL_recipe_exec(CPL_recipe *self, PyObject *args) {
+/* Start the recipe in a forked child process. Returns the pid of the child,
+   stores the read end of the result pipe in rfd and the resident set size
+   of the parent at the fork in base_rss. On error, -1 is returned and a
+   Python exception is set. */
+static pid_t
+exec_start(CPL_recipe *self, PyObject *args, int *rfd, long long *base_rss) {
     PyObject *parlist;
     PyObject *soflist;
     PyObject *runenv;
@@ -794,26 +865,55 @@ CPL_recipe_exec(CPL_recipe *self, PyObject *args) {
     int loglevel;
     int memory_dump;
     int memory_trace;
-    if (!PyArg_ParseTuple(args, "sOOOsiii", &dirname, &parlist, &soflist,
-			  &runenv, &logfile, &loglevel,
-			  &memory_dump, &memory_trace))
-        return NULL;
+    PyObject *cpus = Py_None;
+    long long max_memory = -1;
+    long long max_cpu_time = -1;
+    int new_group = 0;
+    if (!PyArg_ParseTuple(args, "sOOOsiii|OLLi", &dirname, &parlist,
+			  &soflist, &runenv, &logfile, &loglevel,
+			  &memory_dump, &memory_trace, &cpus,
+			  &max_memory, &max_cpu_time, &new_group))
+        return -1;
     if (!PySequence_Check(parlist)) {
 	PyErr_SetString(PyExc_TypeError, "Second parameter not a list");
-	return NULL;
+	return -1;
     }
     if (!PySequence_Check(soflist)) {
 	PyErr_SetString(PyExc_TypeError, "Third parameter not a list");
-	return NULL;
+	return -1;
     }
     if (!PySequence_Check(runenv)) {
 	PyErr_SetString(PyExc_TypeError, "Fourth parameter not a list");
-	return NULL;
+	return -1;
     }
+#ifdef HAVE_CPU_AFFINITY
+    cpu_set_t cpuset;
+    CPU_ZERO(&cpuset);
+    if (cpus != Py_None) {
+	if (!PySequence_Check(cpus)) {
+	    PyErr_SetString(PyExc_TypeError, "CPU set not a list");
+	    return -1;
+	}
+	Py_ssize_t i_cpu;
+	for (i_cpu = 0; i_cpu < PySequence_Size(cpus); i_cpu++) {
+	    PyObject *item = PySequence_GetItem(cpus, i_cpu);
+	    long cpu = PyLong_AsLong(item);
+	    Py_XDECREF(item);
+	    if ((cpu == -1) && PyErr_Occurred()) {
+		return -1;
+	    }
+	    if ((cpu < 0) || (cpu >= CPU_SETSIZE)) {
+		PyErr_SetString(PyExc_ValueError, "CPU number out of range");
+		return -1;
+	    }
+	    CPU_SET(cpu, &cpuset);
+	}
+    }
+#endif
 
     if (self->plugin == NULL) {
 	PyErr_SetString(PyExc_IOError, "NULL recipe");
-	return NULL;
+	return -1;
     }
     self->cpl->error_reset();
     cpl_recipe *recipe = (cpl_recipe *)self->plugin;
@@ -823,31 +923,58 @@ CPL_recipe_exec(CPL_recipe *self, PyObject *args) {
     set_parameters(self, recipe->parameters, parlist);
     if (self->cpl->error_get_code() != CPL_ERROR_NONE) {
 	PyErr_SetString(PyExc_IOError, "CPL error on inititalization");
-	return NULL;	
+	return -1;
     }
     int fd[2];
     if (pipe(fd) == -1) {
 	PyErr_SetString(PyExc_IOError, "Cannot pipe()");
-	return NULL;
+	return -1;
     }
+    *base_rss = read_proc_rss();
     pid_t childpid = fork();
     if (childpid == -1) {
+	close(fd[0]);
+	close(fd[1]);
 	PyErr_SetString(PyExc_IOError, "Cannot fork()");
-	return NULL;
+	return -1;
     }
     
     if (childpid == 0) {
 	close(fd[0]);
+	if (new_group) {
+	    setpgid(0, 0);
+	}
+	struct rlimit limit;
+	if (max_memory > 0) {
+	    limit.rlim_cur = limit.rlim_max = max_memory;
+	    setrlimit(RLIMIT_AS, &limit);
+	}
+	if (max_cpu_time > 0) {
+	    /* SIGXCPU at the soft limit, SIGKILL one second later */
+	    limit.rlim_cur = max_cpu_time;
+	    limit.rlim_max = max_cpu_time + 1;
+	    setrlimit(RLIMIT_CPU, &limit);
+	}
 	int retval;
 	struct tms clock_end;
+	long wall_time = 0;
+	long io[4] = { -1, -1, -1, -1 };
 	set_environment(runenv);
+#ifdef HAVE_CPU_AFFINITY
+	if (cpus != Py_None) {
+	    sched_setaffinity(0, sizeof(cpuset), &cpuset);
+	}
+#endif
 	self->cpl->msg_set_log_name(logfile);
 	self->cpl->msg_set_log_level(loglevel);
 	self->cpl->msg_set_level(CPL_MSG_OFF);
 	cpl_errorstate prestate = self->cpl->errorstate_get();
 	if (chdir(dirname) == 0) {
 	    struct tms clock_start;
+	    long io_start[4];
 	    times(&clock_start);
+	    wall_time = wall_clock();
+	    read_proc_io(io_start);
 	    setup_tracing(self, memory_trace);
 	    retval = self->cpl->plugin_get_exec(self->plugin)(self->plugin);
 	    int reto;
@@ -868,6 +995,14 @@ CPL_recipe_exec(CPL_recipe *self, PyObject *args) {
 				      self->cpl->error_get_line());
 	    }
 	    times(&clock_end);
+	    wall_time = wall_clock() - wall_time;
+	    read_proc_io(io);
+	    int i_io;
+	    for (i_io = 0; i_io < 4; i_io++) {
+		if ((io[i_io] >= 0) && (io_start[i_io] >= 0)) {
+		    io[i_io] -= io_start[i_io];
+		}
+	    }
 	    clock_end.tms_utime -= clock_start.tms_utime;
 	    clock_end.tms_stime -= clock_start.tms_stime;
 	    clock_end.tms_cutime -= clock_start.tms_cutime;
@@ -878,7 +1013,7 @@ CPL_recipe_exec(CPL_recipe *self, PyObject *args) {
 	    self->cpl->error_set_message_macro(__func__, retval, __FILE__, __LINE__, " ");
 	}
 	void *ptr = exec_serialize_retval(self, recipe->frames, prestate,
-					  retval, &clock_end);
+					  retval, &clock_end, wall_time, io);
 	long n_bytes = write(fd[1], ptr, ((long *)ptr)[0]);
 	close(fd[1]);
 	retval = (n_bytes != ((long *)ptr)[0]);
@@ -901,20 +1036,49 @@ CPL_recipe_exec(CPL_recipe *self, PyObject *args) {
 	_exit(retval);
     }
     
+    if (new_group) {
+	/* Also set here, so that the group exists when fork() returns */
+	setpgid(childpid, childpid);
+    }
     close(fd[1]);
+    *rfd = fd[0];
+    return childpid;
+}
+
+#define CPL_recipe_exec_doc                                             \
+    "Execute with parameters and frames.\n\n"                           \
+    "The parameters shall contain an iterable of (name, value) pairs\n" \
+    "where the values have the correct type for the parameter.\n"       \
+    "The frames shall contain an iterable of (name, tag) pairs.\n"      \
+    "The optional arguments are a list of CPU numbers the recipe\n"     \
+    "process is bound to, the limits of its address space in bytes\n"  \
+    "and of its CPU time in seconds (-1 for no limit), and a flag\n"    \
+    "whether the process is put into its own process group."
+
+static PyObject *
+CPL_recipe_exec(CPL_recipe *self, PyObject *args) {
+    int rfd;
+    long long base_rss;
+    pid_t childpid = exec_start(self, args, &rfd, &base_rss);
+    if (childpid == -1) {
+	return NULL;
+    }
     long nbytes;
     long nbytes2;
+    struct rusage rusage;
+    int status = 0;
+    long long usage[5] = { -1, -1, -1, -1, -1 };
     void *ptr = malloc(2 * sizeof(long));
 Py_BEGIN_ALLOW_THREADS
     do {
-        nbytes = read(fd[0], ptr, 2 * sizeof(long));
+        nbytes = read(rfd, ptr, 2 * sizeof(long));
         if (nbytes >= 0 || errno != EINTR)
             break;
     } while (1);
     if (nbytes == 2 * sizeof(long)) {
         ptr = realloc(ptr, ((long *)ptr)[0]);
         do {
-            nbytes2 = read(fd[0], ptr + 2 * sizeof(long), 
+            nbytes2 = read(rfd, ptr + 2 * sizeof(long), 
                     ((long *)ptr)[0] - 2 * sizeof(long));
             if (nbytes2 >= 0 || errno != EINTR)
                 break;
@@ -923,14 +1087,80 @@ Py_BEGIN_ALLOW_THREADS
     } else { // broken pipe while reading first two bytes
         ((long *)ptr)[0] = 2 * sizeof(long); 
     }
-    close(fd[0]);
-    waitpid(childpid, NULL, 0);
+    close(rfd);
+    if (wait4(childpid, &status, 0, &rusage) == childpid) {
+        /* ru_maxrss is given in kilobytes. It includes the pages that
+           were resident in the parent at the fork. */
+        usage[0] = 1024LL * rusage.ru_maxrss - base_rss;
+        if (usage[0] < 0) {
+            usage[0] = 0;
+        }
+        usage[1] = rusage.ru_minflt;
+        usage[2] = rusage.ru_majflt;
+        usage[3] = rusage.ru_nvcsw;
+        usage[4] = rusage.ru_nivcsw;
+    }
 Py_END_ALLOW_THREADS
     if (nbytes != ((long *)ptr)[0]) {
+	free(ptr);
+	if (WIFSIGNALED(status)) {
+	    PyErr_Format(PyExc_IOError, "Recipe killed by signal %i",
+			 WTERMSIG(status));
+	} else {
+	    PyErr_SetString(PyExc_IOError, "Recipe crashed");
+	}
+	return NULL;
+    }
+    PyObject *retval = exec_build_retval(ptr, usage);
+    free(ptr);
+    return retval;
+}
+
+#define CPL_recipe_start_doc                                            \
+    "Start the execution with parameters and frames.\n\n"               \
+    "The arguments are the same as for run(). The recipe is started\n"  \
+    "in a child process, and the function returns immediately with\n"   \
+    "the (pid, fd, rss) triple of the child process, the file\n"       \
+    "descriptor of the pipe where the child writes its result, and\n"  \
+    "the resident set size in bytes the child inherited at the fork.\n"\
+    "The caller has to read the pipe until EOF, close it, wait for\n"  \
+    "the child and convert the data with parse_result()."
+
+static PyObject *
+CPL_recipe_start(CPL_recipe *self, PyObject *args) {
+    int rfd;
+    long long base_rss;
+    pid_t childpid = exec_start(self, args, &rfd, &base_rss);
+    if (childpid == -1) {
+	return NULL;
+    }
+    return Py_BuildValue("iiL", (int)childpid, rfd, base_rss);
+}
+
+static PyObject *
+CPL_parse_result(PyObject *self, PyObject *args) {
+    PyObject *data;
+    char *buffer;
+    Py_ssize_t nbytes;
+    long long usage[5] = { -1, -1, -1, -1, -1 };
+    if (!PyArg_ParseTuple(args, "O|LLLLL", &data, &usage[0], &usage[1],
+                          &usage[2], &usage[3], &usage[4]))
+        return NULL;
+#if PY_MAJOR_VERSION < 3
+    if (PyString_AsStringAndSize(data, &buffer, &nbytes) == -1)
+        return NULL;
+#else
+    if (PyBytes_AsStringAndSize(data, &buffer, &nbytes) == -1)
+        return NULL;
+#endif
+    if ((nbytes < 11 * (Py_ssize_t)sizeof(long))
+        || (((long *)buffer)[0] != nbytes)) {
 	PyErr_SetString(PyExc_IOError, "Recipe crashed");
 	return NULL;
     }
-    PyObject *retval = exec_build_retval(ptr);
+    void *ptr = malloc(nbytes);
+    memcpy(ptr, buffer, nbytes);
+    PyObject *retval = exec_build_retval(ptr, usage);
     free(ptr);
     return retval;
 }
@@ -948,6 +1178,8 @@ static PyMethodDef CPL_recipe_methods[] = {
      CPL_recipe_get_copyright_doc},
     {"frameConfig",  (PyCFunction)CPL_recipe_get_frameconfig, METH_NOARGS,
      CPL_recipe_get_frameconfig_doc},
+    {"start",  (PyCFunction)CPL_recipe_start, METH_VARARGS,
+     CPL_recipe_start_doc},
     {"run",  (PyCFunction)CPL_recipe_exec, METH_VARARGS,
      CPL_recipe_exec_doc},
     {"cpl_is_supported", (PyCFunction)CPL_is_supported, METH_NOARGS,
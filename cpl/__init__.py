@@ -14,6 +14,7 @@ aspects of the CPL data-reduction development environment.
 '''
 
 from __future__ import absolute_import
+import sys
 
 from .version import version as __version__
 from .version import author as __author__
@@ -23,17 +24,44 @@ from .version import license_ as __license__
 from .recipe import Recipe
 from .param import Parameter
 from .frames import FrameConfig
-from .result import Result, CplError, RecipeCrash
-from . import dfs
-from . import esorex
-from . import CPL_recipe
+from .result import Result, CplError, RecipeCrash, RecipeTimeout, \
+    RecipeKilled, RecipeStalled
 
 Recipe.dir = '.'
-cpl_versions = [ '%i.%i.%i' % ver for ver in CPL_recipe.cpl_versions() ]
-del CPL_recipe
-del absolute_import
+
+def _cpl_versions():
+    from . import CPL_recipe
+    return [ '%i.%i.%i' % ver for ver in CPL_recipe.cpl_versions() ]
+
+# Submodules and attributes that are expensive to import or to compute, and
+# that are therefore loaded on first access only.
+_lazy = {
+    'dfs': lambda: __import__('cpl.dfs').dfs,
+    'esorex': lambda: __import__('cpl.esorex').esorex,
+    'executor': lambda: __import__('cpl.executor').executor,
+    'forkserver': lambda: __import__('cpl.forkserver').forkserver,
+    'scheduler': lambda: __import__('cpl.scheduler').scheduler,
+    'staging': lambda: __import__('cpl.staging').staging,
+    'RecipeExecutor': lambda: __import__('cpl.executor').executor \
+        .RecipeExecutor,
+    'cpl_versions': _cpl_versions,
+}
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name not in _lazy:
+            raise AttributeError("module %r has no attribute %r"
+                                 % (__name__, name))
+        value = _lazy[name]()
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_lazy))
+else:
+    for _name, _load in _lazy.items():
+        globals()[_name] = _load()
+    del _name, _load
+
+del absolute_import, sys
 del recipe, version, param, frames, result, md5sum
-try:
-    del ver
-except NameError:
-    pass
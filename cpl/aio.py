@@ -0,0 +1,274 @@
+'''Execution of recipes in an :mod:`asyncio` event loop.
+
+The recipe process is started with :meth:`CPL_recipe.recipe.start()`. The
+event loop watches the result pipe and the log FIFO of the recipe with
+:meth:`asyncio.AbstractEventLoop.add_reader`, and collects the exit status
+of the child via a process file descriptor (or by polling, if these are
+not available). No threads are needed, so that many concurrent recipe
+calls can be supervised from one thread.
+
+This module requires Python 3.5 or later. Use :meth:`cpl.Recipe.acall()`
+to call a recipe.
+'''
+import asyncio
+import errno
+import os
+
+from . import CPL_recipe
+from . import timeline
+from .supervisor import Supervisor, drain, usage, _exited
+from .logger import LogReceiver
+from .result import Result, RecipeTimeout, RecipeKilled
+
+_retry = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class AsyncLogReceiver(LogReceiver):
+    '''Receiver of the log messages of a recipe call that reads the FIFO in
+    the event loop.
+    '''
+
+    def __init__(self, loop, name, level = None):
+        LogReceiver.__init__(self, name, level)
+        self._loop = loop
+        self._buffer = b''
+        self._fd = os.open(self.logfile, os.O_RDONLY | os.O_NONBLOCK)
+        # Keep the FIFO open for writing as well: otherwise reading would
+        # return EOF as long as the recipe did not open it.
+        self._wfd = os.open(self.logfile, os.O_WRONLY | os.O_NONBLOCK)
+        loop.add_reader(self._fd, self._read)
+
+    def _read(self):
+        try:
+            self._feed(os.read(self._fd, 65536))
+        except OSError as e:
+            if e.errno not in _retry:
+                self._loop.remove_reader(self._fd)
+
+    def _feed(self, chunk):
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self.log(line.decode('ascii', 'replace') + '\n')
+
+    def close(self):
+        '''Stop reading and process the remaining messages.'''
+        if self._fd is None:
+            return
+        self._loop.remove_reader(self._fd)
+        os.close(self._wfd)
+        while True:
+            try:
+                chunk = os.read(self._fd, 65536)
+            except OSError:
+                break
+            if not chunk:
+                break
+            self._feed(chunk)
+        if self._buffer:
+            self._feed(b'\n')
+        os.close(self._fd)
+        self._fd = None
+        try:
+            os.remove(self.logfile)
+        except OSError:
+            pass
+
+class _ResultReader(object):
+    '''Read the result pipe of a recipe process in the event loop.'''
+
+    def __init__(self, loop, fd):
+        self._loop = loop
+        self._fd = fd
+        self.data = bytearray()
+        os.set_blocking(fd, False)
+        loop.add_reader(fd, self._read)
+
+    def _read(self):
+        try:
+            chunk = os.read(self._fd, 65536)
+        except OSError as e:
+            if e.errno not in _retry:
+                self._loop.remove_reader(self._fd)
+            return
+        if chunk:
+            self.data += chunk
+        else:
+            self._loop.remove_reader(self._fd)
+
+    def close(self):
+        '''Read the remaining data and close the pipe. This is called after
+        the recipe process exited; children that it started may still keep
+        the pipe open, so it is not read until EOF.'''
+        if self._fd is None:
+            return
+        self._loop.remove_reader(self._fd)
+        self.data += drain(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
+async def _wait_pid(loop, pid, exited = None):
+    '''Wait for a child process without blocking, and return its wait
+    status and its resource usage.
+
+    :param exited: Function called after the process exited, but before it
+        is reaped (if :func:`os.waitid` is not available, before waiting).
+    '''
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pass
+    if pidfd is not None:
+        readable = loop.create_future()
+        loop.add_reader(pidfd,
+                        lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+    delay = 0.001
+    if pidfd is None and hasattr(os, 'waitid'):
+        while not _exited(pid):
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 0.1)
+    if exited is not None:
+        exited()
+    while True:
+        p, status, rusage = os.wait4(pid, os.WNOHANG)
+        if p != 0:
+            return status, rusage
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, 0.1)
+
+class _Periodic(object):
+    '''Call a function periodically in the event loop.'''
+
+    def __init__(self, loop, interval, func, now = True):
+        self._loop = loop
+        self._interval = interval
+        self._func = func
+        self._handle = None
+        if now:
+            self._call()
+        else:
+            self._handle = loop.call_later(interval, self._call)
+
+    def _call(self):
+        self._func()
+        self._handle = self._loop.call_later(self._interval, self._call)
+
+    def cancel(self):
+        self._handle.cancel()
+
+async def _acquire(loop, scheduler, n, memory):
+    '''Wait until the scheduler assigns n CPUs and the memory, without
+    blocking the event loop.'''
+    future = loop.create_future()
+    def assigned(cpus):
+        if future.cancelled():
+            scheduler.release(cpus, memory)
+        else:
+            future.set_result(cpus)
+    cpus, waiter = scheduler.acquire_callback(
+        n, lambda cpus: loop.call_soon_threadsafe(assigned, cpus), memory)
+    if cpus is not None:
+        return cpus
+    try:
+        return await future
+    except asyncio.CancelledError:
+        scheduler.cancel(waiter)
+        raise
+
+async def acall(recipe, data, ndata, parlist, calib_frames, runenv, staged):
+    '''Execute a recipe call in the running event loop and return its
+    :class:`cpl.Result`.
+
+    data and ndata are the positional and keyword parameters of the call,
+    the other arguments are the resolved configuration as returned by
+    :meth:`cpl.Recipe._configure`. If the task is cancelled, the recipe
+    process is killed.
+    '''
+    (runner, output_dir, parlist, framelist, runenv, input_len, logname,
+     loglevel, output_format, delete, staging, mtrace, scheduler, limits,
+     supervisor) = recipe._setup(data, ndata, parlist, calib_frames, runenv,
+                                 staged)
+    loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+    logger = None
+    cpus = None
+    try:
+        if scheduler is not None:
+            memory = scheduler.memory_demand(recipe, framelist)
+            cpus = await _acquire(loop, scheduler, scheduler.demand(runenv),
+                                  memory)
+        logger = AsyncLogReceiver(loop, logname, loglevel)
+        args = (output_dir, parlist, framelist, runenv, logger.logfile,
+                logger.level, recipe.memory_dump, mtrace, cpus) + limits
+        samples = None
+        if hasattr(runner, 'start'):
+            supervisor = supervisor or Supervisor(new_group = False)
+            pid, fd, base_rss = runner.start(
+                *(args + (int(supervisor.new_group), )))
+            supervisor.started(pid, logger)
+            sampler = timeline.Sampler(pid) if supervisor.sampling else None
+            periodic = list()
+            if sampler is not None:
+                periodic.append(_Periodic(loop, supervisor.sampling,
+                                          sampler.sample))
+            watchdog = supervisor.watchdog
+            if watchdog is not None:
+                periodic.append(_Periodic(
+                    loop, watchdog.interval,
+                    lambda: watchdog.check() and supervisor.kill(pid),
+                    now = False))
+            def exited():
+                # Unregister the process before it is reaped, so that a
+                # concurrent cancel cannot kill a recycled pid.
+                supervisor.finished()
+                for p in periodic:
+                    p.cancel()
+            reader = _ResultReader(loop, fd)
+            timed_out = False
+            try:
+                try:
+                    status, rusage = await asyncio.wait_for(
+                        _wait_pid(loop, pid, exited), supervisor.timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    supervisor.kill(pid)
+                    status, rusage = await _wait_pid(loop, pid, exited)
+            except BaseException:
+                supervisor.kill(pid)
+                try:
+                    # Reap the process even if this task is cancelled again.
+                    await asyncio.shield(_wait_pid(loop, pid, exited))
+                except (OSError, asyncio.CancelledError):
+                    pass
+                raise
+            finally:
+                exited()
+                reader.close()
+            try:
+                supervisor.check(status, timed_out, rusage, base_rss)
+            except (RecipeTimeout, RecipeKilled) as e:
+                logger.close()
+                e.log = logger.entries
+                raise
+            result = CPL_recipe.parse_result(bytes(reader.data),
+                                             *usage(rusage, base_rss))
+            if sampler is not None:
+                samples = sampler.timeline()
+        else:
+            result = await loop.run_in_executor(None, runner.run, *args)
+        if scheduler is not None:
+            scheduler.record(recipe, framelist, result[2])
+        logger.close()
+        return Result(output_dir, result, input_len, logger, output_format,
+                      samples, supervisor and supervisor.max_idle)
+    finally:
+        if logger is not None:
+            logger.close()
+        if cpus is not None:
+            scheduler.release(cpus, memory)
+        recipe._cleanup(output_dir, logger, delete, staging)
@@ -0,0 +1,20 @@
+'''Doc strings that are generated on first access.'''
+
+class DocString(object):
+    '''Descriptor for an instance doc string that is generated only when it
+    is accessed, f.e. by :func:`help()`.
+
+    Accessed on the class, the static class doc string is returned, so that
+    the class documentation is not affected.
+
+    :param classdoc: Doc string of the class.
+    :param func: Method that generates the doc string of an instance.
+    '''
+    def __init__(self, classdoc, func):
+        self.classdoc = classdoc
+        self.func = func
+
+    def __get__(self, obj, cls = None):
+        if obj is None:
+            return self.classdoc
+        return self.func(obj)
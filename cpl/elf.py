@@ -0,0 +1,79 @@
+'''Minimal reader for the dynamic symbol table of ELF shared libraries.
+
+This is used to check whether a shared library exports a certain symbol
+without loading it with :func:`dlopen`, which would run the constructors of
+the library and of all its dependencies.
+'''
+import struct
+
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+
+def exports(filename, symbol):
+    '''Check whether an ELF shared library exports a symbol.
+
+    :param filename: Shared library file name.
+    :type filename: :class:`str`
+    :param symbol: Symbol name
+    :type symbol: :class:`str`
+    :return: :obj:`True` if the library defines the symbol in its dynamic
+        symbol table, :obj:`False` if it does not, and :obj:`None` if the
+        file is not an ELF file or cannot be parsed.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            return _exports(f, symbol.encode())
+    except (IOError, OSError, struct.error, ValueError):
+        return None
+
+def _exports(f, symbol):
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != b'\x7fELF':
+        return None
+    elfclass = ident[4:5]
+    endian = { b'\x01':'<', b'\x02':'>' }.get(ident[5:6])
+    if endian is None or elfclass not in (b'\x01', b'\x02'):
+        return None
+    is64 = elfclass == b'\x02'
+    if is64:
+        ehdr = struct.unpack(endian + 'HHIQQQIHHHHHH', f.read(48))
+        shdr_fmt = endian + 'IIQQQQIIQQ'
+        sym_fmt = endian + 'IBBHQQ'
+    else:
+        ehdr = struct.unpack(endian + 'HHIIIIIHHHHHH', f.read(36))
+        shdr_fmt = endian + 'IIIIIIIIII'
+        sym_fmt = endian + 'IIIBBH'
+    shoff, shentsize, shnum = ehdr[5], ehdr[10], ehdr[11]
+    if shoff == 0 or shnum == 0:
+        return None
+    f.seek(shoff)
+    table = f.read(shentsize * shnum)
+    sections = [ struct.unpack_from(shdr_fmt, table, i * shentsize)
+                 for i in range(shnum) ]
+    dynsym = [ s for s in sections if s[1] == SHT_DYNSYM ]
+    if not dynsym:
+        return False
+    # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link,
+    # sh_info, sh_addralign, sh_entsize
+    dynsym = dynsym[0]
+    strtab = sections[dynsym[6]]
+    f.seek(strtab[4])
+    strings = f.read(strtab[5])
+    if symbol + b'\0' not in strings:
+        return False
+    f.seek(dynsym[4])
+    symbols = f.read(dynsym[5])
+    entsize = dynsym[9] or struct.calcsize(sym_fmt)
+    for i in range(0, len(symbols) - entsize + 1, entsize):
+        sym = struct.unpack_from(sym_fmt, symbols, i)
+        if is64:
+            st_name, st_info, st_shndx = sym[0], sym[1], sym[3]
+        else:
+            st_name, st_info, st_shndx = sym[0], sym[3], sym[5]
+        if strings[st_name:st_name + len(symbol) + 1] != symbol + b'\0':
+            continue
+        if st_shndx != SHN_UNDEF and (st_info >> 4) in (STB_GLOBAL, STB_WEAK):
+            return True
+    return False
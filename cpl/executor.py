@@ -0,0 +1,157 @@
+'''Executor for recipe calls in background threads.
+
+:class:`RecipeExecutor` implements the :class:`concurrent.futures.Executor`
+interface with a fixed number of worker threads and an optionally bounded
+queue of pending calls. Recipe calls with ``threaded = True`` are executed by the
+default executor returned by :func:`default_executor()`.
+'''
+from __future__ import absolute_import
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import Executor, Future, as_completed, wait
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class RecipeExecutor(Executor):
+    '''Executor that runs recipe calls in a pool of threads.
+
+    :param max_workers: Maximal number of calls executed in parallel.
+        Defaults to the number of CPUs.
+    :type max_workers: :class:`int`
+    :param max_queue: Maximal number of pending calls. If the queue is
+        full, :meth:`submit()` blocks until a call was started. Defaults to
+        an unbounded queue.
+    :type max_queue: :class:`int`
+
+    Since a :class:`cpl.Recipe` is callable, it can be submitted directly;
+    the returned :class:`concurrent.futures.Future` resolves to the
+    :class:`cpl.Result`::
+
+      >>> with cpl.RecipeExecutor(max_workers = 8) as executor:
+      ...     futures = [ executor.submit(muse_focus, f) for f in files ]
+      ...     for future in cpl.executor.as_completed(futures):
+      ...         res = future.result()
+
+    :meth:`map()`, :func:`as_completed()` and :func:`wait()` work as for
+    the other executors in :mod:`concurrent.futures`.
+    '''
+
+    def __init__(self, max_workers = None, max_queue = None):
+        self._max_workers = max_workers or multiprocessing.cpu_count()
+        self._queue = queue.Queue(max_queue or 0)
+        self._threads = list()
+        self._running = 0
+        self._cond = threading.Condition()
+        self._shutdown = False
+
+    @property
+    def max_workers(self):
+        '''Maximal number of calls executed in parallel.'''
+        return self._max_workers
+
+    def resize(self, max_workers):
+        '''Change the maximal number of calls executed in parallel.
+
+        Calls that are already running are not affected; new calls are
+        started only when less than `max_workers` calls are running.
+        '''
+        with self._cond:
+            self._max_workers = max_workers
+            self._cond.notify_all()
+            self._adjust_threads()
+
+    def submit(self, fn, *args, **kwargs):
+        '''Schedule the call ``fn(*args, **kwargs)``.
+
+        :return: The future of the call.
+        :rtype: :class:`concurrent.futures.Future`
+        '''
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new calls after shutdown')
+            self._adjust_threads()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _adjust_threads(self):
+        self._threads = [ t for t in self._threads if t.is_alive() ]
+        while len(self._threads) < self._max_workers:
+            thread = threading.Thread(target = self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            # The call stays pending, and can be cancelled, until a slot is
+            # free.
+            with self._cond:
+                while self._running >= self._max_workers:
+                    self._cond.wait()
+                self._running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args, **kwargs)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify()
+            del item, future, fn, args, kwargs
+
+    def shutdown(self, wait = True, cancel_futures = False):
+        '''Stop the executor after all pending calls are finished.
+
+        :param wait: Wait until all calls are finished.
+        :type wait: :class:`bool`
+        :param cancel_futures: Cancel all calls that were not yet started.
+        :type cancel_futures: :class:`bool`
+        '''
+        with self._cond:
+            if self._shutdown:
+                threads = list()
+            else:
+                self._shutdown = True
+                threads = list(self._threads)
+        if cancel_futures:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[0].cancel()
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+_default = None
+_default_lock = threading.Lock()
+
+def default_executor():
+    '''Return the executor for recipe calls with ``threaded = True``.
+
+    It is created on first use with the default number of workers and an
+    unbounded queue, so that a threaded recipe call always returns
+    immediately. Pending calls are finished when the interpreter exits.
+    '''
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = RecipeExecutor()
+            atexit.register(_default.shutdown)
+        return _default
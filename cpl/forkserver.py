@@ -0,0 +1,397 @@
+'''Fork server and worker pool for recipe executions.
+
+Normally, each recipe call forks the calling Python process. If this process
+holds large amounts of memory (f.e. many :class:`astropy.io.fits.HDUList`
+objects), the fork needs to copy large page tables, and the copy-on-write
+faults in the child are expensive.
+
+A fork server is a small separate Python interpreter ("zygote") that has
+only the recipe plugins loaded. It forks the recipe processes itself, so that
+the launch latency and the memory spikes do not depend on the size of the
+controlling process. The recipe calls are sent to the zygote via a Unix
+socket; each call uses its own connection and is handled in its own thread,
+so that calls may run in parallel.
+
+A worker pool consists of several zygotes that keep their recipe plugins
+loaded and initialized. This reduces the overhead of short recipe calls.
+
+The zygotes terminate when the controlling process closes them or exits.
+'''
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_header = struct.Struct('!Q')
+
+# Running the module with "-m" would import it a second time, since the
+# package imports it already.
+_bootstrap = 'import sys; from cpl.forkserver import main; ' \
+    'sys.exit(main(*sys.argv[1:3]))'
+
+_exceptions = {
+    'IOError': IOError,
+    'OSError': OSError,
+    'TypeError': TypeError,
+    'ValueError': ValueError,
+    'KeyError': KeyError,
+}
+
+def _send(conn, obj):
+    data = json.dumps(obj).encode()
+    conn.sendall(_header.pack(len(data)) + data)
+
+def _recvall(conn, n):
+    chunks = list()
+    while n > 0:
+        chunk = conn.recv(min(n, 1 << 20))
+        if not chunk:
+            raise IOError('Connection to the fork server closed')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+def _native(obj):
+    # JSON strings are decoded as unicode on Python 2, but the recipe
+    # interface accepts only str there.
+    if isinstance(obj, list):
+        return [ _native(o) for o in obj ]
+    elif isinstance(obj, dict):
+        return dict((_native(k), _native(v)) for k, v in obj.items())
+    elif not isinstance(obj, str) and isinstance(obj, type(u'')):
+        return obj.encode('utf-8')
+    else:
+        return obj
+
+def _recv(conn):
+    n = _header.unpack(_recvall(conn, _header.size))[0]
+    return _native(json.loads(_recvall(conn, n).decode()))
+
+class Zygote(object):
+    '''Zygote process that executes recipe calls.
+
+    :param recipes: (filename, name) pairs of the recipes that are loaded
+        when the zygote is started. Other recipes are loaded on their first
+        call.
+    :type recipes: :class:`list` of :class:`tuple`
+    :param env: Additional environment variables for the zygote (optional).
+    :type env: :class:`dict`
+    :param wait: Wait until the zygote is ready. If :obj:`False`, the
+        zygote is started in the background, and :meth:`wait()` has to be
+        called before it is used.
+    :type wait: :class:`bool`
+    '''
+
+    def __init__(self, recipes = (), env = None, wait = True):
+        self.recipes = [ (os.path.abspath(f), n) for f, n in recipes ]
+        self._dir = tempfile.mkdtemp(prefix = 'cpl-forkserver-')
+        self.address = os.path.join(self._dir, 'socket')
+        self._ready = False
+        runenv = dict(os.environ)
+        runenv.update(env or dict())
+        pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        runenv['PYTHONPATH'] = os.pathsep.join(
+            [ pkgdir ] + [ p for p in [ runenv.get('PYTHONPATH') ] if p ])
+        try:
+            self._process = subprocess.Popen(
+                [ sys.executable, '-c', _bootstrap, self.address,
+                  json.dumps(self.recipes) ],
+                stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                env = runenv, cwd = '/')
+        except:
+            shutil.rmtree(self._dir, ignore_errors = True)
+            raise
+        if wait:
+            self.wait()
+
+    def wait(self):
+        '''Wait until the zygote has loaded its recipes and is ready.
+
+        :raise: :exc:`IOError` if the zygote could not be started.
+        '''
+        if self._ready:
+            return
+        ready = self._process.stdout.readline()
+        if ready.strip() != b'ready':
+            self.close()
+            raise IOError('Cannot start fork server for %s: %s'
+                          % (self.recipes, ready.decode().strip()))
+        self._ready = True
+
+    @property
+    def pid(self):
+        '''Process id of the zygote.'''
+        return self._process.pid
+
+    def alive(self):
+        '''Return :obj:`True` if the zygote is running.'''
+        return self._process.poll() is None
+
+    def execute(self, filename, name, dirname, parlist, framelist, runenv,
+                logfile, loglevel, memory_dump, mtrace, cpus = None,
+                max_memory = -1, max_cpu_time = -1):
+        '''Execute a recipe in a process forked from the zygote.
+
+        The recipe is specified by its shared library file name and name.
+        The other arguments and the return value are the same as for
+        :meth:`CPL_recipe.recipe.run()`. The call blocks until the recipe is
+        finished.
+        '''
+        self.wait()
+        request = [ [ os.path.abspath(filename), name ],
+                    [ os.path.abspath(dirname), [ list(p) for p in parlist ],
+                      [ list(f) for f in framelist ],
+                      [ list(e) for e in runenv ],
+                      logfile, loglevel, memory_dump, mtrace,
+                      None if cpus is None else list(cpus),
+                      max_memory, max_cpu_time ] ]
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                conn.connect(self.address)
+            except socket.error as e:
+                raise IOError('Fork server for %s not reachable: %s'
+                              % (name, e))
+            _send(conn, request)
+            reply = _recv(conn)
+        finally:
+            conn.close()
+        if 'error' in reply:
+            exc, msg = reply['error']
+            raise _exceptions.get(exc, RuntimeError)(msg)
+        frames, errors, stats = reply['result']
+        return ([ tuple(f) for f in frames ], [ tuple(e) for e in errors ],
+                tuple(stats))
+
+    def close(self):
+        '''Stop the zygote. Running recipe calls are finished.'''
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+        self._process.stdout.close()
+        shutil.rmtree(self._dir, ignore_errors = True)
+
+    def __del__(self):
+        if getattr(self, '_process', None) is not None:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return 'Zygote(%s, pid = %i)' % (repr(self.recipes), self.pid)
+
+class ForkServer(Zygote):
+    '''Zygote process that executes the recipe calls of one plugin.
+
+    :param filename: Shared library file name.
+    :type filename: :class:`str`
+    :param name: Recipe name.
+    :type name: :class:`str`
+    :param env: Additional environment variables for the zygote (optional).
+    :type env: :class:`dict`
+
+    The zygote is started immediately. Its :meth:`run()` method has the
+    same signature and return value as the :meth:`run()` method of the raw
+    :class:`CPL_recipe.recipe`, so it can be used as a replacement for it.
+    '''
+
+    def __init__(self, filename, name, env = None):
+        Zygote.__init__(self, [ (filename, name) ], env)
+        self.filename, self.name = self.recipes[0]
+
+    def run(self, *args):
+        '''Execute the recipe in a process forked from the zygote.
+
+        The arguments are the same as for :meth:`CPL_recipe.recipe.run()`.
+        The call blocks until the recipe is finished.
+        '''
+        return self.execute(self.filename, self.name, *args)
+
+    def __repr__(self):
+        return 'ForkServer(%s, %s, pid = %i)' % (repr(self.filename),
+                                                 repr(self.name), self.pid)
+
+class WorkerPool(object):
+    '''Pool of long-lived worker processes that execute recipe calls.
+
+    :param processes: Number of worker processes. Defaults to the number of
+        CPUs.
+    :type processes: :class:`int`
+    :param recipes: Recipes that are loaded and initialized when the workers
+        are started, as :class:`cpl.Recipe` objects or as (filename, name)
+        pairs. Other recipes are loaded by a worker on their first call.
+    :type recipes: :class:`list`
+    :param env: Additional environment variables for the workers (optional).
+        The :attr:`cpl.Recipe.memory_mode` is always passed to the workers.
+    :type env: :class:`dict`
+
+    Each worker is a :class:`Zygote` that keeps the recipe plugins loaded,
+    and each call runs in a fresh process forked from the worker, so that a
+    crashing recipe does not affect the worker. A worker executes one call
+    at a time; further calls wait in a queue until a worker is free. A
+    worker that died is replaced by a new one.
+
+    The pool is used by setting it as :attr:`cpl.Recipe.pool` attribute or
+    as `pool` parameter of the recipe call::
+
+      >>> pool = cpl.forkserver.WorkerPool(8, [ muse_focus ])
+      >>> muse_focus.pool = pool
+      >>> muse_focus.threaded = True
+      >>> results = [ muse_focus(f) for f in files ]
+    '''
+
+    def __init__(self, processes = None, recipes = (), env = None):
+        import multiprocessing
+        self.processes = processes or multiprocessing.cpu_count()
+        self.recipes = [ (r.__file__, r.__name__) if hasattr(r, '__file__')
+                         else tuple(r) for r in recipes ]
+        from .recipe import Recipe
+        self.env = { 'CPL_MEMORY_MODE': str(Recipe.memory_mode) }
+        self.env.update(env or dict())
+        self._idle = queue.Queue()
+        self._workers = list()
+        self._lock = threading.Lock()
+        try:
+            for i in range(self.processes):
+                self._workers.append(Zygote(self.recipes, self.env,
+                                            wait = False))
+            for worker in self._workers:
+                worker.wait()
+        except:
+            self.close()
+            raise
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def execute(self, filename, name, *args):
+        '''Execute a recipe on the next free worker.
+
+        The recipe is specified by its shared library file name and name.
+        The other arguments and the return value are the same as for
+        :meth:`CPL_recipe.recipe.run()`.
+        '''
+        worker = self._idle.get()
+        try:
+            if not worker.alive():
+                worker = self._replace(worker)
+            return worker.execute(filename, name, *args)
+        finally:
+            self._idle.put(worker)
+
+    def _replace(self, worker):
+        with self._lock:
+            if self._workers is None:
+                raise ValueError('Call of a closed worker pool')
+            new_worker = Zygote(self.recipes, self.env)
+            self._workers[self._workers.index(worker)] = new_worker
+            return new_worker
+
+    def runner(self, filename, name):
+        '''Return an object whose :meth:`run()` method executes the recipe
+        in the pool, with the same signature as
+        :meth:`CPL_recipe.recipe.run()`.
+        '''
+        return _PoolRunner(self, filename, name)
+
+    def close(self):
+        '''Stop all workers. Running recipe calls are finished.'''
+        with self._lock:
+            workers, self._workers = self._workers or [], None
+        for worker in workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return 'WorkerPool(%i, %s)' % (self.processes, repr(self.recipes))
+
+class _PoolRunner(object):
+    def __init__(self, pool, filename, name):
+        self.pool = pool
+        self.filename = filename
+        self.name = name
+
+    def run(self, *args):
+        return self.pool.execute(self.filename, self.name, *args)
+
+def _serve(recipes, lock, conn):
+    from . import CPL_recipe
+    try:
+        (filename, name), args = _recv(conn)
+        try:
+            with lock:
+                recipe = recipes.get((filename, name))
+                if recipe is None:
+                    recipe = CPL_recipe.recipe(filename, name)
+                    recipes[(filename, name)] = recipe
+            reply = { 'result': recipe.run(*args) }
+        except Exception as e:
+            reply = { 'error': [ e.__class__.__name__, str(e) ] }
+        _send(conn, reply)
+    except (IOError, OSError, socket.error):
+        pass
+    finally:
+        conn.close()
+
+def _watch_parent(server):
+    # The controlling process closes stdin when it closes the server or
+    # exits. Shutting down the server socket stops the accept loop; the
+    # running calls are finished before the interpreter exits.
+    while os.read(0, 4096):
+        pass
+    server.shutdown(socket.SHUT_RDWR)
+
+def main(address, preload):
+    from . import CPL_recipe
+    recipes = dict()
+    lock = threading.Lock()
+    try:
+        for filename, name in _native(json.loads(preload)):
+            recipes[(filename, name)] = CPL_recipe.recipe(filename, name)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+        server.listen(128)
+    except Exception as e:
+        sys.stdout.write('%s\n' % e)
+        sys.stdout.flush()
+        return 1
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    # The controlling process does not read the pipe anymore. The recipe
+    # processes inherit stdout, so they would block once the pipe is full.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    watcher = threading.Thread(target = _watch_parent, args = (server, ))
+    watcher.daemon = True
+    watcher.start()
+    while True:
+        try:
+            conn = server.accept()[0]
+        except socket.error:
+            break
+        threading.Thread(target = _serve,
+                         args = (recipes, lock, conn)).start()
+    server.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:3]))
@@ -1,8 +1,69 @@
 from __future__ import absolute_import
+import collections
 import os
-from astropy.io import fits
+import sys
 
 from . import md5sum
+from .staging import data_layout, original_file, write_hdulist
+from .docstring import DocString
+
+RawConfig = collections.namedtuple('RawConfig', 'min max inputs outputs')
+'''Frame configuration for one raw input tag, as provided by the recipe.
+
+.. attribute:: min
+
+   Minimal number of raw frames, or :obj:`None` if not specified.
+
+.. attribute:: max
+
+   Maximal number of raw frames, or :obj:`None` if not specified.
+
+.. attribute:: inputs
+
+   Tuple of (tag, min, max) triples for the calibration frames.
+
+.. attribute:: outputs
+
+   Tuple of output tags.
+'''
+
+def read_frameconfig(cpl_frameconfigs):
+    '''Convert the frame configuration of a recipe plugin.
+
+    :param cpl_frameconfigs: Frame configuration as returned by the
+        ``frameConfig()`` method of the raw recipe, or :obj:`None`.
+
+    Returns a triple (tags, config, calib) of the raw tags in their original
+    order, a :class:`dict` mapping the raw tags to :class:`RawConfig` and a
+    tuple of (tag, min, max) triples of all calibration tags, with the ranges
+    merged over all raw tags. Unset values are converted to :obj:`None`. If
+    the recipe does not provide the information, all three are :obj:`None`.
+    '''
+    if cpl_frameconfigs is None:
+        return None, None, None
+    def _n(i):
+        return i if i > 0 else None
+    tags = list()
+    config = dict()
+    calib = collections.OrderedDict()
+    for raw, inputs, outputs in cpl_frameconfigs:
+        tags.append(raw[0])
+        config[raw[0]] = RawConfig(_n(raw[1]), _n(raw[2]),
+                                   tuple((f[0], _n(f[1]), _n(f[2]))
+                                         for f in inputs),
+                                   tuple(outputs))
+        for tag, min_frames, max_frames in config[raw[0]].inputs:
+            if tag not in calib:
+                calib[tag] = (min_frames, max_frames)
+            else:
+                c = calib[tag]
+                calib[tag] = (
+                    min(c[0], min_frames) if None not in (c[0], min_frames)
+                    else None,
+                    max(c[1], max_frames) if None not in (c[1], max_frames)
+                    else None)
+    return (tuple(tags), config,
+            tuple((tag, c[0], c[1]) for tag, c in calib.items()))
 
 class FrameConfig(object):
     '''Frame configuration. 
@@ -37,12 +98,13 @@ class FrameConfig(object):
        List of frames (file names or :class:`astropy.io.fits.HDUList` objects)
        that are assigned to this frame type.
     '''
+    __slots__ = ('tag', 'min', 'max', 'frames')
+
     def __init__(self, tag, min_frames = 0, max_frames = 0, frames = None):
         self.tag = tag
-        self.min = min_frames if min_frames > 0 else None
-        self.max = max_frames if max_frames > 0 else None
+        self.min = min_frames if min_frames and min_frames > 0 else None
+        self.max = max_frames if max_frames and max_frames > 0 else None
         self.frames = frames
-        self.__doc__ = self._doc()
 
     def extend_range(self, min_frames, max_frames):
         if self.min is not None:
@@ -81,12 +143,20 @@ class FrameConfig(object):
 
     def __getitem__(self, i):
         return (self.tag, self.frames)[i]
+
+    __doc__ = DocString(__doc__, _doc)
     
 
 class FrameList(object):
     def __init__(self, recipe, other = None):
         self._recipe = recipe
         self._values = dict()
+        self._docstring = None
+        calib = recipe._plugin.calib
+        self._fixed = calib is not None
+        if calib:
+            for tag, min_frames, max_frames in calib:
+                self._values[tag] = FrameConfig(tag, min_frames, max_frames)
         if isinstance(other, self.__class__):
             self._set_items((o.tag, o.frames) for o in other)
         elif isinstance(other, dict):
@@ -98,28 +168,9 @@ class FrameList(object):
         for o in l:
             self[o[0]] = o[1]
 
-    @property
-    def _cpl_dict(self):
-        cpl_frameconfigs = self._recipe._recipe.frameConfig()
-        if cpl_frameconfigs is None:
-            return None
-        s = dict()
-        for configs in cpl_frameconfigs:
-            c_cfg = configs[1]
-            for f in c_cfg:
-                if f[0] in s:
-                    s[f[0]].extend_range(f[1], f[2])
-                elif f[0] in self._values:
-                    s[f[0]] = self._values[f[0]]
-                    s[f[0]].set_range(f[1], f[2])
-                else:
-                    s[f[0]] = FrameConfig(f[0], f[1], f[2])
-                    self._values[f[0]] = s[f[0]]
-        return s
-
     @property
     def _dict(self):
-        return self._cpl_dict or self._values
+        return self._values
 
     def __iter__(self):
         return iter(self._dict.values())
@@ -128,9 +179,8 @@ class FrameList(object):
         return self._dict[key]
 
     def __setitem__(self, key, value):
-        d = self._cpl_dict
-        if d is not None:
-            d[key].frames = value
+        if self._fixed:
+            self._values[key].frames = value
         else:
             self._values.setdefault(key, FrameConfig(key)).frames = value
 
@@ -167,25 +217,42 @@ class FrameList(object):
     def __eq__(self, other):
         return dict(iter(self)) == other
 
-    @property
-    def __doc__(self):
+    def _doc(self):
+        if self._fixed and self._docstring is not None:
+            return self._docstring
         r = 'Frames for recipe %s.\n\nAttributes:\n' % (
-            self._recipe.name)
+            self._recipe.__name__)
         for s in self:
-            r += '%s: %s\n' % (self._key(s), s.__doc__)
+            r += '%s: %s\n' % (s.tag, s.__doc__)
+        self._docstring = r
         return r        
 
+    __doc__ = DocString(None, _doc)
+
     def _aslist(self, frames):
         flist = FrameList(self._recipe, self)
         if frames is not None:
             flist._set_items(frames.items())
         return [(f.tag, f.frames) for f in flist]
 
-def mkabspath(frames, tmpdir):
+def is_hdulist(obj):
+    '''Check whether an object is a :class:`astropy.io.fits.HDUList`.
+
+    This does not import :mod:`astropy.io.fits`: if it is not imported yet,
+    there cannot be any HDU lists.
+    '''
+    fits = sys.modules.get('astropy.io.fits')
+    return fits is not None and isinstance(obj, fits.HDUList)
+
+def mkabspath(frames, tmpdir, staging = None):
     '''Convert all filenames in the frames list into absolute paths.
 
     :class:`astropy.io.fits.HDUList`s will be converted to temporary files
-    located in the temporary directory tmpdir.
+    located in the temporary directory tmpdir, or staged in memory if
+    staging is given. HDU lists that were opened from a file and not
+    changed are replaced by the name of that file, if its primary header
+    already contains the ``DATAMD5`` keyword. Otherwise the keyword is set
+    and the HDU list is written like a changed one.
 
     The replacement is done in-place. The function will return the list of
     temporary files.
@@ -194,12 +261,36 @@ def mkabspath(frames, tmpdir):
                   a file name or a HDU list.
 
     param tmpdir: directory where the temporary files are being created.
+
+    param staging: :class:`cpl.staging.MemoryStaging` for the HDU lists.
     '''
     
     tmpfiles = list()
+    hdulists = dict((id(f), f) for tag, f in frames if is_hdulist(f))
+    paths = dict((key, original_file(f)) for key, f in hdulists.items()
+                 if 'DATAMD5' in f[0].header)
+    for key, path in list(paths.items()):
+        if path is None:
+            del paths[key]
+        else:
+            del hdulists[key]
+    # HDU lists with unchanged data units are hashed from the file, unless
+    # the data is scaled
+    layouts = dict((key, data_layout(f)) for key, f in hdulists.items())
+    md5s = dict(zip(hdulists, md5sum.datamd5_all(
+        layouts[key] if layouts[key] and not md5sum.scaled(f) else f
+        for key, f in hdulists.items())))
     for i, frame in enumerate(frames):
-        if isinstance(frame[1], fits.HDUList):
-            md5 = md5sum.update_md5(frame[1])
+        if id(frame[1]) in paths:
+            frames[i] = ( frame[0], paths[id(frame[1])] )
+        elif is_hdulist(frame[1]):
+            md5 = md5sum.update_md5(frame[1], md5s[id(frame[1])])
+            if staging is not None:
+                filename = staging.stage(frame[1], '%s_%s.fits'
+                                         % (frame[0], md5[:8]))
+                frames[i] = ( frame[0], filename )
+                tmpfiles.append(filename)
+                continue
             filename = os.path.abspath(os.path.join(tmpdir, '%s_%s.fits' 
                                                     % (frame[0], md5[:8])))
             try:
@@ -208,7 +299,8 @@ def mkabspath(frames, tmpdir):
                 pass
             frames[i] = ( frame[0], filename )
             tmpfiles.append(filename)
-            frame[1].writeto(filename)
+            with open(filename, 'wb') as f:
+                write_hdulist(frame[1], f, layouts[id(frame[1])])
         else:
             frames[i] = ( frame[0], os.path.abspath(frame[1]) )
     return tmpfiles
@@ -219,7 +311,7 @@ def expandframelist(frames):
     '''
     framelist = list()
     for tag, f in frames:
-        if isinstance(f, list) and not isinstance(f, fits.HDUList):
+        if isinstance(f, list) and not is_hdulist(f):
             framelist += [ (tag, frame) for frame in f ]
         elif f is not None:
             framelist.append((tag, f))
@@ -0,0 +1,150 @@
+'''Persistent history of the resource usage of recipe calls.
+
+The peak memory of a recipe call depends mainly on the recipe, its version
+and the size of the input files. The history stores the peak resident set
+size of each call in a small SQLite database, so that the memory demand of
+a new call can be predicted before it is started (see
+:class:`cpl.scheduler.Scheduler`).
+'''
+from __future__ import absolute_import
+import logging
+import os
+import sqlite3
+
+def default_filename():
+    '''Default location of the history: :file:`python-cpl/history.db` in
+    the user cache directory (:envvar:`XDG_CACHE_HOME`, or
+    :file:`~/.cache`).
+    '''
+    cachedir = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'python-cpl', 'history.db')
+
+def input_size(framelist):
+    '''Return the total size in bytes of the files in a list of (tag, file
+    name) pairs. Files that do not exist are not counted.
+    '''
+    size = 0
+    for tag, f in framelist:
+        try:
+            size += os.path.getsize(f)
+        except (OSError, TypeError):
+            pass
+    return size
+
+class RunHistory(object):
+    '''On-disk history of the peak memory of recipe calls.
+
+    :param filename: File name of the SQLite database. Defaults to
+        :func:`default_filename()`.
+    :type filename: :class:`str`
+
+    Each call is recorded with the recipe name, the recipe version and the
+    total size of its input files. If the database cannot be created or
+    written, nothing is recorded and no predictions are made.
+    '''
+
+    schema_version = 2
+
+    max_records = 100
+    '''Maximal number of calls kept per recipe and version.'''
+
+    def __init__(self, filename = None):
+        self.filename = filename or default_filename()
+
+    def _connect(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.filename, timeout = 30)
+        if conn.execute('PRAGMA user_version').fetchone()[0] \
+                != self.schema_version:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS runs')
+                conn.execute('CREATE TABLE runs ('
+                             'recipe TEXT, version INTEGER, '
+                             'input_size INTEGER, max_rss INTEGER)')
+                conn.execute('CREATE INDEX runs_recipe '
+                             'ON runs (recipe, version, input_size)')
+                conn.execute('PRAGMA user_version = %i'
+                             % self.schema_version)
+        return conn
+
+    def record(self, recipe, version, input_size, max_rss):
+        '''Record the peak resident set size of a recipe call.
+
+        :param recipe: Recipe name.
+        :type recipe: :class:`str`
+        :param version: Recipe version number.
+        :type version: :class:`int`
+        :param input_size: Total size of the input files in bytes.
+        :type input_size: :class:`int`
+        :param max_rss: Peak resident set size in bytes, without the pages
+            inherited from the forking process (see
+            :attr:`cpl.Result.stat.max_rss`).
+        :type max_rss: :class:`int`
+        '''
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('INSERT INTO runs VALUES (?, ?, ?, ?)',
+                                 (recipe, version, input_size, max_rss))
+                    conn.execute(
+                        'DELETE FROM runs WHERE recipe = ? AND version = ? '
+                        'AND rowid NOT IN (SELECT rowid FROM runs '
+                        'WHERE recipe = ? AND version = ? '
+                        'ORDER BY rowid DESC LIMIT ?)',
+                        (recipe, version, recipe, version, self.max_records))
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError, IOError) as e:
+            logging.getLogger('cpl').debug('Cannot update run history %s: %s',
+                                           self.filename, e)
+
+    def predict(self, recipe, version, input_size):
+        '''Predict the peak resident set size of a recipe call in bytes.
+
+        The prediction is the largest peak of the recorded calls with the
+        smallest input size that is not smaller than `input_size`. If all
+        recorded inputs were smaller, the largest peak is scaled up
+        linearly with the input size.
+
+        :return: The predicted peak in bytes, or :obj:`None` if no call of
+            the recipe version was recorded.
+        '''
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    'SELECT input_size, MAX(max_rss) FROM runs '
+                    'WHERE recipe = ? AND version = ? AND input_size >= ? '
+                    'GROUP BY input_size ORDER BY input_size LIMIT 1',
+                    (recipe, version, input_size)).fetchone()
+                if row is not None:
+                    return row[1]
+                row = conn.execute(
+                    'SELECT input_size, max_rss FROM runs '
+                    'WHERE recipe = ? AND version = ? '
+                    'ORDER BY max_rss DESC LIMIT 1',
+                    (recipe, version)).fetchone()
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError, IOError) as e:
+            logging.getLogger('cpl').debug('Run history %s not usable: %s',
+                                           self.filename, e)
+            return None
+        if row is None:
+            return None
+        size, max_rss = row
+        return max_rss * input_size // size if size > 0 else max_rss
+
+    def clear(self):
+        '''Remove all entries from the history.'''
+        if os.path.exists(self.filename):
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('DELETE FROM runs')
+            finally:
+                conn.close()
@@ -0,0 +1,312 @@
+'''Persistent index of the recipes contained in the shared libraries.
+
+Listing the recipes of a shared library requires to load it and to
+initialize all its plugins, which takes a considerable amount of time for a
+full pipeline installation. The index stores the result of this scan on disk,
+together with the modification time, size and inode of the library. On
+lookup, only libraries that changed since the last scan are loaded again.
+
+Libraries may also be scanned in a pool of worker processes (:func:`scan`),
+so that a broken plugin crashes only its worker, not the interpreter.
+
+ELF libraries that do not export ``cpl_plugin_get_info`` are skipped without
+loading them.
+'''
+from __future__ import absolute_import
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import sqlite3
+import time
+
+from . import CPL_recipe
+from . import elf
+
+def default_filename():
+    '''Default location of the index: :file:`python-cpl/recipes.db` in the
+    user cache directory (:envvar:`XDG_CACHE_HOME`, or :file:`~/.cache`).
+    '''
+    cachedir = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'python-cpl', 'recipes.db')
+
+def list_recipes(filename):
+    '''List the recipes of a shared library.
+
+    Returns a list of (name, version, version string) tuples, or
+    :obj:`None` if the library does not contain CPL recipes. ELF libraries
+    that do not export ``cpl_plugin_get_info`` are rejected without loading
+    them.
+    '''
+    if elf.exports(filename, 'cpl_plugin_get_info') is False:
+        return None
+    return CPL_recipe.list(filename)
+
+def scan(libs, processes = None, timeout = 60):
+    '''Scan shared libraries for recipes in separate worker processes.
+
+    :param libs: Shared library file names.
+    :type libs: :class:`list` of :class:`str`
+    :param processes: Maximal number of libraries scanned in parallel.
+        Defaults to the number of CPUs.
+    :type processes: :class:`int`
+    :param timeout: Time in seconds after which the scan of a library is
+        killed, or :obj:`None` to wait forever.
+    :type timeout: :class:`float`
+
+    Each library is loaded in its own forked process. The results are
+    returned as soon as a library is finished, as (library, recipes, status)
+    triples, where recipes is the list of (name, version, version string)
+    tuples, or :obj:`None` if the library does not contain CPL recipes. If
+    the worker crashed or was killed after the timeout, recipes is
+    :obj:`None` and status is the non-zero wait status of the worker;
+    otherwise status is 0.
+    '''
+    if not processes:
+        import multiprocessing
+        processes = multiprocessing.cpu_count()
+    pending = list(reversed(libs))
+    running = dict()
+    try:
+        while pending or running:
+            while pending and len(running) < processes:
+                f = pending.pop()
+                if elf.exports(f, 'cpl_plugin_get_info') is False:
+                    yield f, None, 0
+                    continue
+                rfd, wfd = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        os.close(rfd)
+                        data = json.dumps(CPL_recipe.list(f)).encode()
+                        while data:
+                            data = data[os.write(wfd, data):]
+                        status = 0
+                    finally:
+                        os._exit(status)
+                os.close(wfd)
+                deadline = time.time() + timeout if timeout else None
+                running[rfd] = (pid, f, [], deadline)
+            if not running:
+                continue
+            deadlines = [ r[3] for r in running.values() if r[3] is not None ]
+            wait = max(0, min(deadlines) - time.time()) if deadlines else None
+            try:
+                ready = select.select(list(running), [], [], wait)[0]
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            for fd in list(running):
+                if fd in ready:
+                    chunk = os.read(fd, 65536)
+                    if chunk:
+                        running[fd][2].append(chunk)
+                        continue
+                    timed_out = False
+                elif running[fd][3] is not None and now >= running[fd][3]:
+                    os.kill(running[fd][0], signal.SIGKILL)
+                    timed_out = True
+                else:
+                    continue
+                os.close(fd)
+                pid, f, chunks, deadline = running.pop(fd)
+                status = os.waitpid(pid, 0)[1]
+                if status == 0 and chunks:
+                    plugins = json.loads(b''.join(chunks).decode())
+                    yield f, [ tuple(p) for p in plugins ] \
+                        if plugins is not None else None, 0
+                elif timed_out:
+                    logging.getLogger('cpl').warning(
+                        'Scanning %s timed out after %s s', f, timeout)
+                    yield f, None, status
+                else:
+                    logging.getLogger('cpl').warning(
+                        'Scanning %s crashed (status %i)', f, status or -1)
+                    yield f, None, status or -1
+    finally:
+        for fd, (pid, f, chunks, deadline) in running.items():
+            os.close(fd)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+
+def in_order(libs, results):
+    '''Return the results of :func:`scan` in the order of `libs`.
+
+    Results that arrive early are kept until all libraries before them are
+    finished.
+    '''
+    done = dict()
+    try:
+        for f in libs:
+            if f not in done:
+                for r in results:
+                    done[r[0]] = r
+                    if r[0] == f:
+                        break
+            if f in done:
+                yield done[f]
+    finally:
+        results.close()
+
+class RecipeIndex(object):
+    '''On-disk index mapping shared libraries to the recipes they contain.
+
+    The index is a small SQLite database with one row per library. A row is
+    valid as long as modification time, size and inode of the library file
+    are unchanged.
+
+    If the index file cannot be created or written (f.e. on a read-only file
+    system), the libraries are scanned directly.
+
+    Libraries whose scan crashed or timed out are recorded as bad and are
+    not scanned again until they change.
+    '''
+
+    schema_version = 2
+
+    def __init__(self, filename, processes = None):
+        self.filename = filename
+        self.processes = processes
+
+    def _connect(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.filename, timeout = 30)
+        if conn.execute('PRAGMA user_version').fetchone()[0] \
+                != self.schema_version:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS libraries')
+                conn.execute('CREATE TABLE libraries ('
+                             'filename TEXT PRIMARY KEY, mtime INTEGER, '
+                             'size INTEGER, inode INTEGER, plugins TEXT, '
+                             'status INTEGER)')
+                conn.execute('PRAGMA user_version = %i'
+                             % self.schema_version)
+        return conn
+
+    @staticmethod
+    def _stat(filename):
+        st = os.stat(filename)
+        return (getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)),
+                st.st_size, st.st_ino)
+
+    def plugins(self, libs):
+        '''Iterate over (library, recipes) pairs.
+
+        :param libs: Shared library file names.
+        :type libs: :class:`list` of :class:`str`
+
+        The recipes are returned as a :class:`list` of (name, version,
+        version string) tuples, or :obj:`None` if the library does not
+        contain CPL recipes. Only libraries that are not in the index or
+        that changed since their last scan are loaded. If
+        :attr:`processes` is set, they are scanned with :func:`scan`. The
+        libraries are returned in the order of `libs`.
+
+        Entries of libraries that do not exist anymore are removed from the
+        index. Entries of other libraries that are not in `libs` are kept,
+        so that processes with different search paths can share the index.
+        '''
+        try:
+            conn = self._connect()
+            rows = dict((r[0], r[1:]) for r in conn.execute(
+                'SELECT filename, mtime, size, inode, plugins FROM libraries'))
+        except (sqlite3.Error, OSError, IOError) as e:
+            logging.getLogger('cpl').debug('Recipe index %s not usable: %s',
+                                           self.filename, e)
+            for f, plugins in self._scan(libs):
+                yield f, plugins
+            return
+        try:
+            changed = list()
+            stats = dict()
+            for f in libs:
+                try:
+                    stats[f] = self._stat(f)
+                except OSError:
+                    continue
+                row = rows.get(f)
+                if row is None or tuple(row[:3]) != stats[f]:
+                    changed.append(f)
+            self._prune(conn, [ f for f in set(rows) - set(stats)
+                                if not os.path.exists(f) ])
+            scanned = self._scan_status(changed)
+            for f in libs:
+                if f not in stats:
+                    continue
+                row = rows.get(f)
+                if row is not None and tuple(row[:3]) == stats[f]:
+                    plugins = json.loads(row[3])
+                    yield f, [ tuple(p) for p in plugins ] \
+                        if plugins is not None else None
+                else:
+                    f, plugins, status = next(scanned)
+                    self._store(conn, f, stats[f], plugins, status)
+                    yield f, plugins
+        finally:
+            conn.close()
+
+    def _scan_status(self, libs):
+        if self.processes:
+            return in_order(libs, scan(libs, self.processes))
+        else:
+            return ((f, list_recipes(f), 0) for f in libs)
+
+    def _scan(self, libs):
+        return ((f, plugins) for f, plugins, status in self._scan_status(libs))
+
+    def bad_libraries(self):
+        '''Return a list of (library, status) pairs of all libraries where
+        the scan crashed.
+        '''
+        if not os.path.exists(self.filename):
+            return []
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT filename, status FROM libraries '
+                                'WHERE status != 0').fetchall()
+        finally:
+            conn.close()
+
+    def _prune(self, conn, filenames):
+        if not filenames:
+            return
+        try:
+            with conn:
+                conn.executemany('DELETE FROM libraries WHERE filename = ?',
+                                 [ (f, ) for f in filenames ])
+        except sqlite3.Error as e:
+            logging.getLogger('cpl').debug('Cannot update recipe index %s: %s',
+                                           self.filename, e)
+
+    def _store(self, conn, filename, stat, plugins, status = 0):
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO libraries '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (filename, ) + stat
+                             + (json.dumps(plugins), status))
+        except sqlite3.Error as e:
+            logging.getLogger('cpl').debug('Cannot update recipe index %s: %s',
+                                           self.filename, e)
+
+    def clear(self):
+        '''Remove all entries from the index.'''
+        if os.path.exists(self.filename):
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('DELETE FROM libraries')
+            finally:
+                conn.close()
@@ -1,10 +1,14 @@
 from __future__ import absolute_import
 import datetime
+import errno
 import logging
 import os
 import re
 import tempfile
 import threading
+import time
+
+from .timeline import _clock
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -18,14 +22,20 @@ level = { "DEBUG":logging.DEBUG, "INFO":logging.INFO, "WARNING":logging.WARN,
 cpl_verbosity = [ logging.DEBUG, logging.INFO, logging.WARN,
                   logging.ERROR, logging.CRITICAL + 1 ]
 
-class LogServer(threading.Thread):
+class LogReceiver(object):
+    '''Receiver of the log messages of a recipe call.
+
+    The recipe writes its messages into a FIFO, which is created here. Each
+    line read from it is passed to :meth:`log()`.
+    '''
 
     def __init__(self, name, level = None):
-        threading.Thread.__init__(self)
         self.name = name
         self.logger = logging.getLogger(name)
         self.level = cpl_verbosity.index(level) if level is not None else 0
         self.entries = LogList()
+        self.last_activity = None
+        '''Monotonic time of the last received line, or :obj:`None`.'''
         self.regexp = re.compile('(\\d\\d):(\\d\\d):(\\d\\d)' +
                                  '\\s\\[\\s*(\\w+)\\s*\\]' + 
                                  '\\s(\\w+):' +
@@ -35,18 +45,10 @@ class LogServer(threading.Thread):
         os.close(tmphdl)
         os.remove(self.logfile)
         os.mkfifo(self.logfile)
-        self.start()
 
-    def run(self):
-        try:
-            with open(self.logfile, 'rb', buffering = 0) as logfile:
-                line = logfile.readline()
-                os.remove(self.logfile)
-                while line:
-                    self.log(str(line.decode('ascii')))
-                    line = logfile.readline()
-        except:
-            pass
+    def join(self, timeout = None):
+        '''Wait until all messages are received.'''
+        pass
 
     def log(self, s):
         '''Convert CPL log messages into python log records.
@@ -56,6 +58,7 @@ class LogServer(threading.Thread):
          10:35:25 [WARNING] rtest: [tid=000] No file tagged with FLAT
 
         '''
+        self.last_activity = _clock()
         try:
             m = self.regexp.match(s)
             if m is not None:
@@ -100,6 +103,44 @@ class LogServer(threading.Thread):
         except:
             pass
 
+class LogServer(threading.Thread, LogReceiver):
+    '''Receiver of the log messages of a recipe call that reads the FIFO in
+    a separate thread.
+    '''
+
+    def __init__(self, name, level = None):
+        threading.Thread.__init__(self)
+        LogReceiver.__init__(self, name, level)
+        self.start()
+
+    def close(self):
+        '''Wait until all messages are received after the recipe process
+        was killed. If the recipe did not open the FIFO yet, the reading is
+        stopped.'''
+        # Opening the FIFO for writing wakes up the reading thread if it
+        # waits for a writer. The open fails with ENXIO as long as the
+        # thread did not open the FIFO for reading yet.
+        while self.is_alive():
+            try:
+                os.close(os.open(self.logfile, os.O_WRONLY | os.O_NONBLOCK))
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    break
+                time.sleep(0.001)
+        self.join()
+
+    def run(self):
+        try:
+            with open(self.logfile, 'rb', buffering = 0) as logfile:
+                line = logfile.readline()
+                os.remove(self.logfile)
+                while line:
+                    self.log(str(line.decode('ascii')))
+                    line = logfile.readline()
+        except:
+            pass
+
 class LogList(list):
     '''List of log messages.
 
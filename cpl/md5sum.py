@@ -1,4 +1,44 @@
+'''MD5 checksums of the data units of FITS files.
+
+The checksum is the one written into the ``DATAMD5`` keyword: the MD5 sum
+of the data units of all HDUs, each followed by zeros up to the next
+multiple of the FITS block size. A data unit that fills whole blocks is
+followed by a full block of zeros. The data is fed into the
+hash in chunks without copying it; since :mod:`hashlib` releases the GIL
+while hashing, several HDU lists or files can be hashed in parallel threads.
+'''
+from __future__ import absolute_import
 import hashlib
+import mmap
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str, )
+
+block_size = 2880
+'''Size of a FITS block in bytes.'''
+
+chunk_size = 1 << 22
+'''Number of bytes that are fed into the hash at once.'''
+
+def _buffer(data):
+    '''Return the bytes of an array as :class:`memoryview` without copying,
+    if possible.'''
+    view = memoryview(data)
+    try:
+        if view.c_contiguous:
+            return view.cast('B')
+    except (AttributeError, TypeError):
+        pass
+    return memoryview(bytes(view))
+
+def _update(md5sum, buf):
+    for start in range(0, len(buf), chunk_size):
+        md5sum.update(buf[start:start + chunk_size])
+
+def _pad(md5sum, size):
+    md5sum.update(b'\0' * (block_size - size % block_size))
 
 def datamd5(hdulist):
     '''Calculate the MD5SUM of all data regions of a HDUList.
@@ -6,15 +46,138 @@ def datamd5(hdulist):
     md5sum = hashlib.md5()
     for hdu in hdulist:
         if hdu.data is not None:
-            md5sum.update(bytes(hdu.data.data))
-            pad = b'\0' * (2880 - hdu.data.nbytes % 2880)
-            md5sum.update(pad)
+            buf = _buffer(hdu.data.data)
+            _update(md5sum, buf)
+            _pad(md5sum, len(buf))
+    return md5sum.hexdigest()
+
+def scaled(hdulist):
+    '''Check whether the data of a HDU list is scaled with the ``BSCALE``,
+    ``BZERO`` or ``BLANK`` keywords.
+
+    :func:`datamd5()` hashes the scaled values, so the checksum of a scaled
+    HDU list cannot be calculated from the data units in the file.
+    '''
+    for hdu in hdulist:
+        header = hdu.header
+        if header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0 \
+                or 'BLANK' in header:
+            return True
+    return False
+
+def data_size(header, padded = True):
+    '''Return the size in bytes of the data unit described by a FITS header.
+
+    :param header: The header, or a :class:`dict` with the values of the
+        structural keywords.
+    :param padded: Return the size padded to the block size, as it is
+        stored in the file.
+    '''
+    naxis = int(header.get('NAXIS', 0))
+    if naxis == 0:
+        return 0
+    size = 1
+    for i in range(1, naxis + 1):
+        n = int(header['NAXIS%i' % i])
+        if not (i == 1 and n == 0
+                and header.get('GROUPS') in (True, 'T', b'T')):
+            size *= n
+    size = abs(int(header['BITPIX'])) // 8 * int(header.get('GCOUNT', 1)) \
+        * (int(header.get('PCOUNT', 0)) + size)
+    return size + -size % block_size if padded else size
+
+def _data_units(f):
+    '''Return the (offset, size) pairs of the data units in a FITS file,
+    with the size without padding.'''
+    units = list()
+    offset = 0
+    while True:
+        f.seek(offset)
+        cards = dict()
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                return units
+            offset += block_size
+            for i in range(0, block_size, 80):
+                card = block[i:i + 80]
+                key = card[:8].strip()
+                if key == b'END':
+                    break
+                if card[8:10] == b'= ':
+                    cards[key.decode('ascii', 'replace')] = \
+                        card[10:].split(b'/')[0].strip()
+            else:
+                continue
+            break
+        size = data_size(cards, False)
+        if size > 0:
+            units.append((offset, size))
+        offset += size + -size % block_size
+
+def filemd5(filename, units = None):
+    '''Calculate the MD5SUM of all data regions of a FITS file.
+
+    Only the headers are read; the data units are memory mapped and hashed
+    directly from the page cache, without building a HDU list.
+
+    :param units: (offset, size) pairs of the data units to hash, with the
+        size without padding. Defaults to all data units of the file.
+    '''
+    md5sum = hashlib.md5()
+    with open(filename, 'rb') as f:
+        if units is None:
+            units = _data_units(f)
+        units = [ (offset, size) for offset, size in units if size > 0 ]
+        if units:
+            m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                buf = memoryview(m)
+                try:
+                    for offset, size in units:
+                        _update(md5sum, buf[offset:offset + size])
+                        missing = offset + size - len(m)
+                        if missing > 0:
+                            md5sum.update(b'\0' * missing)
+                        _pad(md5sum, size)
+                finally:
+                    buf.release()
+            finally:
+                m.close()
     return md5sum.hexdigest()
 
+def datamd5_all(objects, max_workers = None):
+    '''Calculate the MD5SUMs of several HDU lists or FITS files in parallel.
+
+    :param objects: HDU lists, file names, and (file name, units) pairs
+        as taken by :func:`filemd5()`.
+    :param max_workers: Maximal number of threads. Defaults to the number
+        of CPUs.
+    :return: The list of MD5SUMs, in the order of `objects`.
+    '''
+    objects = list(objects)
+    def md5(obj):
+        if isinstance(obj, _string_types):
+            return filemd5(obj)
+        elif isinstance(obj, tuple):
+            return filemd5(*obj)
+        else:
+            return datamd5(obj)
+    if len(objects) < 2:
+        return [ md5(obj) for obj in objects ]
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor
+    max_workers = max_workers or multiprocessing.cpu_count()
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(md5, objects))
+
 def verify_md5(hdulist):
     return hdulist[0].header.get('DATAMD5') == datamd5(hdulist)
 
-def update_md5(hdulist):
-    md5sum = datamd5(hdulist)
+def update_md5(hdulist, md5sum = None):
+    '''Set the DATAMD5 keyword of a HDU list and return the MD5SUM. If it is
+    already known, it may be given as `md5sum`.'''
+    if md5sum is None:
+        md5sum = datamd5(hdulist)
     hdulist[0].header['DATAMD5'] =  (md5sum, 'MD5 checksum')
     return md5sum
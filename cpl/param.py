@@ -1,5 +1,110 @@
+import collections
 import textwrap
 
+from .docstring import DocString
+
+class ParameterDef(collections.namedtuple(
+        'ParameterDef',
+        'name context fullname desc range sequence default type enabled')):
+    '''Definition of a recipe parameter, as provided by the recipe. This is
+    shared by all :class:`Parameter` objects for the same recipe parameter.
+    '''
+    __slots__ = ()
+
+    @property
+    def doc(self):
+        '''Doc string of the parameter.'''
+        return textwrap.fill("%s (%s; default: %s)" %
+                             (self.desc, self.type.__name__,
+                              repr(self.default)))
+
+def _paramname(s):
+    for c in [ '-', ' ' ]:
+        if isinstance(c, tuple):
+            s = s.replace(c[0], c[1])
+        else:
+            s = s.replace(c, '_')
+    return s
+
+def _convert(definition, value):
+    '''Check a parameter value and convert it to the parameter type.'''
+    if value is not None and definition.type is not None.__class__:
+        if definition.type is bool and isinstance(value, str):
+            d = {'true':True, 'false':False, 'yes':True, 'no':False}
+            value = d.get(value.lower(), value)
+        value = definition.type(value)
+        if definition.sequence and value not in definition.sequence:
+            raise ValueError("'%s' is not in %s"
+                             % (value, definition.sequence))
+        if definition.range and not (definition.range[0] <= value
+                                     <= definition.range[-1]):
+            raise ValueError("'%s' is not in range %s"
+                             % (value, definition.range))
+    return value
+
+class ParameterSchema(object):
+    '''Parameter definitions of a recipe.
+
+    The schema is read once per recipe plugin and shared by all
+    :class:`ParameterList` objects of the recipe. It indexes the parameter
+    definitions by name, full name and attribute name, and contains one
+    child schema for each dotted prefix of the parameter names.
+    '''
+    def __init__(self, params, prefix = None):
+        self.prefix = prefix
+        self.keys = dict()
+        self.defs = list()
+        self._doc = None
+        childs = collections.OrderedDict()
+        for p in params:
+            if not isinstance(p, ParameterDef):
+                name, context, fullname, desc, prange, sequence, deflt, \
+                    ptype, enabled = p
+                p = ParameterDef(name, context, fullname, desc, prange,
+                                 sequence, deflt, ptype or deflt.__class__,
+                                 enabled)
+            if prefix:
+                if p.name.startswith(prefix + '.'):
+                    aname = p.name[len(prefix)+1:]
+                else:
+                    continue
+            else:
+                aname = p.name
+            if '.' in aname:
+                aname = aname.split('.', 1)[0]
+                if prefix:
+                    aname = prefix + '.' + aname
+                childs.setdefault(aname, list()).append(p)
+            else:
+                self.keys[p.name] = p
+                self.keys[p.fullname] = p
+                self.keys[_paramname(aname)] = p
+                self.defs.append(p)
+        for name, cparams in childs.items():
+            child = ParameterSchema(cparams, prefix = name)
+            self.keys[name] = child
+            for p in child.defs:
+                self.keys[p.name] = p
+                self.keys[p.fullname] = p
+                self.defs.append(p)
+            self.keys[_paramname(name)] = child
+
+    @property
+    def doc(self):
+        '''Doc string of all parameters. It is generated on first access.'''
+        if self._doc is None:
+            if len(self.defs) == 0:
+                self._doc = 'No parameters'
+            else:
+                maxlen = max(len(p.name) for p in self.defs)
+                self._doc = ''.join(textwrap.fill(
+                    p.doc,
+                    subsequent_indent = ' ' * (maxlen + 3),
+                    initial_indent = ' %s: ' % p.name.rjust(maxlen)) + '\n'
+                                    for p in self.defs)
+        return self._doc
+
+
 class Parameter(object):
     '''Runtime configuration parameter of a recipe. 
     Parameters are designed to handle monitor/control data and they provide a
@@ -64,44 +169,32 @@ class Parameter(object):
     >>> print 'value:   ', muse_scibasic.param.cr.value
     value:    None
     '''
-    def __init__(self, name):
-        self.name = name
-        self._value = None
-
-    def _set_attributes(self, context = None, fullname = None, default = None, 
-                        desc = None, range_ = None, sequence = None, 
-                        ptype = None, enabled = None):
-        self.context = context
-        self.range = range_
-        self.sequence = sequence
-        self.default = default
-        self.fullname = fullname
-        self.type = ptype or default.__class__
-        self.enabled = enabled
-        self.__doc__ = textwrap.fill("%s (%s; default: %s)" %
-                                     (desc, self.type.__name__,
-                                      repr(self.default)))
+    __slots__ = ('_def', '_values')
+
+    def __init__(self, definition, values):
+        self._def = definition
+        self._values = values
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return getattr(self._def, key)
 
     @property
     def value(self):
-        return self._value
+        return self._values.get(self._def.fullname)
 
     @value.setter
     def value(self, value):
-        if value is not None and self.type is not None.__class__:
-            if self.type is bool and isinstance(value, str):
-                d = {'true':True, 'false':False, 'yes':True, 'no':False}
-                value = d.get(value.lower(), value)
-            value = self.type(value) 
-            if self.sequence and value not in self.sequence:
-                raise ValueError("'%s' is not in %s" % (value, self.sequence))
-            if self.range and not (self.range[0] <= value <= self.range[-1]):
-                raise ValueError("'%s' is not in range %s" % (value, self.range))
-        self._value = value
+        value = _convert(self._def, value)
+        if value is None:
+            self._values.pop(self._def.fullname, None)
+        else:
+            self._values[self._def.fullname] = value
 
     @value.deleter
     def value(self):
-        self._value = None
+        self._values.pop(self._def.fullname, None)
 
     def __str__(self):
         return '%s%s' % (
@@ -117,48 +210,36 @@ class Parameter(object):
     def __getitem__(self,i):
         return (self.name, self.value or self.default)[i]
 
+    def _doc(self):
+        return self._def.doc
+
+    __doc__ = DocString(__doc__, _doc)
+
 
 class ParameterList(object):
     def __init__(self, recipe, other = None, prefix = None):
         self._recipe = recipe
-        self._dict = dict()
-        self._pars = list()
-        self._prefix = prefix
-        childs = set()
-        for name, context, fullname, desc, prange, \
-                sequence, deflt, ptype, enabled in recipe._recipe.params():
-            if prefix:
-                if name.startswith(prefix + '.'):
-                    aname = name[len(prefix)+1:]
-                else:
-                    continue
-            else:
-                aname = name
-            if '.' in aname:
-                aname = aname.split('.', 1)[0]
-                if prefix:
-                    aname = prefix + '.' + aname
-                childs.add(aname)
-            else:
-                par = Parameter(name)
-                par._set_attributes(context, fullname, deflt,
-                                    desc, prange, sequence, ptype, enabled)
-                self._dict[name] = par
-                self._dict[fullname] = par
-                self._dict[self._paramname(aname)] = par
-                self._pars.append(par)
-        for name in childs:
-            clist = ParameterList(recipe, prefix = name)
-            self._dict[name] = clist
-            for par in clist._pars:
-                self._dict[par.name] = par
-                self._dict[par.fullname] = par
-                self._pars.append(par)
-            aname = self._paramname(name)
-            self._dict[aname] = clist
-        if other:
+        self._schema = recipe._plugin.params
+        if prefix:
+            self._schema = self._schema.keys[prefix]
+        self._values = dict()
+        self._items = dict()
+        if isinstance(other, self.__class__) \
+                and other._schema is self._schema:
+            self._values.update(other._values)
+        elif other:
             self._set_items(other)
-        self.__doc__ = self._doc()
+
+    @classmethod
+    def _overlay(cls, recipe, schema, values):
+        '''Create a parameter list for the schema that works on the given
+        values. Changes in the list are reflected in the values.'''
+        plist = cls.__new__(cls)
+        plist._recipe = recipe
+        plist._schema = schema
+        plist._values = values
+        plist._items = dict()
+        return plist
 
     def _set_items(self, other):
         if isinstance(other, self.__class__):
@@ -171,23 +252,32 @@ class ParameterList(object):
             self[o[0]] = o[1]
 
     def _del_items(self):
-        for p in self:
-            del p.value
+        for p in self._schema.defs:
+            self._values.pop(p.fullname, None)
 
     @staticmethod
     def _paramname(s):
-        for c in [ '-', ' ' ]:
-            if isinstance(c, tuple):
-                s = s.replace(c[0], c[1])
-            else:
-                s = s.replace(c, '_')
-        return s
+        return _paramname(s)
 
     def __iter__(self):
-        return self._pars.__iter__()
+        return (self._item(p) for p in self._schema.defs)
+
+    def _item(self, definition):
+        if isinstance(definition, ParameterSchema):
+            key = definition.prefix
+        else:
+            key = definition.fullname
+        item = self._items.get(key)
+        if item is None:
+            if isinstance(definition, ParameterSchema):
+                item = self._overlay(self._recipe, definition, self._values)
+            else:
+                item = Parameter(definition, self._values)
+            self._items[key] = item
+        return item
 
     def __getitem__(self, key):
-        return self._dict[key]
+        return self._item(self._schema.keys[key])
 
     def __setitem__(self, key, value):
         p = self[key]
@@ -210,10 +300,10 @@ class ParameterList(object):
         return dict(iter(self)).__str__()
     
     def __contains__(self, key):
-        return key in self._dict
+        return key in self._schema.keys
 
     def __len__(self):
-        return len(self._pars)
+        return len(self._schema.defs)
         
     def __getattr__(self, key):
         return self[key]
@@ -229,7 +319,7 @@ class ParameterList(object):
 
     def __dir__(self):
         return list(set(self._paramname(d) 
-                        for d in self._dict.keys() if '.' not in d))
+                        for d in self._schema.keys.keys() if '.' not in d))
 
     def __repr__(self):
         return repr(dict(iter(self)))
@@ -238,26 +328,20 @@ class ParameterList(object):
         return dict(iter(self)) == other
 
     def _doc(self):
-        if len(self) == 0:
-            return 'No parameters'
-        r = ''
-        maxlen = max(len(p.name) for p in self)
-        for p in self:
-            r += textwrap.fill(
-                p.__doc__,
-                subsequent_indent = ' ' * (maxlen + 3),
-                initial_indent = ' %s: ' % p.name.rjust(maxlen)) + '\n'
-        return r        
+        return self._schema.doc
+
+    __doc__ = DocString(None, _doc)
 
     def _aslist(self, par):
-        parlist = ParameterList(self._recipe, self)
+        '''Return the list of (fullname, value) pairs of all parameters that
+        are set, with the parameters in the par :class:`dict` overwritten.
+
+        Only the set and overwritten parameters are processed.
+        '''
+        values = self._values
         if par is not None:
-            parlist._set_items(par.items())
-        l = list()
-        for param in parlist:
-            if isinstance(param, Parameter):
-                if param.value is not None:
-                    l.append((param.fullname, param.value))
-            else:
-                l += param._aslist(par)
-        return l
+            values = dict(values)
+            self._overlay(self._recipe, self._schema, values)._set_items(
+                par.items())
+        return [ (fullname, value) for fullname, value in values.items()
+                 if value is not None ]
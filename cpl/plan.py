@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+import shutil
+import tempfile
+
+from .frames import mkabspath, expandframelist, is_hdulist
+from .staging import shm_dir
+
+class Plan(object):
+    '''Prepared execution plan of a recipe.
+
+    A plan is created with :meth:`cpl.Recipe.prepare()`. It holds the
+    resolved recipe parameters, the calibration frames and the runtime
+    environment, so that they are not processed again on each call. Calling
+    the plan runs the recipe with the given raw frames::
+
+      >>> plan = muse_bias.prepare(param = {'nifu': 1},
+      ...                          calib = {'BADPIX_TABLE': badpix})
+      >>> for exposures in bias_sets:
+      ...     res = plan(exposures)
+
+    The plan does not change when the :attr:`cpl.Recipe.param`,
+    :attr:`cpl.Recipe.calib` or :attr:`cpl.Recipe.env` attributes of the
+    recipe are changed afterwards. Calibration frames given as
+    :class:`astropy.io.fits.HDUList` are written once into a staging
+    directory that is removed with :meth:`close()`, or when the plan is used
+    as a context manager and the ``with`` block is left. If the
+    :attr:`cpl.Recipe.staging` of the recipe is ``'memory'``, the staging
+    directory is created in the shared memory file system.
+
+    Plans are immutable and may be called from several threads in parallel.
+    '''
+    __slots__ = ('_recipe', '_param', '_calib', '_env', '_staging_dir',
+                 '_closed')
+
+    def __init__(self, recipe, param = None, calib = None, env = None):
+        self._staging_dir = None
+        self._closed = False
+        self._recipe = recipe
+        self._param = tuple(recipe.param._aslist(param))
+        runenv = dict(recipe.env)
+        runenv.update(env or dict())
+        self._env = tuple(runenv.items())
+        calib_frames = expandframelist(recipe.calib._aslist(calib))
+        if any(is_hdulist(f) for tag, f in calib_frames):
+            self._staging_dir = tempfile.mkdtemp(
+                dir = (recipe.staging == 'memory' and shm_dir())
+                or recipe.temp_dir, prefix = recipe.__name__ + '-calib-')
+        try:
+            mkabspath(calib_frames, self._staging_dir)
+        except:
+            self.close()
+            raise
+        self._calib = tuple(calib_frames)
+
+    @property
+    def recipe(self):
+        '''The :class:`cpl.Recipe` of the plan.'''
+        return self._recipe
+
+    @property
+    def param(self):
+        '''Tuple of (full name, value) pairs of all parameters set for the
+        call.'''
+        return self._param
+
+    @property
+    def calib(self):
+        '''Tuple of (tag, absolute file name) pairs of the calibration
+        frames.'''
+        return self._calib
+
+    @property
+    def env(self):
+        '''Environment changes for the call, as :class:`dict`.'''
+        return dict(self._env)
+
+    def __call__(self, *data, **ndata):
+        '''Run the recipe with the prepared parameters, calibration frames
+        and environment.
+
+        The raw frames and the keyword parameters `raw`, `tag`, `threaded`,
+        `loglevel`, `logname`, `output_dir`, `forkserver`, `pool`,
+        `scheduler`, `sampling`, `timeout`, `stall_timeout`, `max_memory`,
+        `max_cpu_time`, `staging` and `staging_cache` are the same as for
+        :meth:`cpl.Recipe.__call__`. The parameters, calibration frames and
+        environment are fixed by the plan and may not be specified here.
+
+        :return: The result of the recipe call.
+        :rtype: :class:`cpl.Result`
+        '''
+        return self._recipe._start(data, ndata, *self._configure(ndata))
+
+    def acall(self, *data, **ndata):
+        '''Run the recipe in an :mod:`asyncio` event loop.
+
+        This is a coroutine that takes the same parameters as
+        :meth:`__call__`. See :meth:`cpl.Recipe.acall()`.
+        '''
+        from .aio import acall
+        return acall(self._recipe, data, ndata, *self._configure(ndata))
+
+    def _configure(self, ndata):
+        for key in ('param', 'calib', 'env'):
+            if key in ndata:
+                raise TypeError('%s is fixed in the prepared plan' % key)
+        if self._closed:
+            raise ValueError('Call of a closed plan')
+        return list(self._param), list(self._calib), list(self._env), True
+
+    def close(self):
+        '''Remove the staged calibration files. The plan cannot be called
+        afterwards.
+        '''
+        self._closed = True
+        if self._staging_dir is not None:
+            shutil.rmtree(self._staging_dir, ignore_errors = True)
+            self._staging_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_staging_dir', None) is not None:
+            self.close()
+
+    def __repr__(self):
+        return 'Plan(%s, param = %s, calib = %s)' % (
+            repr(self._recipe), repr(dict(self._param)),
+            repr([tag for tag, f in self._calib]))
@@ -2,18 +2,21 @@ from __future__ import absolute_import
 import os
 import shutil
 import tempfile
-import threading
 import collections
 import warnings
 import textwrap
 
-from astropy.io import fits
-
-from . import CPL_recipe
-from .frames import FrameList, mkabspath, expandframelist
-from .result import Result, RecipeCrash
+from .frames import FrameList, mkabspath, expandframelist, is_hdulist
+from .result import Result, RecipeCrash, RecipeTimeout, RecipeKilled
 from .param import ParameterList
 from .logger import LogServer
+from .docstring import DocString
+from .index import RecipeIndex, default_filename, list_recipes, scan, \
+    in_order
+from .registry import Registry, Plugin
+from .plan import Plan
+from .supervisor import Supervisor
+from .staging import MemoryStaging
 
 class Recipe(object):
     '''Pluggable Data Reduction Module (PDRM) from a ESO pipeline. 
@@ -41,6 +44,58 @@ class Recipe(object):
     :func:`cpl.esorex.init()` is called.
     '''
 
+    index = default_filename()
+    '''File name of the persistent recipe index. The index caches the
+    recipes found in each shared library, so that :func:`Recipe.list()` and
+    the recipe lookup only need to load libraries that changed since they
+    were scanned the last time. Set to :obj:`None` to disable the index and
+    to scan all libraries on each lookup.
+    '''
+
+    scan_processes = None
+    '''Number of worker processes used to scan the shared libraries for
+    recipes. If set, each library is loaded in a separate forked process, so
+    that a crashing plugin does not crash the interpreter, and up to this
+    number of libraries are scanned in parallel. Libraries that crash their
+    worker, or whose scan takes longer than a minute, are skipped and logged
+    as warning. Defaults to :obj:`None`: all
+    libraries are scanned in the current process.
+    '''
+
+    registry = Registry()
+    '''Registry of the loaded recipe plugins. Recipes with the same name and
+    shared library share one initialized plugin; the parameters and
+    calibration frames are still kept per recipe object. Plugins may be
+    removed with :meth:`cpl.registry.Registry.evict()` or
+    :meth:`cpl.registry.Registry.clear()`; they are unloaded when the last
+    recipe object using them is deleted. Set to :obj:`None` to load the
+    plugin separately for each recipe object.
+    '''
+
+    executor = None
+    '''Executor (:class:`cpl.RecipeExecutor`) for recipe calls with
+    ``threaded = True``. If set to :obj:`None` (default), the executor
+    returned by :func:`cpl.executor.default_executor()` is used.
+    '''
+
+    scheduler = None
+    '''Scheduler (:class:`cpl.scheduler.Scheduler`) that admits the recipe
+    calls by their CPU demand and binds each recipe process to its own CPUs.
+    The demand of a call is taken from ``OMP_NUM_THREADS`` in :attr:`env`
+    or in the `env` parameter of the call; if the scheduler has a
+    :class:`cpl.history.RunHistory`, calls also wait until their predicted
+    memory is free. If set to :obj:`None` (default), the calls are started
+    without waiting.
+    '''
+
+    staging_cache = None
+    '''Cache (:class:`cpl.staging.StagingCache`) for the files of
+    :class:`astropy.io.fits.HDUList` input frames, shared between the
+    calls. A HDU list is then written only once, and reused by all calls
+    with the same content. If set to :obj:`None` (default), the HDU lists
+    are staged separately for each call, as given by :attr:`staging`.
+    '''
+
     memory_mode = 0
     '''CPL memory management mode. The valid values are
 
@@ -100,7 +155,9 @@ class Recipe(object):
         self.__file__ = filename
         '''Shared library file name.'''
 
-        self._recipe = CPL_recipe.recipe(filename, name)
+        self._plugin = Recipe.registry.get(filename, name) \
+            if Recipe.registry is not None else Plugin(filename, name)
+        self._recipe = self._plugin.recipe
         if version and version not in self.version:
             raise IOError('wrong version %s (requested %s) for %s in %s' %
                           (str(self.version), str(version), name, filename))
@@ -136,7 +193,87 @@ class Recipe(object):
 
         self.mtrace = False
 
-        self.__doc__ = self._doc()
+        self._forkserver = False
+
+        self.pool = None
+        '''Worker pool (:class:`cpl.forkserver.WorkerPool`) that executes
+        the recipe, or :obj:`None` to execute it directly or via the
+        :attr:`forkserver`. The worker pool may be also specified as
+        parameter in the recipe call.
+        '''
+
+        self.sampling = None
+        '''Interval in seconds at which the memory and CPU usage of the
+        recipe process is sampled, or :obj:`None` to disable the sampling.
+        The samples are stored in :attr:`cpl.Result.stat.timeline`. The
+        interval may be also specified as parameter in the recipe call.
+        '''
+
+        self.timeout = None
+        '''Wall clock time in seconds after which the recipe process and
+        its children are killed, and :exc:`cpl.RecipeTimeout` is raised.
+        :obj:`None` (default) means no timeout. A timeout cannot be used
+        together with a :attr:`forkserver` or a worker :attr:`pool`.
+        '''
+
+        self.max_memory = None
+        '''Limit of the address space of the recipe process in bytes, or
+        :obj:`None` for no limit. Note that the address space includes the
+        memory mapped from the Python process when the recipe was forked.
+        '''
+
+        self.max_cpu_time = None
+        '''Limit of the CPU time of the recipe process in seconds, or
+        :obj:`None` for no limit. If it is exceeded, the process is killed,
+        and :exc:`cpl.RecipeKilled` is raised.
+        '''
+
+        self.stall_timeout = None
+        '''Time in seconds in which the recipe neither writes a log message
+        nor uses CPU time, after which it is considered to be hanging. Its
+        process group is then killed, and :exc:`cpl.RecipeStalled` is
+        raised. :obj:`None` (default) disables the detection. Like the
+        :attr:`timeout`, it cannot be used together with a
+        :attr:`forkserver` or a worker :attr:`pool`.
+        '''
+
+        self.staging = 'file'
+        '''Staging of :class:`astropy.io.fits.HDUList` input frames. With
+        ``'file'`` (default), they are written into the output directory.
+        With ``'memory'``, they are written into anonymous memory files
+        (see :mod:`cpl.staging`), which avoids the disk I/O if the output
+        directory is on a slow or network file system. The staging mode may
+        be also specified as parameter in the recipe call.
+        '''
+
+        self._docstring = None
+
+    @property
+    def forkserver(self):
+        '''Execute the recipe via a fork server.
+
+        If set to :obj:`True`, the recipe processes are not forked from the
+        current Python process, but from a small separate process
+        ("zygote") that has only the recipe plugin loaded. This keeps the
+        launch time and memory usage of the recipe calls independent of the
+        size of the current process. The zygote is started when this
+        attribute is set, so it should be set early. It is shared by all
+        recipe objects of the same plugin. The fork server may also be
+        selected as parameter in the recipe call.
+
+        .. seealso:: :class:`cpl.forkserver.ForkServer`
+        '''
+        return self._forkserver
+
+    @forkserver.setter
+    def forkserver(self, value):
+        if value:
+            self._get_forkserver()
+        self._forkserver = bool(value)
+
+    def _get_forkserver(self):
+        return self._plugin.forkserver(
+            { 'CPL_MEMORY_MODE': str(Recipe.memory_mode) })
 
     @property
     def __author__(self):
@@ -184,12 +321,12 @@ class Recipe(object):
     def tags(self):
         '''Possible tags for the raw input frames, or ':obj:`None` if this
         information is not provided by the recipe.'''
-        frameconfig = self._recipe.frameConfig()
-        return [ c[0][0] for c in frameconfig ] if frameconfig else self._tags
+        tags = self._plugin.tags
+        return list(tags) if tags else self._tags
 
     @tags.setter
     def tags(self, t):
-        if self._recipe.frameConfig():
+        if self._plugin.tags:
             raise AttributeError('Tags are immutable')
         else:
             self._tags = t
@@ -248,9 +385,14 @@ class Recipe(object):
 
         Note that :class:`astropy.io.fits.HDUList` objects are stored in
         temporary files before the recipe is called which may produce some
-        overhead. Also, the CPL then assigns the random temporary file names
-        to the FITS keywords ``HIERARCH ESO PRO RECm RAWn NAME`` which should
-        be corrected afterwards if needed.
+        overhead. HDU lists that were opened from a file and not changed
+        are passed to the recipe by their file name. If only the headers
+        were changed, as in the example, the data units are copied from the
+        original file without being read by :mod:`astropy.io.fits` (see
+        :func:`cpl.staging.write_hdulist()`). Accessing the ``data`` of the
+        HDUs prevents this. Also, the CPL then assigns the random temporary
+        file names to the FITS keywords ``HIERARCH ESO PRO RECm RAWn NAME``
+        which should be corrected afterwards if needed.
 
         To assign more than one frame, put them into a list:
 
@@ -359,7 +501,8 @@ class Recipe(object):
         tags. If the recipe does not provide this information, an exception is
         raised.
         '''
-        return dict((c[0][0], c[2]) for c in self._recipe.frameConfig())
+        return dict((tag, list(c.outputs))
+                    for tag, c in self._plugin.frameconfig.items())
 
     def __call__(self, *data, **ndata):
         '''Call the recipes execution with a certain input frame.
@@ -369,8 +512,10 @@ class Recipe(object):
             :class:`list` of them, or :class:`dict`
         :param tag: Overwrite the :attr:`tag` attribute (optional).
         :type tag: :class:`str`
-        :param threaded: overwrite the :attr:`threaded` attribute (optional).
-        :type threaded: :class:`bool`
+        :param threaded: overwrite the :attr:`threaded` attribute
+            (optional). This may also be a :class:`cpl.RecipeExecutor` to
+            run the recipe in the background with this executor.
+        :type threaded: :class:`bool` or :class:`cpl.RecipeExecutor`
         :param loglevel: set the log level for python :mod:`logging` (optional).
         :type loglevel: :class:`int`
         :param logname: set the log name for the python
@@ -388,6 +533,33 @@ class Recipe(object):
         :param env: overwrite environment variables for the recipe call 
             (optional). 
         :type env: :class:`dict`
+        :param forkserver: overwrite the :attr:`forkserver` attribute
+            (optional).
+        :type forkserver: :class:`bool`
+        :param pool: overwrite the :attr:`pool` attribute (optional).
+        :type pool: :class:`cpl.forkserver.WorkerPool`
+        :param scheduler: overwrite the :attr:`scheduler` attribute
+            (optional).
+        :type scheduler: :class:`cpl.scheduler.Scheduler`
+        :param sampling: overwrite the :attr:`sampling` attribute
+            (optional).
+        :type sampling: :class:`float`
+        :param timeout: overwrite the :attr:`timeout` attribute (optional).
+        :type timeout: :class:`float`
+        :param max_memory: overwrite the :attr:`max_memory` attribute
+            (optional).
+        :type max_memory: :class:`int`
+        :param max_cpu_time: overwrite the :attr:`max_cpu_time` attribute
+            (optional).
+        :type max_cpu_time: :class:`int`
+        :param stall_timeout: overwrite the :attr:`stall_timeout` attribute
+            (optional).
+        :type stall_timeout: :class:`float`
+        :param staging: overwrite the :attr:`staging` attribute (optional).
+        :type staging: :class:`str`
+        :param staging_cache: overwrite the :attr:`staging_cache` attribute
+            (optional).
+        :type staging_cache: :class:`cpl.staging.StagingCache`
         :return: The object with the return frames as 
             :class:`astropy.io.fits.HDUList` objects
         :rtype: :class:`cpl.Result`
@@ -397,6 +569,13 @@ class Recipe(object):
                 not be built, the recipe could not start or the files could not 
                 be read/written.
         :raise: :exc:`cpl.CplError` If the recipe returns an error.
+        :raise: :exc:`cpl.RecipeTimeout` If the recipe exceeds the
+                :attr:`timeout`.
+        :raise: :exc:`cpl.RecipeStalled` If the recipe hangs for the
+                :attr:`stall_timeout`.
+        :raise: :exc:`cpl.RecipeKilled` If the recipe process is killed
+                by a signal, f.e. because it exceeded the
+                :attr:`max_cpu_time`.
         :raise: :exc:`cpl.RecipeCrash` If the CPL recipe crashes with a
                 SIGSEV or a SIGBUS
 
@@ -406,57 +585,184 @@ class Recipe(object):
             (``threaded = True``) and an exception occurs, this exception is 
             raised whenever result fields are accessed.
         '''
+        return self._start(data, ndata, *self._configure(ndata))
+
+    def acall(self, *data, **ndata):
+        '''Execute the recipe in an :mod:`asyncio` event loop.
+
+        This is a coroutine; it takes the same parameters as
+        :meth:`__call__` and returns its :class:`cpl.Result`::
+
+          >>> res = await muse_bias.acall(raw, param = {'nifu': 1})
+
+        The recipe process is supervised by the event loop without any
+        additional threads, so that many recipe calls may run concurrently.
+
+        .. note::
+
+           The ``threaded`` parameter is ignored. If the recipe is executed
+           via a :attr:`forkserver` or a worker :attr:`pool`, the call waits
+           in a thread of the default executor of the event loop.
+        '''
+        from .aio import acall
+        return acall(self, data, ndata, *self._configure(ndata))
+
+    def _configure(self, ndata):
+        '''Return the parameter list, calibration frames, environment and
+        the staging flag for a recipe call with the keyword parameters
+        ndata.'''
+        parlist = self.param._aslist(ndata.get('param'))
+        calib_frames = expandframelist(self.calib._aslist(ndata.get('calib')))
+        runenv = dict(self.env)
+        runenv.update(ndata.get('env', dict()))
+        return parlist, calib_frames, list(runenv.items()), False
+
+    def prepare(self, param = None, calib = None, env = None):
+        '''Prepare the recipe for many calls with the same configuration.
+
+        The recipe parameters, calibration frames and the runtime
+        environment are resolved once and stored in the returned plan, so
+        that calling the plan only needs to add the raw frames::
+
+          >>> plan = muse_bias.prepare(param = {'nifu': 1})
+          >>> results = [ plan(raw) for raw in exposures ]
+
+        :param param: Overwrite the CPL parameters of the recipe specified
+            as keys with their dictionary values (optional).
+        :type param: :class:`dict`
+        :param calib: Overwrite the calibration frame lists for the tags
+            specified as keys with their dictionary values (optional).
+        :type calib: :class:`dict`
+        :param env: Overwrite environment variables for the recipe calls
+            (optional).
+        :type env: :class:`dict`
+        :rtype: :class:`cpl.plan.Plan`
+        '''
+        return Plan(self, param, calib, env)
+
+    def _start(self, data, ndata, parlist, calib_frames, runenv, staged):
+        '''Set up the output directory, and run the recipe with the raw
+        frames from the call arguments. If staged is set, the calibration
+        frames are already absolute file names.
+        '''
+        args = self._setup(data, ndata, parlist, calib_frames, runenv, staged)
         threaded = ndata.get('threaded', self.threaded)
+        if not threaded:
+            return self._exec(*args)
+        else:
+            from .executor import RecipeExecutor, default_executor
+            executor = threaded if isinstance(threaded, RecipeExecutor) \
+                else self.executor or default_executor()
+            supervisor = args[-1]
+            return Threaded(executor.submit(self._exec, *args), supervisor)
+
+    def _setup(self, data, ndata, parlist, calib_frames, runenv, staged):
+        '''Set up the output directory and return the arguments for
+        :meth:`_exec`.'''
         mtrace = ndata.get('mtrace', self.mtrace)
+        pool = ndata.get('pool', self.pool)
+        if pool is not None:
+            runner = pool.runner(self.__file__, self.__name__)
+        elif ndata.get('forkserver', self.forkserver):
+            runner = self._get_forkserver()
+        else:
+            runner = self._recipe
+        staging = ndata.get('staging', self.staging)
+        if staging not in ('file', 'memory'):
+            raise ValueError('Unknown staging mode %s' % repr(staging))
+        timeout = ndata.get('timeout', self.timeout)
+        stall_timeout = ndata.get('stall_timeout', self.stall_timeout)
+        sampling = ndata.get('sampling', self.sampling)
+        limits = (ndata.get('max_memory', self.max_memory) or -1,
+                  ndata.get('max_cpu_time', self.max_cpu_time) or -1)
+        if runner is not self._recipe:
+            if timeout or stall_timeout:
+                raise ValueError('A timeout requires the direct execution '
+                                 'of the recipe')
+            supervisor = None
+        elif timeout or stall_timeout or sampling or limits != (-1, -1) \
+                or ndata.get('threaded', self.threaded):
+            # Threaded calls are supervised to be killed on cancel(). A new
+            # process group is only needed to kill the children of the
+            # recipe on a timeout; otherwise the recipe stays in the process
+            # group of the terminal and gets its Ctrl-C.
+            supervisor = Supervisor(timeout, sampling, stall_timeout,
+                                    new_group = bool(timeout or stall_timeout))
+        else:
+            supervisor = None
         loglevel = ndata.get('loglevel')
         logname = ndata.get('logname', 'cpl.%s' % self.__name__)
         output_dir = ndata.get('output_dir', self.output_dir)
-        output_format = str if output_dir else fits.HDUList
+        if output_dir:
+            output_format = str
+        else:
+            from astropy.io import fits
+            output_format = fits.HDUList
         if output_dir is None:
             output_dir = tempfile.mkdtemp(dir = self.temp_dir, 
                                           prefix = self.__name__ + "-") 
-        parlist = self.param._aslist(ndata.get('param'))
         raw_frames = self._get_raw_frames(*data, **ndata)
         if len(raw_frames) < 1:
             raise ValueError('No raw frames specified.')
-        input_len = -1 if isinstance(raw_frames[0][1], fits.HDUList) else \
+        input_len = -1 if is_hdulist(raw_frames[0][1]) else \
             len(raw_frames[0][1]) if isinstance(raw_frames[0][1], list) else -1
-        calib_frames = self.calib._aslist(ndata.get('calib'))
-        framelist = expandframelist(raw_frames + calib_frames)
-        runenv = dict(self.env)
-        runenv.update(ndata.get('env', dict()))
-        logger = None
-        delete = output_format == fits.HDUList
+        framelist = expandframelist(raw_frames)
+        if not staged:
+            framelist += calib_frames
+        delete = output_format is not str
+        cache = ndata.get('staging_cache', self.staging_cache)
+        if cache is not None:
+            staging = cache.lease()
+        elif staging == 'memory':
+            staging = MemoryStaging(output_dir, runner is self._recipe)
+        else:
+            staging = None
         try:
             if (not os.access(output_dir, os.F_OK)):
                 os.makedirs(output_dir)
-            mkabspath(framelist, output_dir)
-            logger = LogServer(logname, loglevel)
+            mkabspath(framelist, output_dir, staging)
         except:
             try:
-                self._cleanup(output_dir, logger, delete)
+                self._cleanup(output_dir, None, delete, staging)
             except:
                 pass
             raise
-        if not threaded:
-            return self._exec(output_dir, parlist, framelist, runenv, 
-                         input_len, logger, output_format, delete, mtrace)
-        else:
-            return  Threaded(
-                self._exec, output_dir, parlist, framelist, runenv, 
-                input_len, logger, output_format, delete, mtrace)
-
-    def _exec(self, output_dir, parlist, framelist, runenv,
-              input_len, logger, output_format, delete, mtrace):
+        if staged:
+            framelist += calib_frames
+        scheduler = ndata.get('scheduler', self.scheduler)
+        return (runner, output_dir, parlist, framelist, runenv, input_len,
+                logname, loglevel, output_format, delete, staging, mtrace,
+                scheduler, limits, supervisor)
+
+    def _exec(self, runner, output_dir, parlist, framelist, runenv,
+              input_len, logname, loglevel, output_format, delete, staging,
+              mtrace, scheduler, limits, supervisor):
+        logger = None
+        cpus = None
         try:
-            return Result(output_dir,
-                          self._recipe.run(output_dir, parlist, framelist,
-                                           list(runenv.items()), 
-                                           logger.logfile, logger.level,
-                                           self.memory_dump, mtrace),
-                          input_len, logger, output_format)
+            if scheduler is not None:
+                memory = scheduler.memory_demand(self, framelist)
+                cpus = scheduler.acquire(scheduler.demand(runenv), memory)
+            logger = LogServer(logname, loglevel)
+            args = (output_dir, parlist, framelist, runenv, logger.logfile,
+                    logger.level, self.memory_dump, mtrace, cpus) + limits
+            if supervisor is not None:
+                try:
+                    res, samples = supervisor.run(runner, args, logger)
+                except (RecipeTimeout, RecipeKilled) as e:
+                    logger.close()
+                    e.log = logger.entries
+                    raise
+            else:
+                res, samples = runner.run(*args), None
+            if scheduler is not None:
+                scheduler.record(self, framelist, res[2])
+            return Result(output_dir, res, input_len, logger, output_format,
+                          samples, supervisor and supervisor.max_idle)
         finally:
-            self._cleanup(output_dir, logger, delete)
+            if cpus is not None:
+                scheduler.release(cpus, memory)
+            self._cleanup(output_dir, logger, delete, staging)
 
     def _get_raw_frames(self, *data, **ndata):
         '''Return the input frames.
@@ -476,14 +782,13 @@ class Recipe(object):
                 raise ValueError('No raw input tag')
             elif tag not in m:
                 m[tag] = f
-            elif isinstance(m[tag], list) \
-                    and not isinstance(m[tag], fits.HDUList):
+            elif isinstance(m[tag], list) and not is_hdulist(m[tag]):
                 m[tag].append(f)
             else:
                 m[tag] = [ m[tag], f ]
         return list(m.items())
 
-    def _cleanup(self, output_dir, logger, delete):
+    def _cleanup(self, output_dir, logger, delete, staging = None):
         try:
             bt = os.path.join(output_dir, 'recipe.backtrace-unprocessed')
             if os.path.exists(bt):
@@ -494,6 +799,8 @@ class Recipe(object):
                     raise ex
 
         finally:
+            if staging is not None:
+                staging.close()
             if delete:
                 shutil.rmtree(output_dir)
 
@@ -505,7 +812,7 @@ class Recipe(object):
             r = 'Parameters:\n%s\n' % self._param.__doc__
         else:
             r = 'No parameters\n'
-        if self._recipe.frameConfig() is not None:
+        if self._plugin.frameconfig is not None:
             c = textwrap.fill(repr([f.tag for f in self.calib]),
                               initial_indent = 'Calibration frames: ',
                               subsequent_indent = ' ' * 21) + '\n\n'
@@ -522,6 +829,13 @@ class Recipe(object):
             t = ''
         return s + r + c + t + '\n\n'
 
+    def _cached_doc(self):
+        if self._docstring is None:
+            self._docstring = self._doc()
+        return self._docstring
+
+    __doc__ = DocString(__doc__, _cached_doc)
+
     def __repr__(self):
         return 'Recipe(%s, version = %s)' % (repr(self.__name__), 
                                              repr(self.version[0]))
@@ -533,10 +847,8 @@ class Recipe(object):
         Searches for all recipes in in the directory specified by the class
         attribute :attr:`Recipe.path` or its subdirectories. 
         '''
-        os.putenv('CPL_MEMORY_MODE', str(Recipe.memory_mode));
         plugins = collections.defaultdict(list)
-        for f in Recipe.get_libs():
-            plugin_f = CPL_recipe.list(f)
+        for f, plugin_f in Recipe._plugins():
             if plugin_f:
                 for p in plugin_f:
                     plugins[p[0]].append(p[2])
@@ -544,11 +856,9 @@ class Recipe(object):
 
     @staticmethod
     def get_recipefilename(name, version = None):
-        os.putenv('CPL_MEMORY_MODE', str(Recipe.memory_mode));
         filename = None
         rversion = -1
-        for f in Recipe.get_libs():
-            plugin_f = CPL_recipe.list(f)
+        for f, plugin_f in Recipe._plugins():
             if plugin_f:
                 for p in plugin_f:
                     if p[0] != name:
@@ -560,6 +870,22 @@ class Recipe(object):
                         filename = f
         return filename
 
+    @staticmethod
+    def _plugins():
+        '''Iterate over (library, recipes) pairs of all libraries in the
+        search path, using the recipe index if enabled.
+        '''
+        os.putenv('CPL_MEMORY_MODE', str(Recipe.memory_mode));
+        libs = Recipe.get_libs()
+        if Recipe.index:
+            return RecipeIndex(Recipe.index,
+                               Recipe.scan_processes).plugins(libs)
+        elif Recipe.scan_processes:
+            return ((f, p) for f, p, status
+                    in in_order(libs, scan(libs, Recipe.scan_processes)))
+        else:
+            return ((f, list_recipes(f)) for f in libs)
+
     @staticmethod
     def get_libs():
         libs = [ ]
@@ -576,53 +902,67 @@ class Recipe(object):
 
         .. note::
 
-            This affects only threads that are started afterwards with
-            the ``threaded = True`` flag.
+            This affects only recipe calls that are started afterwards.
 
         .. seealso:: :ref:`parallel`
         '''
-        Threaded.set_maxthreads(n)
+        from .executor import default_executor
+        (Recipe.executor or default_executor()).resize(n)
 
-class Threaded(threading.Thread):
-    '''Simple threading interface. 
+class Threaded(object):
+    '''Result of a recipe call executed in the background.
 
-    Creating this object will start the execution of func(*args, **nargs).
-    It returns an object that has the same attribute as the function return
-    value, if the function execution was completed.
+    The object has the same attributes as the :class:`cpl.Result` of the
+    call, once the call is completed.
 
-    Accessing any of the attributes will cause a wait until the function
+    Accessing any of the attributes will cause a wait until the recipe
     execution is ready. Note that the attribute delegation will work only for
-    attributes (not for methods), and it will not work for attributes defined
-    by the threading.Thread interface.
+    attributes (not for methods).
 
-    If the function returns an exception, this exception is thrown by any
+    If the recipe call raised an exception, this exception is thrown by any
     attempt to access an attribute.
+
+    .. attribute:: future
+
+       The :class:`concurrent.futures.Future` of the call.
     '''
-    pool_sema = threading.BoundedSemaphore(65536)
-
-    def __init__(self, func, *args, **nargs):
-        threading.Thread.__init__(self)
-        self._func = func
-        self._args = args
-        self._nargs = nargs
-        self._res = None
-        self._exception = None
-        self.start()
-                    
-    def run(self):
-        with Threaded.pool_sema:
-            try:
-                self._res = self._func(*self._args, **self._nargs)
-            except Exception as exception:
-                self._exception = exception
+
+    def __init__(self, future, supervisor = None):
+        self.future = future
+        self._supervisor = supervisor
+
+    def cancel(self):
+        '''Cancel the recipe call.
+
+        A call that is still waiting in the executor is not started. If the
+        recipe is already running directly (not via a fork server or a
+        worker pool), its process is killed, and accessing the result
+        raises :exc:`cpl.RecipeKilled`. Processes started by the recipe are
+        killed as well only if the call has a :attr:`timeout` or a
+        :attr:`stall_timeout`, since only then the recipe runs in its own
+        process group.
+
+        :return: :obj:`True` if the call was cancelled or killed.
+        '''
+        if self.future.cancel():
+            return True
+        if self._supervisor is not None and not self.future.done():
+            return self._supervisor.cancel()
+        return False
 
     @property
     def _result(self):
-        self.join()
-        if self._exception is None:
-            return self._res
-        else:
-            raise self._exception
+        return self.future.result()
+
+    def join(self, timeout = None):
+        '''Wait until the recipe call is finished, or until the timeout (in
+        seconds) occurs.'''
+        from concurrent.futures import wait
+        wait([ self.future ], timeout)
+
+    def is_alive(self):
+        '''Return :obj:`True` if the recipe call is not finished.'''
+        return not self.future.done()
 
     def __getitem__(self, key):
         return self._result[key]
@@ -637,10 +977,6 @@ class Threaded(threading.Thread):
         return self._result.__iter__()
 
     def __getattr__(self, name):
+        if name in ('future', '_supervisor'):
+            raise AttributeError(name)
         return self._result.__dict__[name]
-
-    @staticmethod
-    def set_maxthreads(n):
-        with Threaded.pool_sema:
-            Threaded.pool_sema = threading.BoundedSemaphore(n)
-
@@ -0,0 +1,179 @@
+'''Process-wide registry of loaded recipe plugins.
+
+Loading a recipe opens its shared library, builds the plugin list and runs
+the initialization function of the plugin. The registry keeps the
+initialized plugins, so that :class:`cpl.Recipe` objects for the same recipe
+share one plugin handle. Parameter values and calibration frames are kept in
+the :class:`cpl.Recipe` objects and are not shared.
+'''
+from __future__ import absolute_import
+import os
+import threading
+
+from . import CPL_recipe
+from .frames import read_frameconfig
+from .param import ParameterSchema
+
+class Plugin(object):
+    '''Initialized recipe plugin.
+
+    .. attribute:: filename
+
+       Shared library file name.
+
+    .. attribute:: name
+
+       Recipe name.
+
+    .. attribute:: recipe
+
+       The raw :class:`CPL_recipe.recipe` handle.
+    '''
+    def __init__(self, filename, name):
+        self.filename = filename
+        self.name = name
+        self.recipe = CPL_recipe.recipe(filename, name)
+        self._frameconfig = None
+        self._params = None
+        self._forkserver = None
+        self._lock = threading.Lock()
+
+    @property
+    def params(self):
+        '''Parameter definitions of the recipe as
+        :class:`cpl.param.ParameterSchema`. They are read from the recipe
+        only once.'''
+        if self._params is None:
+            self._params = ParameterSchema(self.recipe.params())
+        return self._params
+
+    def _read_frameconfig(self):
+        if self._frameconfig is None:
+            self._frameconfig = read_frameconfig(self.recipe.frameConfig())
+        return self._frameconfig
+
+    @property
+    def tags(self):
+        '''Tuple of the raw input tags, or :obj:`None` if the recipe does
+        not provide this information.'''
+        return self._read_frameconfig()[0]
+
+    @property
+    def frameconfig(self):
+        '''Frame configuration as :class:`dict` mapping each raw input tag
+        to a :class:`cpl.frames.RawConfig`, or :obj:`None` if the recipe
+        does not provide this information. The frame configuration is read
+        from the recipe only once; the returned object must not be
+        modified.'''
+        return self._read_frameconfig()[1]
+
+    @property
+    def calib(self):
+        '''Tuple of (tag, min, max) triples for all calibration tags, or
+        :obj:`None` if the recipe does not provide this information.'''
+        return self._read_frameconfig()[2]
+
+    def forkserver(self, env = None):
+        '''Return the :class:`cpl.forkserver.ForkServer` of the plugin.
+
+        The fork server is started on the first call, and restarted if its
+        process died.
+
+        :param env: Additional environment variables for the fork server
+            (optional). They are only used when the server is started.
+        :type env: :class:`dict`
+        '''
+        from .forkserver import ForkServer
+        with self._lock:
+            if self._forkserver is None or not self._forkserver.alive():
+                self._forkserver = ForkServer(self.filename, self.name, env)
+            return self._forkserver
+
+    @property
+    def version(self):
+        '''Pair (versionnumber, versionstring) of the recipe.'''
+        return self.recipe.version()
+
+    def __repr__(self):
+        return 'Plugin(%s, %s, version = %s)' % (
+            repr(self.filename), repr(self.name), repr(self.version[0]))
+
+class Registry(object):
+    '''Registry of initialized recipe plugins.
+
+    The plugins are keyed on the real path of the shared library and the
+    recipe name, which also determines the recipe version. If the library
+    file changed since the plugin was loaded, the plugin is loaded again.
+
+    Evicting a plugin removes it from the registry. It is deinitialized and
+    its library is unloaded as soon as the last :class:`cpl.Recipe` that uses
+    it is deleted.
+    '''
+
+    def __init__(self):
+        self._plugins = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stat(filename):
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def get(self, filename, name):
+        '''Return the plugin for a recipe in a shared library.
+
+        The plugin is loaded and initialized if it is not yet in the
+        registry.
+
+        :param filename: Shared library file name.
+        :type filename: :class:`str`
+        :param name: Recipe name.
+        :type name: :class:`str`
+        :rtype: :class:`Plugin`
+        '''
+        path = os.path.realpath(filename)
+        try:
+            stat = self._stat(path)
+        except OSError:
+            return Plugin(filename, name)
+        with self._lock:
+            entry = self._plugins.get((path, name))
+            if entry is not None and entry[0] == stat:
+                return entry[1]
+            plugin = Plugin(filename, name)
+            self._plugins[(path, name)] = (stat, plugin)
+            return plugin
+
+    def evict(self, name = None, filename = None, version = None):
+        '''Remove plugins from the registry.
+
+        :param name: Recipe name. Optional; if not set, plugins of all
+            recipes are removed.
+        :type name: :class:`str`
+        :param filename: Shared library file name. Optional.
+        :type filename: :class:`str`
+        :param version: Version number or string. Optional.
+        :type version: :class:`int` or :class:`str`
+        :return: The number of removed plugins.
+        '''
+        path = os.path.realpath(filename) if filename else None
+        with self._lock:
+            keys = [ key for key, (stat, plugin) in self._plugins.items()
+                     if (name is None or key[1] == name)
+                     and (path is None or key[0] == path)
+                     and (version is None or version in plugin.version) ]
+            for key in keys:
+                del self._plugins[key]
+            return len(keys)
+
+    def clear(self):
+        '''Remove all plugins from the registry.'''
+        with self._lock:
+            self._plugins.clear()
+
+    def __iter__(self):
+        with self._lock:
+            return iter([ plugin for stat, plugin in self._plugins.values() ])
+
+    def __len__(self):
+        return len(self._plugins)
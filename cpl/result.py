@@ -3,11 +3,11 @@ import os
 import signal
 import logging
 
-from astropy.io import fits
+from .frames import is_hdulist
 
 class Result(object):
     def __init__(self, directory, res, input_len = 0, logger = None, 
-                 output_format = fits.HDUList):
+                 output_format = None, timeline = None, max_idle = None):
         '''Build an object containing all result frames.
 
         Calling :meth:`cpl.Recipe.__call__` returns an object that contains
@@ -15,7 +15,7 @@ class Result(object):
         tag are summarized in one attribute of the same name. 
 
         If the argument `output_format` is :class:`astropy.io.fits.HDUList`
-        (default), then the attribute content is either a
+        or :obj:`None` (default), then the attribute content is either a
         :class:`astropy.io.fits.HDUList` or a class:`list` of HDU lists,
         depending on the recipe and the call: If the recipe produces one out
         put frame of a tag per input file, the attribute contains a list if
@@ -30,6 +30,11 @@ class Result(object):
         :class:`str`, containing the paths of output files. In this case,
         removing the output files is suppressed.
 
+        The optional `timeline` contains the samples of the memory and CPU
+        usage of the recipe process (see :mod:`cpl.timeline`). If the call
+        was watched for stalls, `max_idle` is the longest time in seconds
+        without log messages and CPU progress.
+
         .. todo:: This behaviour is made on some heuristics based on the
            number and type of the input frames. The heuristics will go wrong
            if there is only one input frame, specified as a list, but the
@@ -43,12 +48,14 @@ class Result(object):
            anyway. So, we will skip this to probably some distant future.
         '''
         self.dir = os.path.abspath(directory)
+        if output_format is not str:
+            from astropy.io import fits
         logger.join()
         if res[2][0]:
             raise CplError(res[2][0], res[1], logger)
         self.tags = set()
         for tag, frame in res[0]:
-            if (output_format == fits.HDUList): 
+            if output_format is not str:
                 # Move the file to the base dir to avoid NFS problems
                 outframe = os.path.join(
                     os.path.dirname(self.dir), 
@@ -56,7 +63,7 @@ class Result(object):
                 os.rename(os.path.join(self.dir, frame), outframe)
             else:
                 outframe = os.path.join(self.dir, frame)
-            if output_format == fits.HDUList:
+            if output_format is not str:
                 hdulist = fits.open(outframe, memmap = True, mode = 'update')
                 hdulist.readall()
                 os.remove(outframe)
@@ -66,7 +73,8 @@ class Result(object):
                 self.__dict__[tag] = outframe if input_len != 1 \
                     else [ outframe ]
                 self.tags.add(tag)
-            elif isinstance(self.__dict__[tag], (fits.HDUList, str)):
+            elif is_hdulist(self.__dict__[tag]) \
+                    or isinstance(self.__dict__[tag], str):
                 self.__dict__[tag] = [ self.__dict__[tag], outframe ]
             else:
                 self.__dict__[tag].append(outframe)
@@ -77,7 +85,7 @@ class Result(object):
                 mtrace = os.popen("mtrace %s" % mtracefname).read();
             except:
                 mtrace = None
-        self.stat = Stat(res[2], mtrace)
+        self.stat = Stat(res[2], mtrace, timeline, max_idle)
         self.error = CplError(res[2][0], res[1], logger) if res[1] else None
         self.log = logger.entries if logger else None
 
@@ -97,12 +105,22 @@ class Result(object):
         return iter((key, self.__dict__[key]) for key in self.tags)
 
 class Stat(object):
-    def __init__(self, stat, mtrace):
+    def __init__(self, stat, mtrace, timeline = None, max_idle = None,
+                 stalled = False):
         self.return_code = stat[0]
         self.user_time = stat[1]
         self.sys_time = stat[2]
         self.memory_is_empty = { -1:None, 0:False, 1:True }[stat[3]]
+        usage = [ v if v >= 0 else None for v in stat[4:14] ]
+        usage += [ None ] * (10 - len(usage))
+        (self.max_rss, self.wall_time, self.minor_faults, self.major_faults,
+         self.voluntary_switches, self.involuntary_switches,
+         self.bytes_read, self.bytes_written,
+         self.disk_read, self.disk_written) = usage
         self.mtrace = mtrace;
+        self.timeline = timeline
+        self.max_idle = max_idle
+        self.stalled = stalled
 
 class CplError(Exception):
     '''Error message from the recipe.
@@ -348,3 +366,111 @@ class RecipeCrash(Exception):
         s += RecipeCrash.signals.get(self.signal, '%s: Unknown' % str(self.signal))
         return s
 
+
+class RecipeTimeout(Exception):
+    '''Recipe timeout exception
+
+    If the recipe does not finish within the time given by
+    :attr:`cpl.Recipe.timeout`, its process group is killed and this
+    exception is raised.
+
+    The exception is raised on recipe invocation, or when accessing the result
+    frames if the recipe was started in background
+    (:attr:`cpl.Recipe.threaded` set to :obj:`True`).
+
+    Attributes:
+
+    .. attribute:: timeout
+
+       The timeout in seconds.
+
+    .. attribute:: log
+
+       Log lines of the recipe until it was killed.
+
+       .. seealso:: :class:`cpl.logger.LogList`
+    '''
+    def __init__(self, timeout, logger = None):
+        self.timeout = timeout
+        self.log = logger.entries if logger else None
+        Exception.__init__(self, 'Recipe exceeded the timeout of %g s'
+                           % timeout)
+
+    def __repr__(self):
+        return 'RecipeTimeout(%s)' % repr(self.timeout)
+
+class RecipeKilled(Exception):
+    '''Recipe killed exception
+
+    This exception is raised if the recipe process was terminated by a
+    signal that it did not handle: when it exceeded its
+    :attr:`cpl.Recipe.max_cpu_time`, when it was killed by the kernel
+    because the system ran out of memory, or when the call was cancelled
+    with :meth:`cpl.recipe.Threaded.cancel()`. Crashes of the recipe itself
+    raise a :class:`cpl.RecipeCrash` instead.
+
+    Attributes:
+
+    .. attribute:: signal
+
+       Signal that terminated the process.
+
+    .. attribute:: reason
+
+       Description of the reason, if known.
+
+    .. attribute:: log
+
+       Log lines of the recipe until it was killed.
+
+       .. seealso:: :class:`cpl.logger.LogList`
+    '''
+    reasons = {signal.SIGXCPU:'CPU time limit exceeded',
+               signal.SIGKILL:'Killed'}
+
+    def __init__(self, sig, reason = None, logger = None):
+        self.signal = sig
+        self.reason = reason or RecipeKilled.reasons.get(sig)
+        self.log = logger.entries if logger else None
+        Exception.__init__(self, 'Recipe killed by signal %i%s' % (
+            sig, ' (%s)' % self.reason if self.reason else ''))
+
+    def __repr__(self):
+        return 'RecipeKilled(%i)' % self.signal
+
+class RecipeStalled(RecipeTimeout):
+    '''Recipe stall exception
+
+    If the recipe neither writes a log message nor uses CPU time for the
+    time given by :attr:`cpl.Recipe.stall_timeout`, it is considered to be
+    hanging. Its process group is killed and this exception is raised. Since
+    it is a subclass of :class:`cpl.RecipeTimeout`, it is also caught by
+    handlers of timeouts.
+
+    Attributes:
+
+    .. attribute:: timeout
+
+       The stall timeout in seconds.
+
+    .. attribute:: stat
+
+       Resource usage of the killed process as :class:`cpl.result.Stat`,
+       with :attr:`stalled` set to :obj:`True`. The return code is
+       :obj:`None`, and the I/O counters are not available.
+
+    .. attribute:: log
+
+       Log lines of the recipe until it was killed.
+
+       .. seealso:: :class:`cpl.logger.LogList`
+    '''
+    def __init__(self, timeout, stat = None, logger = None):
+        self.timeout = timeout
+        self.stat = stat
+        self.log = logger.entries if logger else None
+        Exception.__init__(self, 'Recipe stalled for more than %g s'
+                           % timeout)
+
+    def __repr__(self):
+        return 'RecipeStalled(%s)' % repr(self.timeout)
@@ -0,0 +1,301 @@
+'''Admission of parallel recipe calls by their CPU and memory demand.
+
+Many recipes are parallelized internally with OpenMP. If several of them run
+at the same time, the number of threads easily exceeds the number of CPUs,
+and the throughput drops because of the oversubscription. A
+:class:`Scheduler` counts CPUs instead of processes: each call requests as
+many CPUs as given by its ``OMP_NUM_THREADS`` environment variable, and it
+is started only when enough CPUs are free. The recipe process is then bound
+to its own set of CPUs, disjoint from the sets of the other running calls.
+
+Recipes with a large memory footprint may also trigger the OOM killer if too
+many of them run at once. With a :class:`cpl.history.RunHistory`, the
+scheduler predicts the peak memory of each call from the previous calls of
+the same recipe with similar input size, and starts the call only when the
+predicted memory fits into the memory that is not reserved by running calls.
+'''
+from __future__ import absolute_import
+import collections
+import os
+import threading
+
+from .history import input_size
+
+def available_cpus():
+    '''Return the sorted list of CPU numbers the current process may run on.
+    '''
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return list(range(multiprocessing.cpu_count()))
+
+def available_memory():
+    '''Return the memory in bytes that is available for new processes
+    without swapping.
+    '''
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def omp_threads(runenv):
+    '''Return the number of OpenMP threads requested by an environment.
+
+    :param runenv: Environment changes of the call, as (name, value)
+        pairs. A value of :obj:`None` removes the variable.
+    :type runenv: :class:`list` of :class:`tuple`
+
+    The value of ``OMP_NUM_THREADS`` is taken from `runenv`, or from the
+    environment of the current process if `runenv` does not set it. For
+    nested parallelism, only the first level counts. Returns 1 if the
+    variable is not set or not a positive number.
+    '''
+    value = os.environ.get('OMP_NUM_THREADS')
+    for name, v in runenv:
+        if name == 'OMP_NUM_THREADS':
+            value = v
+    try:
+        return max(1, int(str(value).split(',')[0]))
+    except ValueError:
+        return 1
+
+class _Waiter(object):
+    __slots__ = ('n', 'memory', 'cpus', 'event', 'callback')
+
+    def __init__(self, n, memory, callback = None):
+        self.n = n
+        self.memory = memory
+        self.cpus = None
+        self.event = None if callback else threading.Event()
+        self.callback = callback
+
+    def notify(self):
+        if self.callback is not None:
+            self.callback(self.cpus)
+        else:
+            self.event.set()
+
+class Scheduler(object):
+    '''Scheduler that admits recipe calls while their CPU and memory demand
+    fits into the available resources.
+
+    :param cpus: CPU numbers to distribute. Defaults to the CPUs the
+        current process may run on.
+    :type cpus: :class:`list` of :class:`int`
+    :param history: History of the previous calls. If set, the peak memory
+        of each call is recorded, and calls are admitted only if their
+        predicted memory fits. Otherwise, the memory is not checked.
+    :type history: :class:`cpl.history.RunHistory`
+    :param memory: Memory in bytes to distribute. Defaults to the memory
+        that is available at the time a call is admitted.
+    :type memory: :class:`int`
+    :param margin: Fraction of the memory that is kept free as safety
+        margin.
+    :type margin: :class:`float`
+
+    The scheduler is used by setting it as :attr:`cpl.Recipe.scheduler`
+    attribute or as `scheduler` parameter of the recipe call::
+
+      >>> muse_scibasic.scheduler = cpl.scheduler.Scheduler()
+      >>> muse_scibasic.env['OMP_NUM_THREADS'] = 4
+      >>> muse_scibasic.threaded = True
+      >>> results = [ muse_scibasic(f) for f in exposures ]
+
+    Calls are admitted in the order they arrive; a call that does not fit
+    waits, and the later calls wait behind it. A call that requests more
+    CPUs than the scheduler has gets all of them.
+
+    .. note::
+
+       Calls without ``OMP_NUM_THREADS`` request one CPU. Since the recipe
+       process is bound to this CPU, an OpenMP parallelized recipe then
+       effectively runs with a single thread. Set ``OMP_NUM_THREADS`` in
+       :attr:`cpl.Recipe.env` to give it more CPUs.
+
+    To limit the memory as well, give a history::
+
+      >>> cpl.Recipe.scheduler = cpl.scheduler.Scheduler(
+      ...     history = cpl.history.RunHistory(), margin = 0.2)
+
+    Without a fixed `memory`, the memory that is free for a call is the
+    ``MemAvailable`` value of :file:`/proc/meminfo` at the time of the
+    admission, reduced by the margin and by the predicted memory of all
+    running calls. Since the running calls already use a part of their
+    prediction, this is on the safe side.
+
+    .. note::
+
+       The memory demand of a recipe that was never recorded is unknown.
+       Such a call reserves all memory, so that it runs alone. Once the
+       first call of the recipe has finished, its memory is known, and
+       the following calls run in parallel again. A call that is predicted
+       to need more than the scheduler's memory is started when no other
+       call is running.
+    '''
+
+    def __init__(self, cpus = None, history = None, memory = None,
+                 margin = 0.1):
+        self.cpus = sorted(set(available_cpus() if cpus is None else cpus))
+        if not self.cpus:
+            raise ValueError('No CPUs to schedule')
+        self.history = history
+        self.margin = margin
+        '''Fraction of the memory that is kept free as safety margin.'''
+        self._memory = memory
+        self._free = list(self.cpus)
+        self._reserved = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def free(self):
+        '''Number of CPUs that are currently not assigned to a call.'''
+        return len(self._free)
+
+    @property
+    def memory(self):
+        '''Memory in bytes that is distributed among the calls, without the
+        margin. If no memory was given, this is the memory that is
+        currently available, and 0 without a history.'''
+        if self._memory is not None:
+            memory = self._memory
+        elif self.history is not None:
+            memory = available_memory()
+        else:
+            memory = 0
+        return int(memory * (1.0 - self.margin))
+
+    @property
+    def free_memory(self):
+        '''Memory in bytes that is currently not reserved by a call.'''
+        return self.memory - self._reserved
+
+    def demand(self, runenv):
+        '''Return the number of CPUs requested by a call with the
+        environment changes `runenv`, limited to the number of CPUs of the
+        scheduler.'''
+        return min(omp_threads(runenv), len(self.cpus))
+
+    def memory_demand(self, recipe, framelist):
+        '''Return the predicted peak memory in bytes of a call of a
+        :class:`cpl.Recipe` with the input files `framelist`, limited to
+        the memory of the scheduler. Returns 0 if the scheduler has no
+        history.'''
+        if self.history is None:
+            return 0
+        memory = self.history.predict(recipe.__name__, recipe.version[0],
+                                      input_size(framelist))
+        limit = self.memory
+        return limit if memory is None else min(memory, limit)
+
+    def record(self, recipe, framelist, stats):
+        '''Record the peak memory of a finished call of a
+        :class:`cpl.Recipe` in the history.
+
+        :param stats: Statistics tuple of the call, as returned by
+            :meth:`CPL_recipe.recipe.run()`.
+        '''
+        if self.history is not None and len(stats) > 4 and stats[4] >= 0:
+            self.history.record(recipe.__name__, recipe.version[0],
+                                input_size(framelist), stats[4])
+
+    def acquire(self, n = 1, memory = 0):
+        '''Wait until `n` CPUs and `memory` bytes are free, and return the
+        CPUs.
+
+        :param n: Number of CPUs.
+        :type n: :class:`int`
+        :param memory: Memory in bytes.
+        :type memory: :class:`int`
+        :return: The CPU numbers assigned to the caller. They have to be
+            given back with :meth:`release()`, together with the memory.
+        :rtype: :class:`list` of :class:`int`
+        '''
+        with self._lock:
+            cpus = self._take(n, memory)
+            if cpus is not None:
+                return cpus
+            waiter = _Waiter(self._limit(n), memory)
+            self._waiters.append(waiter)
+        waiter.event.wait()
+        return waiter.cpus
+
+    def acquire_callback(self, n, callback, memory = 0):
+        '''Assign `n` CPUs and `memory` bytes without blocking.
+
+        If the CPUs are free, they are returned immediately. Otherwise,
+        :obj:`None` is returned, and `callback` is called with the list of
+        CPUs as soon as they are assigned, from the thread that released
+        them. The returned waiter handle can be passed to :meth:`cancel()`.
+
+        :return: (cpus, waiter) pair where exactly one is :obj:`None`.
+        '''
+        with self._lock:
+            cpus = self._take(n, memory)
+            if cpus is not None:
+                return cpus, None
+            waiter = _Waiter(self._limit(n), memory, callback)
+            self._waiters.append(waiter)
+            return None, waiter
+
+    def cancel(self, waiter):
+        '''Withdraw a waiting request from :meth:`acquire_callback()`.
+
+        :return: :obj:`True` if the request was still waiting. Otherwise,
+            the CPUs were already passed to the callback.
+        '''
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                return False
+            granted = self._grant()
+        for w in granted:
+            w.notify()
+        return True
+
+    def release(self, cpus, memory = 0):
+        '''Give back CPUs and memory that were assigned by :meth:`acquire()`,
+        and admit waiting calls.'''
+        with self._lock:
+            self._free.extend(cpus)
+            self._reserved -= memory
+            self._free.sort()
+            granted = self._grant()
+        for waiter in granted:
+            waiter.notify()
+
+    def _limit(self, n):
+        return max(1, min(n, len(self.cpus)))
+
+    def _fits(self, n, memory):
+        return len(self._free) >= n and \
+            (self._reserved == 0 or memory <= self.free_memory)
+
+    def _take(self, n, memory):
+        n = self._limit(n)
+        if self._waiters or not self._fits(n, memory):
+            return None
+        cpus, self._free = self._free[:n], self._free[n:]
+        self._reserved += memory
+        return cpus
+
+    def _grant(self):
+        granted = list()
+        while self._waiters and self._fits(self._waiters[0].n,
+                                           self._waiters[0].memory):
+            waiter = self._waiters.popleft()
+            waiter.cpus, self._free = (self._free[:waiter.n],
+                                       self._free[waiter.n:])
+            self._reserved += waiter.memory
+            granted.append(waiter)
+        return granted
+
+    def __repr__(self):
+        return 'Scheduler(%s, free = %i, free_memory = %i)' % (
+            repr(self.cpus), self.free, self.free_memory)
@@ -0,0 +1,466 @@
+'''Staging of :class:`astropy.io.fits.HDUList` inputs in memory or in a
+shared cache.
+
+A recipe can read its input frames only from files. By default,
+:class:`astropy.io.fits.HDUList` inputs are written into the output
+directory of the call, which is often on a network file system. A
+:class:`MemoryStaging` writes them into memory instead:
+
+- If the recipe is executed directly, each HDU list is written into an
+  anonymous file created with :func:`os.memfd_create()`. The forked recipe
+  process inherits the file descriptor, and the recipe gets the file name
+  :file:`/proc/self/fd/{N}`.
+
+- Otherwise, or if anonymous files are not supported, the HDU list is
+  written into a file in :file:`/dev/shm`, which is removed after the call.
+
+If neither is available, the files are written into the fallback directory.
+
+A :class:`StagingCache` keeps the files of HDU lists across calls, so that
+a calibration frame that is used for many calls is written only once.
+
+A HDU list that was opened from a file and not changed is not staged at
+all; the recipe gets the name of the original file (see
+:func:`original_file()`).
+
+A HDU list that was opened from a file and where only headers were changed
+(f.e. to patch a keyword of a calibration frame) is not serialized by
+:mod:`astropy.io.fits`: the new headers are written, and the unchanged data
+units are copied from the original file within the kernel (see
+:func:`write_hdulist()`).
+'''
+from __future__ import absolute_import
+import collections
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from .md5sum import block_size, data_size
+
+# Errors of a copy method that is not supported for the file pair.
+_unsupported = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                errno.EBADF, errno.ESPIPE)
+
+_max_count = 1 << 30
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str, )
+
+# Private attributes of the HDUs and their headers in astropy.io.fits that
+# are used to find the data units in the file. If a version of astropy does
+# not have them, the HDU lists are always written with writeto().
+_hdu_attributes = ('_file', '_data_loaded', '_data_size', '_data_offset',
+                   '_header_offset')
+_header_attributes = ('_modified', )
+
+def _has_private_api(hdulist):
+    try:
+        return all(hasattr(hdu, a) for hdu in hdulist
+                   for a in _hdu_attributes) \
+            and all(hasattr(hdu.header, a) for hdu in hdulist
+                    for a in _header_attributes)
+    except Exception:
+        return False
+
+def _copy_file_range(src, dst, offset, count):
+    return os.copy_file_range(src, dst, min(count, _max_count), offset)
+
+def _sendfile(src, dst, offset, count):
+    return os.sendfile(dst, src, offset, min(count, _max_count))
+
+def _pread(src, dst, offset, count):
+    data = os.pread(src, min(count, 1 << 22), offset)
+    _write(dst, data)
+    return len(data)
+
+_copy_methods = [ method for name, method in (
+    ('copy_file_range', _copy_file_range), ('sendfile', _sendfile),
+    ('pread', _pread)) if hasattr(os, name) ]
+
+def _write(fd, data):
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+def _copy(src, dst, offset, size):
+    '''Copy `size` bytes at `offset` of the file descriptor `src` to the
+    current position of `dst`, and return the number of bytes copied, which
+    is smaller than `size` at the end of the file. Copies are done in the
+    kernel where possible; file systems that support it share the blocks
+    instead of copying them.'''
+    done = 0
+    for method in _copy_methods:
+        try:
+            while done < size:
+                n = method(src, dst, offset + done, size - done)
+                if n == 0:
+                    return done
+                done += n
+            return done
+        except OSError as e:
+            if e.errno not in _unsupported:
+                raise
+    return done
+
+def data_layout(hdulist):
+    '''Check whether the data units of a HDU list are unchanged parts of a
+    file.
+
+    This is the case if the HDU list was opened from an uncompressed FITS
+    file that is still open, no HDU was added, and the data of the HDUs was
+    not accessed. The headers may be changed as long as the size of the
+    data units stays the same.
+
+    This relies on private attributes of :mod:`astropy.io.fits`. If they
+    are not available, :obj:`None` is returned.
+
+    :return: The file name and the list of (offset, size) pairs of the data
+        units for all HDUs, with the size without padding, or :obj:`None`.
+    '''
+    if not _copy_methods or not _has_private_api(hdulist):
+        return None
+    from astropy.io import fits
+    f = getattr(hdulist, '_file', None)
+    name = getattr(f, 'name', None)
+    if f is None or getattr(f, 'closed', True) \
+            or getattr(f, 'compression', None) \
+            or not isinstance(name, _string_types) \
+            or not os.path.isfile(name):
+        return None
+    units = list()
+    try:
+        for i, hdu in enumerate(hdulist):
+            if isinstance(hdu, fits.CompImageHDU) \
+                    or isinstance(hdu, fits.PrimaryHDU) != (i == 0) \
+                    or hdu._file is not f:
+                return None
+            size = data_size(hdu.header, False)
+            if size == 0:
+                units.append((0, 0))
+                continue
+            if hdu._data_loaded \
+                    or hdu._data_size != size + -size % block_size:
+                return None
+            units.append((hdu._data_offset, size))
+    except (AttributeError, KeyError, ValueError):
+        return None
+    return name, units
+
+def original_file(hdulist):
+    '''Return the absolute name of the file a HDU list was opened from, if
+    the HDU list is unchanged.
+
+    In addition to the conditions of :func:`data_layout()`, no header may be
+    modified, and no HDU may be removed. Otherwise, :obj:`None` is
+    returned.
+    '''
+    layout = data_layout(hdulist)
+    if layout is None:
+        return None
+    name = layout[0]
+    offset = 0
+    try:
+        for hdu, (data_offset, size) in zip(hdulist, layout[1]):
+            if hdu._header_offset != offset or hdu.header._modified:
+                return None
+            offset = hdu._data_offset + size + -size % block_size
+    except AttributeError:
+        return None
+    if offset < os.path.getsize(name):
+        return None
+    return os.path.abspath(name)
+
+def write_hdulist(hdulist, f, layout = None):
+    '''Write a HDU list into a binary file.
+
+    If the data units are unchanged parts of a file (see
+    :func:`data_layout()`), only the headers are serialized, and the data
+    units are copied from the original file with
+    :func:`os.copy_file_range()` or :func:`os.sendfile()`. Otherwise, the
+    HDU list is written with :meth:`astropy.io.fits.HDUList.writeto()`.
+
+    :param f: File object, opened for binary writing.
+    :param layout: The result of :func:`data_layout()`, if already known.
+    '''
+    layout = layout or data_layout(hdulist)
+    if layout is None:
+        hdulist.writeto(f)
+        return
+    filename, units = layout
+    f.flush()
+    dst = f.fileno()
+    with open(filename, 'rb') as src:
+        for hdu, (offset, size) in zip(hdulist, units):
+            _write(dst, hdu.header.tostring().encode('ascii'))
+            size += -size % block_size
+            n = _copy(src.fileno(), dst, offset, size)
+            if n < size:
+                _write(dst, b'\0' * (size - n))
+
+def shm_dir():
+    '''Return the directory of the shared memory file system, or
+    :obj:`None` if there is none that is writable.'''
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+class MemoryStaging(object):
+    '''Memory files for the :class:`astropy.io.fits.HDUList` inputs of one
+    recipe call.
+
+    :param fallback_dir: Directory for the files if there is no shared
+        memory file system.
+    :type fallback_dir: :class:`str`
+    :param inherit: Flag whether the recipe process is forked from the
+        current process, so that it inherits the file descriptors.
+    :type inherit: :class:`bool`
+    '''
+
+    def __init__(self, fallback_dir, inherit = True):
+        self.inherit = inherit and hasattr(os, 'memfd_create')
+        self.dir = shm_dir() or fallback_dir
+        self._fds = list()
+        self._files = list()
+
+    def stage(self, hdulist, name):
+        '''Write a HDU list into memory.
+
+        :param hdulist: The HDU list.
+        :type hdulist: :class:`astropy.io.fits.HDUList`
+        :param name: Name of the file, used for the memory file and as
+            suffix of the file in the shared memory file system.
+        :type name: :class:`str`
+        :return: The absolute file name to be passed to the recipe.
+        '''
+        if self.inherit:
+            try:
+                fd = os.memfd_create(name)
+            except OSError:
+                self.inherit = False
+            else:
+                self._fds.append(fd)
+                with os.fdopen(os.dup(fd), 'wb') as f:
+                    write_hdulist(hdulist, f)
+                return '/proc/self/fd/%i' % fd
+        tmphdl, filename = tempfile.mkstemp(dir = self.dir, prefix = 'cpl-',
+                                            suffix = '_' + name)
+        self._files.append(filename)
+        with os.fdopen(tmphdl, 'wb') as f:
+            write_hdulist(hdulist, f)
+        return os.path.abspath(filename)
+
+    def close(self):
+        '''Release the memory of all staged HDU lists.'''
+        for fd in self._fds:
+            os.close(fd)
+        for filename in self._files:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self._fds = list()
+        self._files = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class _Entry(object):
+    __slots__ = ('filename', 'size', 'refs', 'ready', 'error')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = 0
+        self.refs = 1
+        self.ready = threading.Event()
+        self.error = None
+
+def content_key(hdulist):
+    '''Return the key of a HDU list in a :class:`StagingCache`.
+
+    The key is a hash of all headers. Since the ``DATAMD5`` keyword of the
+    primary header is set to the checksum of the data before the HDU list
+    is staged (see :func:`cpl.md5sum.update_md5()`), it covers the data as
+    well. The checksum is the same whether the data of a HDU list opened
+    from a file was accessed or not, so the key is as well.
+    '''
+    key = hashlib.sha1()
+    for hdu in hdulist:
+        key.update(hdu.header.tostring().encode('ascii', 'replace'))
+    return key.hexdigest()
+
+class StagingCache(object):
+    '''Cache of the files of :class:`astropy.io.fits.HDUList` inputs,
+    shared between recipe calls.
+
+    :param directory: Directory where the cache directory is created.
+        Defaults to the shared memory file system if available, and to the
+        default temporary directory otherwise.
+    :type directory: :class:`str`
+    :param max_size: Total size in bytes of the files that are kept when
+        they are not used by a running call.
+    :type max_size: :class:`int`
+
+    The files are identified by the content of the HDU list (see
+    :func:`content_key()`). A HDU list is written at its first use; later
+    calls with the same content, even from another HDU list object, get the
+    name of the existing file. Files that are in use by a running call are
+    never removed. Unused files are removed, least recently used first, as
+    soon as the total size exceeds `max_size`.
+
+    The cache is used by setting it as :attr:`cpl.Recipe.staging_cache`
+    attribute or as `staging_cache` parameter of the recipe call::
+
+      >>> cpl.Recipe.staging_cache = cpl.staging.StagingCache()
+      >>> muse_scibasic.calib.MASTER_BIAS = patched_bias
+      >>> results = [ muse_scibasic(f) for f in exposures ]
+
+    The cache directory is removed with :meth:`close()`, or when the cache
+    is used as a context manager and the ``with`` block is left.
+    '''
+
+    def __init__(self, directory = None, max_size = 2**30):
+        self.dir = tempfile.mkdtemp(
+            dir = directory or shm_dir() or tempfile.gettempdir(),
+            prefix = 'cpl-staging-')
+        self.max_size = max_size
+        self.hits = 0
+        '''Number of HDU lists that were found in the cache.'''
+        self.misses = 0
+        '''Number of HDU lists that were written into the cache.'''
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        '''Total size in bytes of the cached files.'''
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def acquire(self, hdulist):
+        '''Return the name of the file with the content of a HDU list, and
+        write it if it is not cached yet. The file is kept until it is
+        given back with :meth:`release()`.
+
+        :return: The (key, filename) pair.
+        '''
+        key = content_key(hdulist)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            created = entry is None
+            if created:
+                entry = _Entry(os.path.join(self.dir, key + '.fits'))
+                self.misses += 1
+            else:
+                entry.refs += 1
+                self.hits += 1
+            self._entries[key] = entry
+        if not created:
+            entry.ready.wait()
+            if entry.error is not None:
+                # The creator already removed the entry, and the key may
+                # now belong to a new entry; only this one is released.
+                with self._lock:
+                    entry.refs -= 1
+                raise entry.error
+            return key, entry.filename
+        tmphdl, tmpname = tempfile.mkstemp(dir = self.dir, suffix = '.part')
+        try:
+            with os.fdopen(tmphdl, 'wb') as f:
+                write_hdulist(hdulist, f)
+            os.rename(tmpname, entry.filename)
+            entry.size = os.path.getsize(entry.filename)
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+        finally:
+            entry.ready.set()
+        with self._lock:
+            self._size += entry.size
+        return key, entry.filename
+
+    def release(self, key):
+        '''Give back a file that was returned by :meth:`acquire()`, and
+        remove unused files if the cache is too large.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refs -= 1
+        self._evict(self.max_size)
+
+    def _evict(self, max_size):
+        evicted = list()
+        with self._lock:
+            for key in list(self._entries):
+                if self._size <= max_size:
+                    break
+                entry = self._entries[key]
+                if entry.refs == 0:
+                    del self._entries[key]
+                    self._size -= entry.size
+                    evicted.append(entry.filename)
+        for filename in evicted:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def lease(self):
+        '''Return a staging object for one recipe call. All files it staged
+        are released when it is closed.'''
+        return _Lease(self)
+
+    def clear(self):
+        '''Remove all files that are not in use.'''
+        self._evict(0)
+
+    def close(self):
+        '''Remove the cache directory with all files.'''
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        shutil.rmtree(self.dir, ignore_errors = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return 'StagingCache(%s, %i files, size = %i)' % (
+            repr(self.dir), len(self), self.size)
+
+class _Lease(object):
+    '''Files of a :class:`StagingCache` used by one recipe call.'''
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._keys = list()
+
+    def stage(self, hdulist, name):
+        key, filename = self.cache.acquire(hdulist)
+        self._keys.append(key)
+        return filename
+
+    def close(self):
+        for key in self._keys:
+            self.cache.release(key)
+        self._keys = list()
@@ -0,0 +1,327 @@
+'''Supervision of running recipe processes.
+
+A :class:`Supervisor` starts the recipe with
+:meth:`CPL_recipe.recipe.start()`, usually in its own process group, and
+waits for the result while it
+
+- kills the process group when the wall clock timeout is exceeded,
+- kills the process group when the call is cancelled from another thread,
+- kills the process group when the recipe stalls (see :class:`Watchdog`),
+- samples the memory and CPU usage (see :mod:`cpl.timeline`).
+
+Supervision requires the recipe to be executed directly; calls via a fork
+server or a worker pool cannot be supervised.
+'''
+from __future__ import absolute_import
+import errno
+import fcntl
+import os
+import select
+import signal
+import struct
+import threading
+
+from . import CPL_recipe
+from .result import Stat, RecipeTimeout, RecipeKilled, RecipeStalled
+from .timeline import Sampler, cpu_time, _clock
+
+def usage(rusage, base_rss = 0):
+    '''Convert a :class:`resource.struct_rusage` into the arguments of
+    :func:`CPL_recipe.parse_result()`.
+
+    :param base_rss: Resident set size in bytes that the process inherited
+        at the fork, as returned by :meth:`CPL_recipe.recipe.start()`. It is
+        subtracted from the peak resident set size.
+    '''
+    return (max(0, 1024 * rusage.ru_maxrss - base_rss), rusage.ru_minflt,
+            rusage.ru_majflt, rusage.ru_nvcsw, rusage.ru_nivcsw)
+
+_header = struct.Struct('l')
+
+def complete(data):
+    '''Return :obj:`True` if `data` contains the complete result written by
+    the recipe process. The result starts with its length.'''
+    return len(data) >= _header.size and len(data) >= _header.unpack_from(
+        bytes(data[:_header.size]))[0]
+
+def drain(fd):
+    '''Read all data that is currently available from a file descriptor,
+    without blocking.'''
+    chunks = list()
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            break
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def _exited(pid):
+    '''Check whether a child process exited, without reaping it.'''
+    if not hasattr(os, 'waitid'):
+        return False
+    return os.waitid(os.P_PID, pid,
+                     os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+
+def kill(pid, group = True):
+    '''Kill the process group of a recipe process started with a new process
+    group, or only the process if `group` is :obj:`False`.'''
+    try:
+        if group:
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+class Watchdog(object):
+    '''Detector of a stalled recipe process.
+
+    A recipe that hangs, f.e. in a deadlock inside an OpenMP region, neither
+    writes log messages nor uses CPU time. The watchdog considers the recipe
+    process as making progress whenever a log line is received or its CPU
+    time increases, and as stalled when there was no progress for `window`
+    seconds. A recipe that busy-waits is not detected.
+
+    :param pid: Process id of the recipe.
+    :type pid: :class:`int`
+    :param window: Time without progress in seconds after which the recipe
+        is considered stalled.
+    :type window: :class:`float`
+    :param logger: Receiver of the log messages of the recipe.
+    :type logger: :class:`cpl.logger.LogReceiver`
+    '''
+
+    def __init__(self, pid, window, logger = None):
+        self.pid = pid
+        self.window = window
+        self.logger = logger
+        self.interval = min(max(window / 10.0, 0.01), 1.0)
+        '''Interval in seconds in which :meth:`check()` should be called.'''
+        self.max_idle = 0.0
+        '''Longest observed time without progress in seconds.'''
+        self.stalled = False
+        self._progress = _clock()
+        self._cpu = cpu_time(pid)
+
+    def check(self):
+        '''Check the progress of the recipe.
+
+        :return: :obj:`True` if the recipe is stalled.
+        '''
+        now = _clock()
+        cpu = cpu_time(self.pid)
+        if cpu is None:
+            # The process is exiting.
+            return False
+        if self._cpu is None or cpu > self._cpu:
+            self._cpu = cpu
+            self._progress = now
+        last = self.logger.last_activity if self.logger else None
+        if last is not None and last > self._progress:
+            self._progress = last
+        idle = now - self._progress
+        self.max_idle = max(self.max_idle, idle)
+        self.stalled = idle >= self.window
+        return self.stalled
+
+class Supervisor(object):
+    '''Supervisor of one recipe call.
+
+    :param timeout: Wall clock timeout in seconds, or :obj:`None`.
+    :type timeout: :class:`float`
+    :param sampling: Sampling interval in seconds, or :obj:`None`.
+    :type sampling: :class:`float`
+    :param stall_timeout: Time without log messages and CPU progress in
+        seconds after which the recipe is killed, or :obj:`None`.
+    :type stall_timeout: :class:`float`
+    :param new_group: Start the recipe in a new process group, so that the
+        processes started by the recipe are killed with it. The recipe
+        then does not receive the signals from the terminal, f.e. on
+        Ctrl-C. Otherwise, only the recipe process itself is killed.
+    :type new_group: :class:`bool`
+    '''
+
+    def __init__(self, timeout = None, sampling = None, stall_timeout = None,
+                 new_group = True):
+        self.timeout = timeout
+        self.sampling = sampling
+        self.stall_timeout = stall_timeout
+        self.new_group = new_group
+        self.pid = None
+        self.cancelled = False
+        self.watchdog = None
+        self._start = None
+        self._lock = threading.Lock()
+
+    @property
+    def max_idle(self):
+        '''Longest time without progress in seconds, or :obj:`None` if the
+        recipe was not watched for stalls.'''
+        return self.watchdog.max_idle if self.watchdog else None
+
+    def started(self, pid, logger = None):
+        '''Register the started recipe process. If the call was already
+        cancelled, the process is killed immediately.
+
+        :param logger: Receiver of the log messages, used to detect stalls.
+        '''
+        self._start = _clock()
+        if self.stall_timeout:
+            self.watchdog = Watchdog(pid, self.stall_timeout, logger)
+        with self._lock:
+            self.pid = pid
+            if self.cancelled:
+                self.kill(pid)
+
+    def finished(self):
+        '''Unregister the recipe process before it is reaped.'''
+        with self._lock:
+            self.pid = None
+
+    def cancel(self):
+        '''Cancel the call: kill the recipe process if it is running, or
+        prevent it from being started.
+
+        :return: :obj:`True` if the call was not finished yet.
+        '''
+        with self._lock:
+            if self.cancelled:
+                return True
+            self.cancelled = True
+            if self.pid is not None:
+                self.kill(self.pid)
+                return True
+        return False
+
+    def kill(self, pid):
+        '''Kill the recipe process, together with its process group if it
+        was started in a new one.'''
+        kill(pid, self.new_group)
+
+    def check(self, status, timed_out, rusage = None, base_rss = 0):
+        '''Raise an exception if the recipe process was killed, stalled or
+        timed out.
+
+        :param status: Wait status of the recipe process.
+        :param timed_out: Flag whether the timeout was exceeded.
+        :param rusage: Resource usage of the recipe process, as returned by
+            :func:`os.wait4()`.
+        :param base_rss: Resident set size inherited at the fork.
+        '''
+        if timed_out:
+            raise RecipeTimeout(self.timeout)
+        if self.watchdog is not None and self.watchdog.stalled:
+            stat = None
+            if rusage is not None:
+                u = usage(rusage, base_rss)
+                stat = Stat((None, rusage.ru_utime, rusage.ru_stime, -1, u[0],
+                             _clock() - self._start) + u[1:], None,
+                            max_idle = self.watchdog.max_idle, stalled = True)
+            raise RecipeStalled(self.stall_timeout, stat)
+        if os.WIFSIGNALED(status):
+            sig = os.WTERMSIG(status)
+            raise RecipeKilled(sig, 'Cancelled' if self.cancelled and
+                               sig == signal.SIGKILL else None)
+
+    def run(self, runner, args, logger = None):
+        '''Execute a recipe and wait for the result.
+
+        :param runner: Raw recipe with a :meth:`CPL_recipe.recipe.start()`
+            method.
+        :param args: Arguments of :meth:`CPL_recipe.recipe.run()` up to
+            the CPU time limit.
+        :param logger: Receiver of the log messages, used to detect stalls.
+        :return: The (result, timeline) pair, where result is the same as
+            returned by :meth:`CPL_recipe.recipe.run()`, and timeline is
+            :obj:`None` if no sampling interval was given.
+        :raise: :exc:`cpl.RecipeTimeout` if the timeout was exceeded.
+        :raise: :exc:`cpl.RecipeStalled` if the recipe stalled.
+        :raise: :exc:`cpl.RecipeKilled` if the process was terminated by
+            a signal, or the call was cancelled.
+        '''
+        if self.cancelled:
+            raise RecipeKilled(signal.SIGKILL, 'Cancelled')
+        pid, fd, base_rss = runner.start(*(tuple(args)
+                                           + (int(self.new_group), )))
+        self.started(pid, logger)
+        watchdog = self.watchdog
+        sampler = Sampler(pid) if self.sampling else None
+        start = _clock()
+        timed_out = False
+        data = bytearray()
+        pidfd = None
+        try:
+            try:
+                if hasattr(os, 'pidfd_open'):
+                    try:
+                        pidfd = os.pidfd_open(pid)
+                    except OSError:
+                        pass
+                fds = [ fd ] if pidfd is None else [ fd, pidfd ]
+                deadline = start + self.timeout if self.timeout else None
+                next_sample = start if sampler else None
+                next_check = start + watchdog.interval if watchdog else None
+                while not complete(data):
+                    now = _clock()
+                    if deadline is not None and now >= deadline:
+                        timed_out = True
+                        self.kill(pid)
+                        break
+                    if next_check is not None and now >= next_check:
+                        if watchdog.check():
+                            self.kill(pid)
+                            break
+                        next_check += watchdog.interval
+                    if next_sample is not None and now >= next_sample:
+                        sampler.sample()
+                        next_sample += self.sampling
+                    # Without a pidfd, poll for the exit of the process
+                    wakeups = [ t for t in (deadline, next_sample, next_check,
+                                            now + 0.5 if pidfd is None
+                                            else None) if t is not None ]
+                    try:
+                        ready = select.select(
+                            fds, [], [], max(0, min(wakeups) - now)
+                            if wakeups else None)[0]
+                    except (select.error, OSError) as e:
+                        if e.args[0] != errno.EINTR:
+                            raise
+                        continue
+                    if fd in ready:
+                        chunk = os.read(fd, 65536)
+                        if not chunk:
+                            break
+                        data += chunk
+                    elif pidfd in ready if pidfd is not None \
+                            else _exited(pid):
+                        # The process is gone, but children that it
+                        # started may still keep the pipe open.
+                        data += drain(fd)
+                        if not complete(data):
+                            self.kill(pid)
+                        break
+            finally:
+                os.close(fd)
+                if pidfd is not None:
+                    os.close(pidfd)
+            self.finished()
+            status, rusage = os.wait4(pid, 0)[1:]
+        except BaseException:
+            self.finished()
+            self.kill(pid)
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            raise
+        self.check(status, timed_out, rusage, base_rss)
+        return (CPL_recipe.parse_result(bytes(data),
+                                        *usage(rusage, base_rss)),
+                sampler.timeline() if sampler else None)
@@ -0,0 +1,83 @@
+'''Sampling of the memory and CPU usage of running recipe processes.
+
+While the recipe is running, its entry in :file:`/proc/<pid>/stat` is read
+at a fixed interval. Each sample records the time since the start of the
+recipe, the resident set size, the CPU time used so far and the number of
+threads. The samples are returned as a :class:`numpy.ndarray` with the
+fields
+
+``time``
+  Seconds since the start of the recipe.
+
+``rss``
+  Resident set size in bytes.
+
+``cpu``
+  User and system CPU time in seconds, accumulated since the start.
+
+``threads``
+  Number of threads.
+
+The sampling is done by the :class:`cpl.supervisor.Supervisor` of the call.
+It requires the recipe to be executed directly; for calls via a fork server
+or a worker pool, no timeline is recorded.
+'''
+from __future__ import absolute_import
+import os
+import time
+
+_clock = getattr(time, 'monotonic', time.time)
+
+dtype = [('time', 'f4'), ('rss', 'i8'), ('cpu', 'f4'), ('threads', 'i2')]
+'''NumPy data type of the timeline.'''
+
+def _read_stat(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    # The command name in parentheses may contain blanks.
+    return data[data.rindex(b')') + 2:].split()
+
+def cpu_time(pid):
+    '''Return the user and system CPU time in seconds used so far by all
+    threads of a running process, or :obj:`None` if the process is not
+    running anymore.'''
+    fields = _read_stat('/proc/%i/stat' % pid)
+    if fields is None or fields[0] in (b'Z', b'X'):
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+class Sampler(object):
+    '''Collect samples of a running process.
+
+    :param pid: Process id.
+    :type pid: :class:`int`
+    '''
+
+    def __init__(self, pid):
+        self.pid = pid
+        self._path = '/proc/%i/stat' % pid
+        self._start = _clock()
+        self._tick = float(os.sysconf('SC_CLK_TCK'))
+        self._page = os.sysconf('SC_PAGE_SIZE')
+        self._samples = list()
+
+    def sample(self):
+        '''Take one sample. Samples of a process that is exiting or not
+        running anymore are skipped.'''
+        fields = _read_stat(self._path)
+        if fields is None:
+            return
+        rss = int(fields[21]) * self._page
+        if fields[0] in (b'Z', b'X') or rss == 0:
+            return
+        self._samples.append((_clock() - self._start, rss,
+                              (int(fields[11]) + int(fields[12])) / self._tick,
+                              int(fields[17])))
+
+    def timeline(self):
+        '''Return the samples as :class:`numpy.ndarray`.'''
+        import numpy
+        return numpy.array(self._samples, dtype = dtype)
@@ -65,7 +65,7 @@ setup(
     download_url='%s/%s-%s.tar.gz' % (baseurl, pkgname, cpl_version),
     classifiers=classifiers,
     python_requires='>=2.7',
-    install_requires=['astropy'],
+    install_requires=['astropy', 'futures; python_version < "3"'],
     provides=['cpl'],
     packages=['cpl'],
     ext_modules=[module1]
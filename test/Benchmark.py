@@ -0,0 +1,146 @@
+'''Benchmarks for python-cpl.
+
+Run this in the test directory::
+
+  python Benchmark.py
+
+The test recipe is compiled in a temporary directory like in
+:mod:`TestRecipe`.
+'''
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import cpl
+from cpl import md5sum
+from TestRecipe import create_recipe, recipe_name, raw_tag
+
+def bench_memory(n = 1000):
+    '''Memory footprint of configured recipe objects.
+
+    Creates n recipe objects, sets some parameters and calibration frames
+    and returns the allocated memory per recipe in bytes. This needs
+    :mod:`tracemalloc`, which is not available on Python 2.
+    '''
+    if tracemalloc is None:
+        return float('nan')
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    recipes = list()
+    for i in range(n):
+        recipe = cpl.Recipe(recipe_name)
+        recipe.param.intopt = i
+        recipe.param.stropt = 'more'
+        recipe.calib.FLAT = 'flat_%i.fits' % i
+        recipe.calib.BIAS = [ 'bias_%i.fits' % i, 'bias_%i.fits' % (i + 1) ]
+        recipes.append(recipe)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return size / n
+
+def bench_construction(n = 1000):
+    '''Time to construct a recipe object, in microseconds.
+
+    The plugin is already loaded, so this measures the Python overhead of
+    the construction only.
+    '''
+    cpl.Recipe(recipe_name)
+    return timeit.timeit(lambda: cpl.Recipe(recipe_name), number = n) / n * 1e6
+
+def bench_construction_doc(n = 1000):
+    '''Time to construct a recipe object and to create its doc string, in
+    microseconds.
+    '''
+    cpl.Recipe(recipe_name)
+    return timeit.timeit(lambda: cpl.Recipe(recipe_name).__doc__,
+                         number = n) / n * 1e6
+
+def bench_import(n = 10):
+    '''Time to import :mod:`cpl` in a fresh interpreter, in milliseconds.
+
+    The interpreter start-up time is subtracted; the minimum of n runs is
+    taken.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+        os.path.abspath(cpl.__file__)))
+    def run(script):
+        return min(timeit.repeat(
+            lambda: subprocess.check_call([sys.executable, '-c', script],
+                                          env = env),
+            number = 1, repeat = n))
+    return (run('import cpl') - run('pass')) * 1e3
+
+def _raw_frame():
+    from astropy.io import fits
+    import numpy
+    hdulist = fits.HDUList([fits.PrimaryHDU(numpy.zeros((16, 16),
+                                                        dtype = 'int16'))])
+    hdulist[0].header['HIERARCH ESO DET DIT'] = 0.0
+    hdulist[0].header['HIERARCH ESO PRO CATG'] = raw_tag
+    return hdulist
+
+def bench_calls(n = 50, pool = None):
+    '''Throughput of short recipe calls, in calls per second.'''
+    recipe = cpl.Recipe(recipe_name)
+    recipe.temp_dir = temp_dir
+    recipe.output_dir = os.path.join(temp_dir, 'out')
+    recipe.pool = pool
+    raw = os.path.join(temp_dir, 'raw.fits')
+    _raw_frame().writeto(raw, overwrite = True)
+    recipe(raw)
+    start = timeit.default_timer()
+    results = [ recipe(raw, threaded = True) for i in range(n) ]
+    for res in results:
+        res.THE_PRO_CATG_VALUE
+    return n / (timeit.default_timer() - start)
+
+def bench_calls_pool(n = 50):
+    '''Throughput of short recipe calls in a worker pool, in calls per
+    second.'''
+    with cpl.forkserver.WorkerPool(recipes = [ (
+            os.path.join(temp_dir, recipe_name + '.so'), recipe_name) ]) \
+            as pool:
+        return bench_calls(n, pool)
+
+def bench_md5(n = 4, size = 64):
+    '''Throughput of the DATAMD5 computation of n HDU lists of the given size
+    in MB, in MB per second.'''
+    from astropy.io import fits
+    import numpy
+    hdulists = [ fits.HDUList([fits.PrimaryHDU(
+        numpy.ones(size * 2**18, dtype = 'float32'))]) for i in range(n) ]
+    start = timeit.default_timer()
+    md5sum.datamd5_all(hdulists)
+    return n * size / (timeit.default_timer() - start)
+
+benchmarks = [
+    ('Import time [ms]', bench_import),
+    ('Memory per configured recipe [bytes]', bench_memory),
+    ('Recipe construction [us]', bench_construction),
+    ('Recipe construction with __doc__ [us]', bench_construction_doc),
+    ('Short recipe calls [1/s]', bench_calls),
+    ('Short recipe calls in worker pool [1/s]', bench_calls_pool),
+    ('DATAMD5 computation [MB/s]', bench_md5),
+]
+
+if __name__ == '__main__':
+    temp_dir = tempfile.mkdtemp()
+    try:
+        create_recipe(recipe_name, temp_dir)
+        cpl.Recipe.path = temp_dir
+        cpl.Recipe.index = os.path.join(temp_dir, 'recipes.db')
+        for name, func in benchmarks:
+            sys.stdout.write('%-45s %12.1f\n' % (name, func()))
+    finally:
+        shutil.rmtree(temp_dir)
@@ -1,12 +1,17 @@
+import hashlib
 import logging
 import os
 import shutil
+import sqlite3
+import subprocess
+import sys
 import tempfile
 import unittest
 
 import numpy
 from astropy.io import fits
 import cpl
+from cpl import md5sum
 cpl.Recipe.memory_mode = 0
 
 recipe_name = 'rtest'
@@ -42,6 +47,8 @@ class CplTestCase(unittest.TestCase):
         self.temp_dir = tempfile.mkdtemp()
         create_recipe(recipe_name, self.temp_dir)
         cpl.Recipe.path = self.temp_dir
+        cpl.Recipe.index = os.path.join(self.temp_dir, 'recipes.db')
+        cpl.Recipe.scan_processes = None
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -68,11 +75,139 @@ class RecipeStatic(CplTestCase):
         self.assertEqual(len(l), 1)
         self.assertEqual(l[0], (recipe_name, ['0.0.1']))
 
+    def test_list_index(self):
+        '''List recipes with and without the recipe index'''
+        l = cpl.Recipe.list()
+        self.assertTrue(os.path.exists(cpl.Recipe.index))
+        self.assertEqual(cpl.Recipe.list(), l)
+        cpl.Recipe.index = None
+        self.assertEqual(cpl.Recipe.list(), l)
+
+    def test_index_changed_library(self):
+        '''Rescan a library that changed after it was indexed'''
+        cpl.Recipe.list()
+        os.remove(os.path.join(self.temp_dir, recipe_name + '.so'))
+        self.assertEqual(cpl.Recipe.list(), [])
+        create_recipe(recipe_name, self.temp_dir)
+        self.assertEqual(cpl.Recipe.list(), [(recipe_name, ['0.0.1'])])
+
+    def test_index_order(self):
+        '''Prefer the library that comes first in the path'''
+        dirs = [ os.path.join(self.temp_dir, d) for d in ('a', 'b') ]
+        for d in dirs:
+            os.mkdir(d)
+            shutil.copy(os.path.join(self.temp_dir, recipe_name + '.so'), d)
+        cpl.Recipe.path = dirs
+        cpl.Recipe.scan_processes = 2
+        first = os.path.join(dirs[0], recipe_name + '.so')
+        self.assertEqual(cpl.Recipe.get_recipefilename(recipe_name), first)
+        os.utime(first, None)
+        self.assertEqual(cpl.Recipe.get_recipefilename(recipe_name), first)
+        os.remove(first)
+        cpl.Recipe.path = dirs[1:]
+        cpl.Recipe.list()
+        with sqlite3.connect(cpl.Recipe.index) as conn:
+            rows = conn.execute('SELECT filename FROM libraries').fetchall()
+        self.assertEqual(rows, [ (os.path.join(dirs[1], recipe_name + '.so'),
+                                  ) ])
+
+    def test_index_alternating_paths(self):
+        '''Keep the index entries of libraries outside of the path'''
+        dirs = [ os.path.join(self.temp_dir, d) for d in ('a', 'b') ]
+        for d in dirs:
+            os.mkdir(d)
+            shutil.copy(os.path.join(self.temp_dir, recipe_name + '.so'), d)
+            cpl.Recipe.path = d
+            cpl.Recipe.list()
+        scanned = list()
+        list_recipes = cpl.index.list_recipes
+        def counting_list_recipes(filename):
+            scanned.append(filename)
+            return list_recipes(filename)
+        cpl.index.list_recipes = counting_list_recipes
+        try:
+            for d in dirs:
+                cpl.Recipe.path = d
+                self.assertEqual(cpl.Recipe.list(),
+                                 [(recipe_name, ['0.0.1'])])
+        finally:
+            cpl.index.list_recipes = list_recipes
+        self.assertEqual(scanned, [])
+
+    def test_list_parallel(self):
+        '''List recipes with the libraries scanned in worker processes'''
+        cpl.Recipe.scan_processes = 2
+        cpl.Recipe.index = None
+        self.assertEqual(cpl.Recipe.list(), [(recipe_name, ['0.0.1'])])
+
+    def test_list_crashing_library(self):
+        '''Skip a library that crashes while it is scanned'''
+        cname = os.path.join(self.temp_dir, 'crash.c')
+        with open(cname, 'w') as cfile:
+            cfile.write('void __attribute__((constructor)) crash(void) {\n'
+                        '    *(volatile int *)0 = 0;\n}\n'
+                        'int cpl_plugin_get_info(void *list) {\n'
+                        '    return 0;\n}\n')
+        os.system('%s -shared -fPIC -o %s %s' % (
+            os.getenv("CC", "gcc"), os.path.join(self.temp_dir, 'crash.so'),
+            cname))
+        cpl.Recipe.scan_processes = 2
+        self.assertEqual(cpl.Recipe.list(), [(recipe_name, ['0.0.1'])])
+        bad = cpl.index.RecipeIndex(cpl.Recipe.index).bad_libraries()
+        self.assertEqual([os.path.basename(b[0]) for b in bad], ['crash.so'])
+
+    def test_list_skip_non_cpl(self):
+        '''Skip libraries without CPL recipes without loading them'''
+        cname = os.path.join(self.temp_dir, 'nocpl.c')
+        soname = os.path.join(self.temp_dir, 'nocpl.so')
+        with open(cname, 'w') as cfile:
+            cfile.write('int some_function(void) {\n    return 0;\n}\n')
+        os.system('%s -shared -fPIC -o %s %s' % (os.getenv("CC", "gcc"),
+                                                 soname, cname))
+        self.assertFalse(cpl.elf.exports(soname, 'cpl_plugin_get_info'))
+        self.assertTrue(cpl.elf.exports(
+            os.path.join(self.temp_dir, recipe_name + '.so'),
+            'cpl_plugin_get_info'))
+        self.assertEqual(cpl.elf.exports(cname, 'cpl_plugin_get_info'), None)
+        self.assertEqual(cpl.Recipe.list(), [(recipe_name, ['0.0.1'])])
+
+    def test_import_lazy(self):
+        '''Import cpl without astropy and without probing the CPL version'''
+        script = ('import sys, cpl\n'
+                  'cpl.Recipe.index = None\n'
+                  'cpl.Recipe(%r)\n' % recipe_name +
+                  'sys.stdout.write(repr(sorted(m for m in sys.modules\n'
+                  '    if m.startswith("astropy") or m == "cpl.dfs")))\n')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(cpl.__file__))
+        out = subprocess.check_output([sys.executable, '-c', script],
+                                      env = env, cwd = self.temp_dir)
+        self.assertEqual(out.decode(), '[]')
+        self.assertTrue(isinstance(cpl.cpl_versions, list))
+        self.assertTrue(cpl.dfs.ProcessingInfo is not None)
+
     def test_create_recipe(self):
         '''Create a recipe specified by its name'''
         recipe = cpl.Recipe(recipe_name)
         self.assertTrue(isinstance(recipe, cpl.Recipe))
 
+    def test_registry(self):
+        '''Share the plugin between recipes with the same name'''
+        recipe1 = cpl.Recipe(recipe_name)
+        recipe2 = cpl.Recipe(recipe_name)
+        self.assertTrue(recipe1._recipe is recipe2._recipe)
+        recipe1.param.intopt = 5
+        self.assertEqual(recipe2.param.intopt.value, None)
+        self.assertEqual(cpl.Recipe.registry.evict(recipe_name), 1)
+        recipe3 = cpl.Recipe(recipe_name)
+        self.assertFalse(recipe1._recipe is recipe3._recipe)
+        cpl.Recipe.registry = None
+        try:
+            recipe4 = cpl.Recipe(recipe_name)
+            self.assertFalse(recipe3._recipe is recipe4._recipe)
+        finally:
+            cpl.Recipe.registry = cpl.registry.Registry()
+
     def test_create_recipe_version(self):
         '''Create a recipe specified by its name and version'''
         recipe = cpl.Recipe(recipe_name, version = '0.0.1')
@@ -119,6 +254,36 @@ class RecipeCommon(RecipeTestCase):
         self.assertTrue(isinstance(self.recipe.description[1], str))
         self.assertTrue(len(self.recipe.description[1]) > 0)
 
+    def test_doc(self):
+        '''Doc strings are created on first access'''
+        self.assertEqual(self.recipe._docstring, None)
+        self.assertTrue('Parameters:' in self.recipe.__doc__)
+        self.assertTrue(self.recipe._docstring is not None)
+        self.assertTrue('stropt' in self.recipe.param.__doc__)
+        self.assertTrue('FLAT' not in self.recipe.calib.__doc__)
+        self.recipe.calib.FLAT = 'flat.fits'
+        self.assertTrue('FLAT' in self.recipe.calib.__doc__)
+        self.assertTrue(cpl.Recipe.__doc__.startswith('Pluggable'))
+
+    def test_doc_not_built(self):
+        '''Recipe construction and configuration do not build the doc'''
+        calls = list()
+        doc = cpl.Recipe._doc
+        def counting_doc(recipe):
+            calls.append(recipe)
+            return doc(recipe)
+        cpl.Recipe._doc = counting_doc
+        try:
+            recipe = cpl.Recipe(recipe_name)
+            recipe.param.stropt = 'more'
+            recipe.calib.FLAT = 'flat.fits'
+            self.assertEqual(calls, [])
+            recipe.__doc__
+            recipe.__doc__
+            self.assertEqual(len(calls), 1)
+        finally:
+            cpl.Recipe._doc = doc
+
     def test_copyright(self):
         '''Copyright'''
         self.assertTrue(isinstance(self.recipe.__copyright__, str))
@@ -315,6 +480,26 @@ class RecipeParams(RecipeTestCase):
         '''Trivial equality test'''
         self.assertTrue(self.recipe.param == self.recipe.param)
 
+    def test_aslist_overlay(self):
+        '''Per-call parameters do not change the recipe parameters'''
+        self.recipe.param.stropt = 'more'
+        l = dict(self.recipe.param._aslist({'intopt':5, 'stropt':'less'}))
+        self.assertEqual(l, {'iiinstrument.rtest.string_option':'less',
+                             'iiinstrument.rtest.int_option':5})
+        self.assertEqual(self.recipe.param.stropt.value, 'more')
+        self.assertEqual(self.recipe.param.intopt.value, None)
+        self.assertEqual(self.recipe.param._aslist(None),
+                         [('iiinstrument.rtest.string_option', 'more')])
+
+    def test_copy(self):
+        '''Copy of a parameter list is independent from the original'''
+        self.recipe.param.stropt = 'more'
+        recipe = cpl.Recipe(recipe_name)
+        recipe.param = self.recipe.param
+        recipe.param.intopt = 5
+        self.assertEqual(recipe.param.stropt.value, 'more')
+        self.assertEqual(self.recipe.param.intopt.value, None)
+
         
 class RecipeCalib(RecipeTestCase):
     def test_set(self):
@@ -322,6 +507,12 @@ class RecipeCalib(RecipeTestCase):
         self.recipe.calib.FLAT = 'flat.fits'
         self.assertEqual(self.recipe.calib.FLAT.frames, 'flat.fits')
         
+    def test_get_same(self):
+        '''Access a calibration frame set twice'''
+        self.recipe.calib.FLAT = 'flat.fits'
+        self.assertTrue(self.recipe.calib.FLAT is self.recipe.calib['FLAT'])
+        self.assertEqual(self.recipe.tags, None)
+
     def test_set_dict(self):
         '''Assign a dictionary to the calibration frame list'''
         self.recipe.calib = { 'FLAT':'flat2.fits' }
@@ -391,6 +582,107 @@ class RecipeExec(RecipeTestCase):
         except:
             pass
 
+    def test_frames_memory_staging(self):
+        '''Raw and calibration frames staged in memory'''
+        self.recipe.tag = None
+        self.recipe.staging = 'memory'
+        for forkserver in (False, True):
+            res = self.recipe(raw = {'RRRECIPE_DOCATG_RAW': self.raw_frame },
+                              calib = { 'FLAT':self.flat_frame },
+                              forkserver = forkserver)
+            self.assertTrue(abs(self.raw_frame[0].data
+                                - res.THE_PRO_CATG_VALUE[0].data).max() == 0)
+            try:
+                res.THE_PRO_CATG_VALUE.close()
+            except:
+                pass
+        self.assertRaises(ValueError, self.recipe, self.raw_frame,
+                          staging = 'tape')
+
+    def test_frames_staging_cache(self):
+        '''Calibration frames staged once in a shared cache'''
+        self.recipe.calib.FLAT = self.flat_frame
+        with cpl.staging.StagingCache(self.temp_dir) as cache:
+            for i in range(3):
+                res = self.recipe(self.raw_frame, staging_cache = cache)
+                try:
+                    res.THE_PRO_CATG_VALUE.close()
+                except:
+                    pass
+            self.assertEqual(cache.misses, 2)
+            self.assertEqual(cache.hits, 4)
+            self.assertEqual(len(cache), 2)
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.size, 0)
+
+    def test_frames_staging_cache_data_access(self):
+        '''Staging cache hit independent of the data access'''
+        from cpl.frames import mkabspath
+        filename = os.path.join(self.temp_dir, 'scaled.fits')
+        fits.HDUList([fits.PrimaryHDU(
+            numpy.arange(1000, dtype = numpy.uint16))]).writeto(filename)
+        with cpl.staging.StagingCache(self.temp_dir) as cache:
+            for load in (False, True):
+                with fits.open(filename) as hdulist:
+                    hdulist[0].header['HIERARCH ESO DET GAIN'] = 2.5
+                    if load:
+                        hdulist[0].data
+                    lease = cache.lease()
+                    mkabspath([ ('FLAT', hdulist) ], self.temp_dir, lease)
+                    lease.close()
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(cache.hits, 1)
+
+    def test_frames_original_file(self):
+        '''Unchanged HDU list passed by its file name'''
+        filename = os.path.join(self.temp_dir, 'raw.fits')
+        md5sum.update_md5(self.raw_frame)
+        self.raw_frame.writeto(filename)
+        with fits.open(filename) as raw:
+            self.assertEqual(cpl.staging.original_file(raw), filename)
+            res = self.recipe(raw)
+        key = 'HIERARCH ESO PRO REC1 RAW1 NAME'
+        self.assertEqual(res.THE_PRO_CATG_VALUE[0].header[key], 'raw.fits')
+        try:
+            res.THE_PRO_CATG_VALUE.close()
+        except:
+            pass
+
+    def test_frames_original_file_md5(self):
+        '''Unchanged HDU list without DATAMD5 keyword'''
+        filename = os.path.join(self.temp_dir, 'raw.fits')
+        self.raw_frame.writeto(filename)
+        with fits.open(filename) as raw:
+            res = self.recipe(raw)
+            self.assertEqual(raw[0].header['DATAMD5'],
+                             md5sum.filemd5(filename))
+        key = 'HIERARCH ESO PRO REC1 RAW1 NAME'
+        self.assertNotEqual(res.THE_PRO_CATG_VALUE[0].header[key], 'raw.fits')
+        try:
+            res.THE_PRO_CATG_VALUE.close()
+        except:
+            pass
+
+    def test_frames_patched_header(self):
+        '''Calibration file with a patched header'''
+        filename = os.path.join(self.temp_dir, 'flat.fits')
+        self.flat_frame.writeto(filename)
+        with fits.open(filename) as flat:
+            flat[0].header['HIERARCH ESO DET GAIN'] = 2.5
+            self.assertNotEqual(cpl.staging.data_layout(flat), None)
+            res = self.recipe(self.raw_frame, calib = { 'FLAT':flat })
+            key = 'HIERARCH ESO PRO REC1 CAL1 DATAMD5'
+            self.assertEqual(res.THE_PRO_CATG_VALUE[0].header[key],
+                             md5sum.filemd5(filename))
+            self.assertEqual(flat[0].header['DATAMD5'],
+                             md5sum.filemd5(filename))
+            self.assertNotEqual(cpl.staging.data_layout(flat), None)
+        try:
+            res.THE_PRO_CATG_VALUE.close()
+        except:
+            pass
+
     def test_frames_keyword_calib(self):
         '''Raw frame specified as keyword, calibration frame set in recipe'''
         self.recipe.tag = None
@@ -517,6 +809,77 @@ class RecipeExec(RecipeTestCase):
         except:
             pass
 
+    def test_prepare(self):
+        '''Run a prepared plan with fixed parameters, calib and environment'''
+        plan = self.recipe.prepare(param = { 'stropt':'more' },
+                                   calib = { 'FLAT':self.flat_frame },
+                                   env = { 'TESTENV':'plan' })
+        self.recipe.param.stropt = 'less'
+        self.recipe.env['TESTENV'] = 'recipe'
+        with plan:
+            self.assertEqual([ tag for tag, f in plan.calib ], ['FLAT'])
+            self.assertTrue(os.path.isfile(plan.calib[0][1]))
+            for i in range(2):
+                with plan(self.raw_frame).THE_PRO_CATG_VALUE as res:
+                    self.assertEqual(res[0].header['HIERARCH ESO QC STROPT'],
+                                     'more')
+                    self.assertEqual(res[0].header['HIERARCH ESO QC TESTENV'],
+                                     'plan')
+            self.assertRaises(TypeError, plan, self.raw_frame,
+                              param = { 'stropt':'less' })
+        self.assertFalse(os.path.exists(plan.calib[0][1]))
+        self.assertRaises(ValueError, plan, self.raw_frame)
+
+    def test_forkserver(self):
+        '''Run the recipe via a fork server'''
+        self.recipe.forkserver = True
+        server = self.recipe._plugin.forkserver()
+        self.assertTrue(server.alive())
+        self.assertNotEqual(server.pid, os.getpid())
+        results = [ self.recipe(self.raw_frame, threaded = True,
+                                param = { 'stropt':'fork%i' % i })
+                    for i in range(3) ]
+        for i, res in enumerate(results):
+            with res.THE_PRO_CATG_VALUE as hdulist:
+                self.assertEqual(hdulist[0].header['HIERARCH ESO QC STROPT'],
+                                 'fork%i' % i)
+        server.close()
+        self.assertFalse(server.alive())
+        with self.recipe(self.raw_frame).THE_PRO_CATG_VALUE as hdulist:
+            self.assertTrue(isinstance(hdulist, fits.HDUList))
+        self.assertTrue(self.recipe._plugin.forkserver().alive())
+
+    def test_worker_pool(self):
+        '''Run the recipe in a worker pool'''
+        with cpl.forkserver.WorkerPool(2, [ self.recipe ]) as pool:
+            self.recipe.pool = pool
+            results = [ self.recipe(self.raw_frame, threaded = True,
+                                    param = { 'stropt':'pool%i' % i })
+                        for i in range(4) ]
+            for i, res in enumerate(results):
+                with res.THE_PRO_CATG_VALUE as hdulist:
+                    self.assertEqual(
+                        hdulist[0].header['HIERARCH ESO QC STROPT'],
+                        'pool%i' % i)
+            pool._workers[0]._process.kill()
+            pool._workers[0]._process.wait()
+            for i in range(2):
+                with self.recipe(self.raw_frame).THE_PRO_CATG_VALUE as res:
+                    self.assertTrue(isinstance(res, fits.HDUList))
+
+    def test_forkserver_limits(self):
+        '''Resource limits with a fork server and a worker pool'''
+        limits = [ dict(), { 'max_memory': 1 << 40, 'max_cpu_time': 600 } ]
+        for l in limits:
+            res = self.recipe(self.raw_frame, forkserver = True, **l)
+            with res.THE_PRO_CATG_VALUE as hdulist:
+                self.assertTrue(isinstance(hdulist, fits.HDUList))
+        with cpl.forkserver.WorkerPool(1, [ self.recipe ]) as pool:
+            for l in limits:
+                res = self.recipe(self.raw_frame, pool = pool, **l)
+                with res.THE_PRO_CATG_VALUE as hdulist:
+                    self.assertTrue(isinstance(hdulist, fits.HDUList))
+
     def test_param_keyword_dict_wrong(self):
         '''Parameter handling via keyword dict'''
         self.assertRaises(KeyError, self.recipe,
@@ -617,6 +980,103 @@ class RecipeExec(RecipeTestCase):
             except:
                 pass
 
+    def test_executor(self):
+        '''Parallel execution with a RecipeExecutor'''
+        with cpl.RecipeExecutor(max_workers = 2, max_queue = 2) as executor:
+            futures = [ executor.submit(self.recipe, self.raw_frame,
+                                        param = { 'intopt':i })
+                        for i in range(6) ]
+            values = set()
+            for future in cpl.executor.as_completed(futures):
+                with future.result().THE_PRO_CATG_VALUE as res:
+                    values.add(res[0].header['HIERARCH ESO QC INTOPT'])
+            self.assertEqual(values, set(range(6)))
+            results = executor.map(lambda i: self.recipe(
+                self.raw_frame, param = { 'intopt':i }), range(3))
+            for i, res in enumerate(results):
+                self.assertEqual(res.THE_PRO_CATG_VALUE[0].header[
+                    'HIERARCH ESO QC INTOPT'], i)
+            res = self.recipe(self.raw_frame, threaded = executor)
+            self.assertTrue(isinstance(res.future.result(), cpl.Result))
+        self.assertRaises(RuntimeError, executor.submit, self.recipe,
+                          self.raw_frame)
+
+    def test_executor_resize(self):
+        '''Calls waiting after a RecipeExecutor was shrunk stay pending'''
+        import threading
+        event = threading.Event()
+        with cpl.RecipeExecutor(max_workers = 2) as executor:
+            running = [ executor.submit(event.wait) for i in range(2) ]
+            executor.resize(1)
+            pending = [ executor.submit(lambda: True) for i in range(2) ]
+            self.assertFalse(pending[0].running())
+            self.assertTrue(pending[0].cancel())
+            event.set()
+            self.assertTrue(pending[1].result())
+            self.assertTrue(all(f.result() for f in running))
+        self.assertTrue(pending[0].cancelled())
+
+    def test_scheduler(self):
+        '''Parallel execution with CPU admission'''
+        cpus = cpl.scheduler.available_cpus()[:2]
+        scheduler = cpl.scheduler.Scheduler(cpus)
+        self.assertEqual(scheduler.demand([('OMP_NUM_THREADS', '1')]), 1)
+        self.assertEqual(scheduler.demand([('OMP_NUM_THREADS', '64,2')]),
+                         len(cpus))
+        self.recipe.env['OMP_NUM_THREADS'] = '1'
+        results = [ self.recipe(self.raw_frame, param = { 'intopt':i },
+                                threaded = True, scheduler = scheduler)
+                    for i in range(6) ]
+        results.append(self.recipe(self.raw_frame, threaded = True,
+                                   scheduler = scheduler,
+                                   env = { 'OMP_NUM_THREADS':'2' }))
+        for i, res in enumerate(results[:6]):
+            self.assertEqual(res.THE_PRO_CATG_VALUE[0].header[
+                'HIERARCH ESO QC INTOPT'], i)
+        self.assertTrue(isinstance(results[6].future.result(), cpl.Result))
+        self.assertEqual(scheduler.free, len(cpus))
+
+    def test_scheduler_memory(self):
+        '''Parallel execution with memory admission'''
+        history = cpl.history.RunHistory(os.path.join(self.temp_dir,
+                                                      'history.db'))
+        scheduler = cpl.scheduler.Scheduler(history = history,
+                                            memory = 1 << 40)
+        res = self.recipe(self.raw_frame, scheduler = scheduler)
+        self.assertTrue(res.stat.max_rss > 0)
+        self.assertEqual(history.predict(self.recipe.__name__,
+                                         self.recipe.version[0], 0),
+                         res.stat.max_rss)
+        results = [ self.recipe(self.raw_frame, threaded = True,
+                                scheduler = scheduler) for i in range(4) ]
+        for res in results:
+            self.assertTrue(isinstance(res.future.result(), cpl.Result))
+        self.assertEqual(scheduler.free_memory, scheduler.memory)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio not available')
+    def test_acall(self):
+        '''Concurrent execution in an asyncio event loop'''
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(asyncio.gather(*[
+                self.recipe.acall(self.raw_frame, param = { 'intopt':i },
+                                  env = { 'TESTENV':'knu%02i' % i })
+                for i in range(5) ]))
+            for i, res in enumerate(results):
+                self.assertTrue(isinstance(res, cpl.Result))
+                with res.THE_PRO_CATG_VALUE as hdulist:
+                    self.assertEqual(hdulist[0].header[
+                        'HIERARCH ESO QC INTOPT'], i)
+                    self.assertEqual(hdulist[0].header[
+                        'HIERARCH ESO QC TESTENV'], 'knu%02i' % i)
+                self.assertTrue(len(res.log) > 0)
+            self.recipe.tag = 'some_unknown_tag'
+            self.assertRaises(cpl.CplError, loop.run_until_complete,
+                              self.recipe.acall(self.raw_frame))
+        finally:
+            loop.close()
+
     def test_error_parallel(self):
         '''Error handling in parallel execution'''
         self.recipe.tag = 'some_unknown_tag'
@@ -625,6 +1085,55 @@ class RecipeExec(RecipeTestCase):
             return x.THE_PRO_CATG_VALUE
         self.assertRaises(cpl.CplError, get, res)
 
+    def test_stat(self):
+        '''Resource usage statistics of the recipe call'''
+        res = self.recipe(self.raw_frame)
+        self.assertEqual(res.stat.return_code, 0)
+        self.assertTrue(res.stat.wall_time >= 0)
+        self.assertTrue(res.stat.max_rss > 0)
+        self.assertTrue(res.stat.minor_faults > 0)
+        self.assertTrue(res.stat.voluntary_switches >= 0)
+        if os.path.exists('/proc/self/io'):
+            self.assertTrue(res.stat.bytes_written > 0)
+
+    def test_timeline(self):
+        '''Sampling of the memory and CPU usage'''
+        res = self.recipe(self.raw_frame)
+        self.assertEqual(res.stat.timeline, None)
+        res = self.recipe(self.raw_frame, sampling = 0.001)
+        timeline = res.stat.timeline
+        self.assertEqual(timeline.dtype.names,
+                         ('time', 'rss', 'cpu', 'threads'))
+        if len(timeline) > 0:
+            self.assertTrue(timeline['rss'].min() > 0)
+            self.assertTrue(timeline['threads'].min() >= 1)
+
+    def test_timeout(self):
+        '''Timeout and cancellation of a running recipe'''
+        self.recipe.param.sleep = 5
+        self.assertRaises(cpl.RecipeTimeout, self.recipe, self.raw_frame,
+                          timeout = 0.5)
+        res = self.recipe(self.raw_frame, threaded = True)
+        res.join(0.5)
+        self.assertTrue(res.cancel())
+        self.assertRaises(cpl.RecipeKilled, getattr, res, 'THE_PRO_CATG_VALUE')
+        self.recipe.forkserver = True
+        self.assertRaises(ValueError, self.recipe, self.raw_frame,
+                          timeout = 0.5)
+
+    def test_stall(self):
+        '''Detection of a hanging recipe'''
+        res = self.recipe(self.raw_frame, stall_timeout = 10)
+        self.assertFalse(res.stat.stalled)
+        self.assertTrue(0 <= res.stat.max_idle < 10)
+        self.recipe.param.sleep = 5
+        try:
+            self.recipe(self.raw_frame, stall_timeout = 0.5)
+            self.fail('Stalled recipe not detected')
+        except cpl.RecipeStalled as e:
+            self.assertTrue(e.stat.stalled)
+            self.assertTrue(e.stat.max_idle >= 0.5)
+
     def test_md5sum_result(self):
         '''MD5sum of the result file'''
         self.recipe.tag = raw_tag
@@ -639,6 +1148,48 @@ class RecipeExec(RecipeTestCase):
         self.assertEqual(len(md5sum), 
                          len('9d123996fa9a7bda315d07e063043454'))
 
+    def test_md5sum_file(self):
+        '''MD5sum computed from the result file'''
+        self.recipe.tag = raw_tag
+        output_dir = os.path.join(self.temp_dir, 'out')
+        res = self.recipe(self.raw_frame, output_dir = output_dir)
+        filename = res.THE_PRO_CATG_VALUE
+        with fits.open(filename) as hdulist:
+            checksum = hdulist[0].header['DATAMD5']
+            self.assertTrue(md5sum.verify_md5(hdulist))
+        self.assertEqual(md5sum.filemd5(filename), checksum)
+        self.assertEqual(md5sum.datamd5_all([filename, filename]),
+                         [checksum, checksum])
+
+    def test_md5sum_block_aligned(self):
+        '''MD5sum of a data unit that fills whole blocks'''
+        data = numpy.arange(720, dtype = '>i4')
+        checksum = hashlib.md5(data.tobytes() + b'\0' * 2880).hexdigest()
+        filename = os.path.join(self.temp_dir, 'aligned.fits')
+        fits.HDUList([fits.PrimaryHDU(data)]).writeto(filename)
+        with fits.open(filename) as hdulist:
+            self.assertEqual(md5sum.datamd5(hdulist), checksum)
+        self.assertEqual(md5sum.filemd5(filename), checksum)
+
+    def test_md5sum_scaled(self):
+        '''MD5sum of a staged file with scaled data'''
+        filename = os.path.join(self.temp_dir, 'scaled.fits')
+        fits.HDUList([fits.PrimaryHDU(
+            numpy.arange(1000, dtype = numpy.uint16))]).writeto(filename)
+        from cpl.frames import mkabspath
+        keys = list()
+        for load in (False, True):
+            with fits.open(filename) as hdulist:
+                hdulist[0].header['HIERARCH ESO DET GAIN'] = 2.5
+                if load:
+                    hdulist[0].data
+                frames = [ ('FLAT', hdulist) ]
+                mkabspath(frames, self.temp_dir)
+                keys.append(hdulist[0].header['DATAMD5'])
+            with fits.open(frames[0][1]) as staged:
+                self.assertTrue(md5sum.verify_md5(staged))
+        self.assertEqual(keys[0], keys[1])
+
     def test_md5sum_calib(self):
         '''Created MD5sum for a HDUList calib file'''
         self.recipe.tag = raw_tag
@@ -1046,5 +1597,19 @@ class ProcessingInfo(RecipeTestCase):
         self.assertEqual(recipe.version[0], self.recipe.version[0])
         self.assertEqual(len(recipe.param), len(self.recipe.param))
 
+class ImportTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        '''Importing cpl does not load the heavy modules'''
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(cpl.__file__)))
+        modules = [ 'astropy.io.fits', 'concurrent.futures',
+                    'multiprocessing' ]
+        script = 'import sys, cpl; print(" ".join(m for m in %r ' \
+            'if m in sys.modules))' % modules
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env = env)
+        self.assertEqual(output.decode().split(), [])
+
 if __name__ == '__main__':
     unittest.main()